@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for parsing image tags and generating new tags.
+
+Run all the benchmarks and save the results as a baseline:
+    python benchmarks/bench_tags.py --save baseline.json
+
+Later, compare against the baseline, exiting with a non-zero return code if
+any benchmark is slower than the baseline by more than the threshold:
+    python benchmarks/bench_tags.py --compare baseline.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+from collections import OrderedDict
+
+from docker_ci_deploy.__main__ import (
+    generate_semver_versions, generate_tags, RegistryTagger, split_image_tag,
+    VersionTagger)
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function sets up the benchmark and
+    returns a function that takes no arguments to time.
+    """
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+def make_images(count):
+    """ Generate ``count`` different, realistic image tags. """
+    images = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            images.append('image-%d' % (i,))
+        elif kind == 1:
+            images.append('org-%d/image_name.%d:tag-%d' % (i % 17, i, i))
+        elif kind == 2:
+            images.append(
+                'registry-%d.example.com:5000/org/team/image-%d:1.2.%d-alpine'
+                % (i % 5, i, i))
+        else:
+            images.append('localhost:5000/a__b--c/image-%d' % (i,))
+    return images
+
+
+def long_version(parts):
+    """ Generate a semver-like version string with many parts. """
+    return '.'.join(str(i) for i in range(1, parts + 1)) + '-rc.1-alpine'
+
+
+@benchmark('split_image_tag')
+def bench_split_image_tag():
+    images = make_images(100)
+
+    def run():
+        for image in images:
+            split_image_tag(image)
+    return run
+
+
+@benchmark('split_image_tag_long_name')
+def bench_split_image_tag_long_name():
+    image = '/'.join(['component-%d.part_%d' % (i, i) for i in range(50)])
+    image = 'registry.example.com:5000/' + image + ':tag'
+
+    def run():
+        split_image_tag(image)
+    return run
+
+
+@benchmark('split_image_tag_malformed')
+def bench_split_image_tag_malformed():
+    # Malformed names like this caused exponential backtracking in the old
+    # regex-based parser
+    images = ['a' * length + '!' for length in (10, 100, 1000)]
+
+    def run():
+        for image in images:
+            try:
+                split_image_tag(image)
+            except ValueError:
+                pass
+    return run
+
+
+@benchmark('registry_tagger_generate_tag')
+def bench_registry_tagger_generate_tag():
+    tagger = RegistryTagger('registry.example.com:5000')
+    names = [split_image_tag(image)[0] for image in make_images(100)]
+
+    def run():
+        for name in names:
+            tagger.generate_tag(name)
+    return run
+
+
+@benchmark('version_tagger_generate_tags')
+def bench_version_tagger_generate_tags():
+    tagger = VersionTagger(generate_semver_versions('1.2.3-alpha'), True)
+    tags = [None, 'latest', 'alpine', '1.2-alpine', '1.2.3-alpha-onbuild']
+
+    def run():
+        for tag in tags:
+            tagger.generate_tags(tag)
+    return run
+
+
+@benchmark('generate_semver_versions')
+def bench_generate_semver_versions():
+    versions = ['1.2.3', '8.7.1-jessie', '0.1.0', '2.7.13-alpine3.6']
+
+    def run():
+        for version in versions:
+            generate_semver_versions(version, zero=True)
+    return run
+
+
+@benchmark('generate_semver_versions_long')
+def bench_generate_semver_versions_long():
+    version = long_version(200)
+
+    def run():
+        generate_semver_versions(version)
+    return run
+
+
+@benchmark('generate_tags')
+def bench_generate_tags():
+    version_tagger = VersionTagger(generate_semver_versions('1.2.3'), True)
+    registry_tagger = RegistryTagger('registry.example.com:5000')
+    images = make_images(100)
+
+    def run():
+        for image in images:
+            generate_tags(image, ['alpine', 'onbuild'], version_tagger,
+                          registry_tagger)
+    return run
+
+
+@benchmark('generate_tags_many_images')
+def bench_generate_tags_many_images():
+    version_tagger = VersionTagger(
+        generate_semver_versions(long_version(10)), True)
+    registry_tagger = RegistryTagger('registry.example.com:5000')
+    tags = ['tag-%d' % (i,) for i in range(20)]
+    images = make_images(5000)
+
+    def run():
+        for image in images:
+            generate_tags(image, tags, version_tagger, registry_tagger)
+    return run
+
+
+def run_benchmark(setup, repeat, min_time):
+    """
+    Time a benchmark. The number of calls per repeat is calibrated so that
+    each repeat takes at least ``min_time`` seconds.
+
+    :return: A dict of the best and median time per call in seconds.
+    """
+    timer = timeit.Timer(setup())
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+
+    times = sorted(t / number for t in timer.repeat(repeat, number))
+    return {
+        'best': times[0],
+        'median': times[len(times) // 2],
+        'number': number,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results against a baseline.
+
+    :return: The names of the benchmarks that regressed.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print('%-32s (no baseline)' % (name,))
+            continue
+        ratio = result['best'] / baseline[name]['best']
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print('%-32s %8.2fx%s' % (
+            name, ratio, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main(raw_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description='Benchmark tag parsing and generation.')
+    parser.add_argument('-k', '--filter', default='',
+                        help='Only run benchmarks with names containing this')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of times to repeat each benchmark '
+                             '(default: %(default)s)')
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='Minimum time in seconds for each repeat '
+                             '(default: %(default)s)')
+    parser.add_argument('--save', metavar='PATH',
+                        help='Save the results as JSON to this file')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='Compare the results against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Combine with --compare to set the fraction by '
+                             'which a benchmark may be slower than the '
+                             'baseline (default: %(default)s)')
+    args = parser.parse_args(raw_args)
+
+    results = OrderedDict()
+    for name, setup in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        results[name] = run_benchmark(setup, args.repeat, args.min_time)
+        print('%-32s %12.3f us' % (name, results[name]['best'] * 1e6))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'benchmarks': results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['benchmarks']
+        print()
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
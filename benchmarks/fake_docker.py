@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A stand-in for the ``docker`` executable that doesn't need a Docker daemon,
+for measuring docker-ci-deploy with ``--executable``. It understands the
+``tag``, ``push`` and ``image inspect`` commands.
+
+It is configured with environment variables:
+
+FAKE_DOCKER_LATENCY
+    Seconds to wait before each command completes (default: 0).
+FAKE_DOCKER_LATENCY_<COMMAND>
+    Seconds to wait for one kind of command, e.g. FAKE_DOCKER_LATENCY_PUSH.
+FAKE_DOCKER_JITTER
+    Maximum random number of seconds to add to or subtract from the latency.
+FAKE_DOCKER_FAILURE_RATE
+    Fraction of commands that should fail (default: 0).
+FAKE_DOCKER_LOG
+    A file to append a line to for every command run, to count processes.
+FAKE_DOCKER_REGISTRY
+    The address of a (fake) registry to upload a manifest to when a tag for
+    that registry is pushed, using plain HTTP.
+"""
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:  # pragma: no cover
+    from urllib2 import Request, urlopen  # Python 2
+
+MANIFEST_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+
+
+def _env_float(name, default=0.0):
+    return float(os.environ.get(name, default))
+
+
+def _digest(data):
+    return 'sha256:' + hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _split_tag(image_tag):
+    name, _, tag = image_tag.rpartition(':')
+    if not name or '/' in tag:
+        return image_tag, 'latest'
+    return name, tag
+
+
+def _upload_manifest(registry, image_tag):
+    name, tag = _split_tag(image_tag)
+    repository = name[len(registry) + 1:]
+    manifest = json.dumps({
+        'schemaVersion': 2,
+        'mediaType': MANIFEST_TYPE,
+        'config': {'mediaType': 'application/octet-stream', 'size': 2,
+                   'digest': _digest(repository)},
+        'layers': [],
+    }).encode('utf-8')
+    request = Request(
+        'http://%s/v2/%s/manifests/%s' % (registry, repository, tag),
+        data=manifest, headers={'Content-Type': MANIFEST_TYPE})
+    request.get_method = lambda: 'PUT'
+    urlopen(request).read()
+    return _digest(manifest.decode('utf-8'))
+
+
+def tag(source, target):
+    pass
+
+
+def push(image_tag):
+    name, tag = _split_tag(image_tag)
+    print('The push refers to repository [%s]' % (name,))
+    layer = _digest(name)[7:19]
+    print('%s: Preparing' % (layer,))
+    print('%s: Pushed' % (layer,))
+
+    registry = os.environ.get('FAKE_DOCKER_REGISTRY')
+    if registry and name.startswith(registry + '/'):
+        digest = _upload_manifest(registry, image_tag)
+    else:
+        digest = _digest(image_tag)
+    print('%s: digest: %s size: 528' % (tag, digest))
+
+
+def inspect(images):
+    print(json.dumps([
+        {'Id': _digest(image), 'RepoTags': [image], 'RepoDigests': []}
+        for image in images]))
+
+
+def main(args=sys.argv[1:]):
+    command = args[0] if args else ''
+    if command == 'image' and args[1:2] == ['inspect']:
+        command = 'inspect'
+
+    log_path = os.environ.get('FAKE_DOCKER_LOG')
+    if log_path:
+        with open(log_path, 'a') as f:
+            f.write(' '.join(args) + '\n')
+
+    latency = _env_float('FAKE_DOCKER_LATENCY_' + command.upper(),
+                         _env_float('FAKE_DOCKER_LATENCY'))
+    jitter = _env_float('FAKE_DOCKER_JITTER')
+    delay = latency + random.uniform(-jitter, jitter)
+    if delay > 0:
+        time.sleep(delay)
+
+    if random.random() < _env_float('FAKE_DOCKER_FAILURE_RATE'):
+        print('Error: injected failure', file=sys.stderr)
+        return 1
+
+    if command == 'tag':
+        tag(args[1], args[2])
+    elif command == 'push':
+        try:
+            push(args[1])
+        except IOError as e:
+            print('Error: failed to upload manifest: %s' % (e,),
+                  file=sys.stderr)
+            return 1
+    elif command == 'inspect':
+        inspect(args[2:])
+    else:
+        print('Error: unsupported command: %s' % (' '.join(args),),
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
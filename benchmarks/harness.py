@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmarks for deploying many images, without a real Docker daemon
+or registry. docker-ci-deploy is run against a fake ``docker`` executable (for
+the ``cli`` backend) or a fake Docker daemon (for the ``engine`` backend), and
+a fake registry, all of which can be made slow or unreliable.
+
+Compare the serial runner with 4 and 16 jobs, with 100ms per command:
+    python benchmarks/harness.py --images 20 --latency 0.1 --jobs 1 4 16
+
+Compare the backends with pushing each image only once:
+    python benchmarks/harness.py --backend cli engine --push-once
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from docker_ci_deploy.testing.fake_engine import FakeDockerEngine
+from docker_ci_deploy.testing.fake_registry import (
+    Faults, FakeRegistry, make_manifest)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_DOCKER = os.path.join(ROOT, 'benchmarks', 'fake_docker.py')
+
+
+def make_images(count):
+    return ['bench/image-%d' % (i,) for i in range(count)]
+
+
+def make_tags(count):
+    return ['tag-%d' % (i,) for i in range(count)]
+
+
+def _count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+
+def run_scenario(backend, jobs, args, tmpdir):
+    """
+    Deploy the images once with docker-ci-deploy.
+
+    :return:
+        A dict of the wall time, whether the deploy succeeded and the numbers
+        of docker commands, processes and requests.
+    """
+    faults = dict(latency=args.latency, jitter=args.jitter,
+                  failure_rate=args.failure_rate, seed=args.seed)
+    images = make_images(args.images)
+    tags = make_tags(args.tags)
+    log_path = os.path.join(tmpdir, 'docker-%s-%d.log' % (backend, jobs))
+    socket_path = os.path.join(tmpdir, 'docker-%s-%d.sock' % (backend, jobs))
+
+    registry = FakeRegistry(
+        faults=Faults(**faults) if args.registry_faults else Faults())
+    engine = None
+    with registry:
+        command = [
+            sys.executable, '-m', 'docker_ci_deploy',
+            '--registry', registry.domain,
+            '--insecure-registry', registry.domain,
+            '--jobs', str(jobs),
+            '--tag'] + tags
+        if args.push_once:
+            command.append('--push-once')
+
+        if backend == 'engine':
+            engine = FakeDockerEngine(
+                socket_path, [image + ':latest' for image in images],
+                faults=Faults(**faults)).start()
+            command += ['--backend', 'engine', '--docker-socket', socket_path]
+            if args.push_once:
+                # The fake daemon doesn't upload anything to the registry
+                for image in images:
+                    for tag in tags:
+                        registry.add_manifest(
+                            image, tag, make_manifest(image.encode('utf-8')))
+        else:
+            command += ['--executable', FAKE_DOCKER]
+
+        env = dict(os.environ)
+        env.update({
+            'PYTHONPATH': ROOT,
+            'FAKE_DOCKER_LOG': log_path,
+            'FAKE_DOCKER_LATENCY': str(args.latency),
+            'FAKE_DOCKER_JITTER': str(args.jitter),
+            'FAKE_DOCKER_FAILURE_RATE': str(args.failure_rate),
+            'FAKE_DOCKER_REGISTRY': registry.domain,
+        })
+
+        devnull = open(os.devnull, 'w')
+        start = time.time()
+        try:
+            returncode = subprocess.call(
+                command + images, env=env, stdout=devnull,
+                stderr=None if args.verbose else devnull)
+        finally:
+            elapsed = time.time() - start
+            devnull.close()
+            if engine is not None:
+                engine.stop()
+
+    if engine is not None:
+        commands = sum(
+            1 for method, _, _ in engine.requests if method == 'POST')
+        processes = 1
+        engine_requests = len(engine.requests)
+    else:
+        commands = processes = _count_lines(log_path)
+        processes += 1
+        engine_requests = 0
+
+    return {
+        'ok': returncode == 0,
+        'time': elapsed,
+        'commands': commands,
+        'processes': processes,
+        'engine_requests': engine_requests,
+        'registry_requests': len(registry.requests),
+    }
+
+
+def main(raw_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description='Benchmark deploying many images end-to-end.')
+    parser.add_argument('--images', type=int, default=10,
+                        help='Number of images to deploy '
+                             '(default: %(default)s)')
+    parser.add_argument('--tags', type=int, default=3,
+                        help='Number of tags for each image '
+                             '(default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds each docker command or request takes '
+                             '(default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Maximum random number of seconds to add to or '
+                             'subtract from the latency')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of docker commands that fail')
+    parser.add_argument('--registry-faults', action='store_true',
+                        help='Also inject the latency and failures into '
+                             'registry requests')
+    parser.add_argument('--seed', type=int,
+                        help='Seed for the fake daemon and registry')
+    parser.add_argument('-j', '--jobs', type=int, nargs='+', default=[1, 4],
+                        help='Numbers of jobs to compare '
+                             '(default: %(default)s)')
+    parser.add_argument('--backend', nargs='+', choices=['cli', 'engine'],
+                        default=['cli'],
+                        help='Backends to compare (default: %(default)s)')
+    parser.add_argument('--push-once', action='store_true',
+                        help='Deploy with the --push-once option')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Show docker-ci-deploy's errors")
+    args = parser.parse_args(raw_args)
+
+    print('%-8s %5s %8s %6s %9s %10s %9s %9s' % (
+        'backend', 'jobs', 'time (s)', 'status', 'commands', 'commands/s',
+        'processes', 'requests'))
+    tmpdir = tempfile.mkdtemp(prefix='dcd-')
+    try:
+        for backend in args.backend:
+            for jobs in args.jobs:
+                result = run_scenario(backend, jobs, args, tmpdir)
+                print('%-8s %5d %8.2f %6s %9d %10.1f %9d %9d' % (
+                    backend, jobs, result['time'],
+                    'ok' if result['ok'] else 'failed', result['commands'],
+                    result['commands'] / result['time'], result['processes'],
+                    result['engine_requests'] + result['registry_requests']))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
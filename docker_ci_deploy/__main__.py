@@ -2,12 +2,24 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
-import argparse
+# Modules that are slow to import and only needed for some commands (e.g.
+# argparse, json, subprocess and tempfile) are imported where they're used,
+# so that starting the command, and importing this module, stays fast.
+import os
 import re
-import subprocess
 import sys
+import threading
+import time
+from collections import deque, namedtuple, OrderedDict
+from contextlib import contextmanager
+from functools import partial
 from itertools import chain
 
+try:
+    from contextvars import copy_context
+except ImportError:  # pragma: no cover
+    copy_context = None  # Python < 3.7
+
 
 # Reference regexes for parsing Docker image tags into separate parts.
 # https://github.com/docker/distribution/blob/v2.6.0-rc.2/reference/regexp.go
@@ -28,34 +40,210 @@ NAME_PATTERN = (
 
 TAG_PATTERN = r'[\w][\w.-]{0,127}'
 DIGEST_PATTERN = (
-    r'[A-Za-z][A-Za-z0-9]*(?:[-_+.][A-Za-z][A-Za-z0-9]*)*[:][[:xdigit:]]{32,}')
+    r'[A-Za-z][A-Za-z0-9]*(?:[-_+.][A-Za-z][A-Za-z0-9]*)*[:][0-9a-fA-F]{32,}')
+
+
+class _LazyRegex(object):
+    """
+    A regex that is compiled when it is first used rather than when this
+    module is imported. Compiling the reference regexes below takes longer
+    than everything else that happens on import.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self._regex = None
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't found normally, i.e. the
+        # compiled regex's methods. Compiling twice in a race is harmless.
+        if self._regex is None:
+            self._regex = re.compile(self.pattern, self.flags)
+        return getattr(self._regex, name)
+
 
 # REFERENCE_REGEX is the full supported format of a reference. The regex is
 # anchored and has capturing groups for name, tag, and digest components.
 # reference = name [ ":" tag ] [ "@" digest ]
-REFERENCE_REGEX = re.compile(
+REFERENCE_REGEX = _LazyRegex(
     r'^({})'.format(NAME_PATTERN) +
     r'(?::({}))?'.format(TAG_PATTERN) +
-    r'(?:@({}))?$'.format(DIGEST_PATTERN))
+    r'(?:@({}))?\Z'.format(DIGEST_PATTERN))
 
 # ANCHORED_NAME_REGEX is used to parse a name value, capturing the hostname and
 # trailing components.
-ANCHORED_NAME_REGEX = re.compile(r'^{}$'.format(
+ANCHORED_NAME_REGEX = _LazyRegex(r'^{}\Z'.format(
     r'(?:({})/)?'.format(HOSTNAME_PATTERN) +
     r'({})'.format(
         NAME_COMPONENT_PATTERN +
         r'(?:(?:/{})+)?'.format(NAME_COMPONENT_PATTERN))))
 
+# The regexes above document the reference grammar, but the nested quantifiers
+# in NAME_COMPONENT_PATTERN can make them backtrack exponentially on long,
+# malformed names. References are parsed by the functions below instead, which
+# accept exactly the same language in a single pass over the input.
+_LOWER_ALNUM = frozenset('abcdefghijklmnopqrstuvwxyz0123456789')
+_ALPHA = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+_ALNUM = _ALPHA | frozenset('0123456789')
+_HOSTNAME_CHARS = _ALNUM | frozenset('-')
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+_DIGEST_SEPARATORS = frozenset('-_+.')
+_MAX_TAG_LENGTH = 128
+
+
+class ImageReference(namedtuple(
+        'ImageReference', ['hostname', 'components', 'tag', 'digest'])):
+    """
+    The parts of an image reference. The hostname, tag and digest are None if
+    they are not present. The components are the list of path components of
+    the name after the hostname.
+    """
+    __slots__ = ()
+
+    @property
+    def name(self):
+        """ The full image name (<hostname>/<components>). """
+        path = '/'.join(self.components)
+        if self.hostname is None:
+            return path
+        return '/'.join((self.hostname, path))
+
+
+def _is_name_component(component):
+    # component = [a-z0-9]+ ((\.|_|__|-+) [a-z0-9]+)*
+    length = len(component)
+    i = 0
+    while i < length:
+        if component[i] in _LOWER_ALNUM:
+            i += 1
+            continue
+        # A separator must be between two alphanumeric characters
+        start = i
+        while i < length and component[i] not in _LOWER_ALNUM:
+            i += 1
+        separator = component[start:i]
+        if start == 0 or i == length:
+            return False
+        if separator not in ('.', '_', '__') and separator.strip('-'):
+            return False
+    return length > 0
+
+
+def _is_hostname(hostname):
+    # hostname = component ('.' component)* (':' [0-9]+)?
+    hostname, colon, port = hostname.partition(':')
+    if colon and not (port and all('0' <= c <= '9' for c in port)):
+        return False
+    for component in hostname.split('.'):
+        if not component or component[0] == '-' or component[-1] == '-':
+            return False
+        if not all(c in _HOSTNAME_CHARS for c in component):
+            return False
+    return True
+
+
+def _is_word_char(char):
+    # The characters matched by '\w'
+    return char.isalnum() or char == '_'
+
+
+def _is_tag(tag):
+    # tag = \w [\w.-]{0,127}
+    if not tag or len(tag) > _MAX_TAG_LENGTH or not _is_word_char(tag[0]):
+        return False
+    return all(_is_word_char(c) or c in '.-' for c in tag[1:])
+
+
+def _is_digest(digest):
+    # digest = [A-Za-z][A-Za-z0-9]* ([-_+.] [A-Za-z][A-Za-z0-9]*)* ':'
+    #          [0-9a-fA-F]{32,}
+    algorithm, colon, encoded = digest.partition(':')
+    if not colon or len(encoded) < 32:
+        return False
+    if not all(c in _HEX_DIGITS for c in encoded):
+        return False
+
+    expect_alpha = True
+    for char in algorithm:
+        if expect_alpha:
+            if char not in _ALPHA:
+                return False
+            expect_alpha = False
+        elif char in _DIGEST_SEPARATORS:
+            expect_alpha = True
+        elif char not in _ALNUM:
+            return False
+    return not expect_alpha
+
+
+def _parse_name(name):
+    """
+    Parse an image name into its hostname and path components, or return
+    None if the name is invalid. If the first component could be either a
+    hostname or a path component, it is treated as a hostname.
+    """
+    first, slash, rest = name.partition('/')
+    if slash and _is_hostname(first):
+        components = rest.split('/')
+        if all(_is_name_component(c) for c in components):
+            return first, components
+
+    components = name.split('/')
+    if all(_is_name_component(c) for c in components):
+        return None, components
+    return None
+
+
+def parse_name(name):
+    """
+    Parse an image name (without a tag or digest) into its parts.
+
+    :rtype: ImageReference
+    """
+    parsed = _parse_name(name)
+    if parsed is None:
+        raise ValueError("Unable to parse image name '%s'" % (name,))
+
+    return ImageReference(parsed[0], parsed[1], None, None)
+
+
+def parse_reference(reference):
+    """
+    Parse an image reference (<name>[:<tag>][@<digest>]) into its parts.
+
+    :rtype: ImageReference
+    """
+    error = ValueError("Unable to parse image tag '%s'" % (reference,))
+
+    name, at, digest = reference.partition('@')
+    if not at:
+        digest = None
+    elif not _is_digest(digest):
+        raise error
+
+    # A ':' can only be part of the name if it is in the hostname, which must
+    # be followed by a '/'
+    tag = None
+    colon = name.rfind(':')
+    if colon != -1 and '/' not in name[colon + 1:]:
+        name, tag = name[:colon], name[colon + 1:]
+        if not _is_tag(tag):
+            raise error
+
+    parsed = _parse_name(name)
+    if parsed is None:
+        raise error
+
+    return ImageReference(parsed[0], parsed[1], tag, digest)
+
 
 def split_image_tag(image_tag):
     """
     Split the given image tag into its name and tag parts (<name>[:<tag>]).
     """
-    match = REFERENCE_REGEX.match(image_tag)
-    if match is None:
-        raise ValueError("Unable to parse image tag '%s'" % (image_tag,))
-
-    return match.group(1), match.group(2)
+    reference = parse_reference(image_tag)
+    return reference.name, reference.tag
 
 
 def join_image_tag(image, tag):
@@ -66,28 +254,39 @@ def join_image_tag(image, tag):
     return ':'.join((image, tag))
 
 
+def _tag_registry(image_tag):
+    """ Get the address of the registry an image tag refers to. """
+    from docker_ci_deploy.registry import split_repository
+
+    return split_repository(split_image_tag(image_tag)[0])[0]
+
+
 class RegistryTagger(object):
-    def __init__(self, registry):
-        self._registry = registry
+    def __init__(self, registry, *registries):
+        self._registries = (registry,) + registries
 
     def generate_tag(self, image):
+        """ Generate the image name for the (first) registry. """
+        return self._generate_tag(image, self._registries[0])
+
+    def generate_tags(self, image):
+        """ Generate the image names for every registry. """
+        return [self._generate_tag(image, registry)
+                for registry in self._registries]
+
+    def _generate_tag(self, image, registry):
         # First try just append the registry without stripping the old
-        joined_image = _join_image_registry(image, self._registry)
+        joined_image = _join_image_registry(image, registry)
         # Check if that worked and return if so
-        if ANCHORED_NAME_REGEX.match(joined_image) is not None:
+        if _parse_name(joined_image) is not None:
             return joined_image
 
         # If the tag was invalid, try strip the existing registry first
-        return _join_image_registry(
-            _strip_image_registry(image), self._registry)
+        return _join_image_registry(_strip_image_registry(image), registry)
 
 
 def _strip_image_registry(image):
-    match = ANCHORED_NAME_REGEX.match(image)
-    if match is None:
-        raise ValueError("Unable to parse image name '%s'" % (image,))
-
-    return match.group(2)
+    return '/'.join(parse_name(image).components)
 
 
 def _join_image_registry(image, registry):
@@ -214,9 +413,9 @@ def generate_tags(image_tag, tags=None, version_tagger=None,
 
     # Replace registry in image name
     if registry_tagger is not None:
-        registry_image = registry_tagger.generate_tag(image)
+        registry_images = registry_tagger.generate_tags(image)
     else:
-        registry_image = image
+        registry_images = [image]
 
     # Add the version to any tags
     new_tags = tags if tags is not None else [tag]
@@ -228,60 +427,641 @@ def generate_tags(image_tag, tags=None, version_tagger=None,
         version_tags = new_tags
 
     # Finally, rejoin the image name and tag parts
-    return [join_image_tag(registry_image, v_t) for v_t in version_tags]
+    return [join_image_tag(registry_image, v_t)
+            for registry_image in registry_images for v_t in version_tags]
+
+
+# An image to deploy, with the tags and version to deploy it with. The tags
+# and version are None if they should come from the command-line options.
+ImageSpec = namedtuple('ImageSpec', ['image', 'tags', 'version'])
+
+
+def _is_string(value):
+    return isinstance(value, type(u''))
+
+
+def _parse_image_spec(line):
+    if not line.startswith('{'):
+        return ImageSpec(line, None, None)
+
+    import json
+
+    spec = json.loads(line)
+    if not isinstance(spec, dict) or not _is_string(spec.get('image')):
+        raise ValueError('expected an object with an "image" string')
+    tags = spec.get('tags')
+    if tags is not None and (
+            not isinstance(tags, list) or not all(map(_is_string, tags))):
+        raise ValueError('expected "tags" to be a list of strings')
+    version = spec.get('version')
+    if version is not None and not _is_string(version):
+        raise ValueError('expected "version" to be a string')
+    return ImageSpec(spec['image'], tags, version)
+
+
+def read_image_specs(lines):
+    """
+    Read the images to deploy, one per line. Each line is either an image tag
+    or a JSON object with an ``image`` tag and, optionally, a list of ``tags``
+    and a ``version`` to use instead of the command-line options, e.g.
+    ``{"image": "foo:alpine", "tags": ["alpine"], "version": "1.2.3"}``.
+    Blank lines and lines starting with ``#`` are ignored.
+
+    :param lines: An iterable of lines, such as a file.
+    :return:
+        An iterator of ImageSpec tuples, which reads lines only as they are
+        needed.
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            yield _parse_image_spec(line)
+        except ValueError as e:
+            raise ValueError(
+                'Invalid image on line %d: %s' % (number, e))
+
+
+def _chunks(iterable, size):
+    """ Split an iterable into lists of at most ``size`` items. """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Held while writing to stdout/stderr so that the output of commands run
+# concurrently is not interleaved.
+_output_lock = threading.RLock()
+
+
+# The most output from a command that is kept in memory for error reporting
+OUTPUT_TAIL_SIZE = 64 * 1024
+
+# Matches the digest of the pushed manifest in the output of ``docker push``
+PUSH_DIGEST_REGEX = _LazyRegex(br'digest: (sha256:[0-9a-f]{64}) size: ')
+# Matches the sizes of the pushed manifests in the output of a push
+PUSH_MANIFEST_BYTES_REGEX = _LazyRegex(
+    br'digest: sha256:[0-9a-f]{64} size: (\d+)')
+# Matches the sizes of the uploaded blobs in the output of a push. Only the
+# archive backend reports them; Docker doesn't say how much it uploaded.
+PUSH_BYTES_REGEX = _LazyRegex(br': Pushed (\d+) bytes')
+# Matches what was done with each layer in the output of a push
+PUSH_LAYER_REGEX = _LazyRegex(
+    br'^\w+: (Pushed|Layer already exists|Mounted from)', re.MULTILINE)
+PUSH_LAYER_STATUSES = {
+    b'Pushed': 'pushed',
+    b'Layer already exists': 'exists',
+    b'Mounted from': 'mounted',
+}
+
+
+@contextmanager
+def _nothing():
+    yield {}
+
+
+def _binary_stream(stream):
+    if sys.version_info >= (3,):
+        return stream.buffer
+    # Python 2 doesn't have a .buffer on stdout/stderr for writing binary data.
+    # Writing bytes will only work for unicode in Python 2.7.1+ due to
+    # https://bugs.python.org/issue4947.
+    return stream
+
+
+def _write_output(stream, data):
+    with _output_lock:
+        # Flush any text already written to the stream first
+        stream.flush()
+        binary_stream = _binary_stream(stream)
+        binary_stream.write(data)
+        binary_stream.flush()
+
+
+def _write_spool(spool, stream):
+    """ Write the contents of a temporary file to a stream, then close it. """
+    with _output_lock:
+        spool.seek(0)
+        for chunk in iter(partial(spool.read, 65536), b''):
+            _write_output(stream, chunk)
+    spool.close()
 
 
-def cmd(args):
+def _write_lines(lines, stream=False):
+    """
+    Write lines of progress output to stdout, either as each line is produced
+    or, if ``stream`` is False, all at once after the last line so that they
+    aren't interleaved with other output. As with ``cmd()``, the lines are
+    spooled to a temporary file rather than kept in memory.
+
+    :return: The end (up to OUTPUT_TAIL_SIZE bytes) of the lines, as bytes.
+    """
+    import tempfile
+
+    spool = None if stream else tempfile.TemporaryFile()
+    tail = bytearray()
+    try:
+        for line in lines:
+            data = (line + '\n').encode('utf-8')
+            if spool is None:
+                _write_output(sys.stdout, data)
+            else:
+                spool.write(data)
+            tail.extend(data)
+            del tail[:-OUTPUT_TAIL_SIZE]
+    finally:
+        if spool is not None:
+            _write_spool(spool, sys.stdout)
+    return bytes(tail)
+
+
+def _pump(pipe, write, tail=None, chunk_size=8192):
+    """
+    Read from a pipe until EOF, passing each chunk read to ``write`` as soon
+    as it arrives. If ``tail`` is a bytearray, the last OUTPUT_TAIL_SIZE bytes
+    read are kept in it.
+    """
+    fd = pipe.fileno()
+    while True:
+        chunk = os.read(fd, chunk_size)
+        if not chunk:
+            break
+        write(chunk)
+        if tail is not None:
+            tail.extend(chunk)
+            del tail[:-OUTPUT_TAIL_SIZE]
+    pipe.close()
+
+
+def cmd(args, stream=False):
     """
     Execute a command in a subprocess. The process is waited for and the return
     code is checked. If the return code is non-zero, an error is raised. The
     stdout/stderr of the process is written to Python's stdout/stderr.
 
+    Only a bounded amount of the output is kept in memory: either the output
+    is written as the process produces it, or it is spooled to temporary
+    files and written once the process exits.
+
     :param list args:
         List of program arguments to execute.
+    :param bool stream:
+        If True, write the output as the process produces it. If False, write
+        all the output together once the process exits so that it isn't
+        interleaved with the output of other commands.
+    :return:
+        The end (up to OUTPUT_TAIL_SIZE bytes) of the process's stdout.
     """
+    import subprocess
+    import tempfile
+
     process = subprocess.Popen(
         args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    out, err = process.communicate()
-
-    if sys.version_info >= (3,):
-        sys.stdout.buffer.write(out)
-        sys.stderr.buffer.write(err)
+    if stream:
+        sinks = [
+            partial(_write_output, sys.stdout),
+            partial(_write_output, sys.stderr),
+        ]
+        spools = []
     else:
-        # Python 2 doesn't have a .buffer on stdout/stderr for writing binary
-        # data. The below will only work for unicode in Python 2.7.1+ due to
-        # https://bugs.python.org/issue4947.
-        sys.stdout.write(out)
-        sys.stderr.write(err)
+        spools = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+        sinks = [spool.write for spool in spools]
+
+    tail = bytearray()
+    readers = [
+        threading.Thread(
+            target=_pump, args=(process.stdout, sinks[0], tail)),
+        threading.Thread(target=_pump, args=(process.stderr, sinks[1])),
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    for reader in readers:
+        reader.join()
+    retcode = process.wait()
+
+    if spools:
+        with _output_lock:
+            for spool, output in zip(spools, [sys.stdout, sys.stderr]):
+                _write_spool(spool, output)
 
-    retcode = process.poll()
     if retcode:
-        raise subprocess.CalledProcessError(retcode, args, output=out)
+        raise subprocess.CalledProcessError(
+            retcode, args, output=bytes(tail))
+    return bytes(tail)
+
+
+def _format_size(size):
+    """ Format a number of bytes to be read by people. """
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if size < 1000:
+            break
+        size /= 1000.0
+    else:
+        unit = 'TB'
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+
+
+def _parse_size(size):
+    """
+    Parse a number of bytes, in the units used by ``_format_size()``.
+    e.g. '64M' or '64MB' => 64000000
+
+    :return: The number of bytes, or None if it can't be parsed.
+    """
+    match = re.match(r'^(\d+)\s*([kMG]?)B?$', size)
+    if match is None:
+        return None
+    number, unit = match.groups()
+    return int(number) * 1000 ** ' kMG'.index(unit or ' ')
+
+
+class TaskPool(object):
+    """
+    A pool of worker threads that run tasks once all the tasks they depend on
+    have completed. Ready tasks are started in the order they were submitted,
+    except that a task that needs a resource isn't started while the limit of
+    tasks using that resource are running, and later tasks may overtake it.
+    If any task raises an error, no further tasks are started and the first
+    error is re-raised by ``join()`` once the running tasks have completed.
+
+    Several groups of tasks can share the pool's workers and resource limits
+    (see ``group()``), with each group's errors kept to itself. Tasks run in
+    a copy of the context (see ``contextvars``) that they were submitted in.
+    """
+
+    def __init__(self, jobs, max_pending=None, limit=None):
+        """
+        :param int jobs: The maximum number of tasks to run at once.
+        :param int max_pending:
+            The maximum number of submitted tasks that have not yet completed.
+            If this is reached, ``submit()`` blocks until a task completes.
+        :param limit:
+            A function that takes a resource and returns the maximum number of
+            tasks using that resource to run at once, or None for no limit
+            other than ``jobs``.
+        """
+        self._cond = threading.Condition()
+        self._ready = deque()
+        self._pending = 0
+        self._limit = limit
+        # The number of running tasks using each resource, and the tasks that
+        # are ready but waiting for each resource
+        self._running = {}
+        self._blocked = {}
+        self._closed = False
+        self._group = self.group(max_pending)
+
+        self._threads = [
+            threading.Thread(target=self._work, name='worker-%d' % (i + 1,))
+            for i in range(jobs)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def group(self, max_pending=None):
+        """
+        Create a group of tasks that are run by the pool's workers alongside
+        any others. If one of the group's tasks raises an error, no further
+        tasks in the group are started, but other groups carry on.
+
+        :param int max_pending:
+            The maximum number of the group's tasks that have not yet
+            completed, as for the pool.
+        :return: A TaskGroup, with ``submit()`` and ``join()`` methods.
+        """
+        return TaskGroup(self, max_pending)
+
+    def submit(self, func, after=(), resource=None):
+        """
+        Submit a task to be run.
+
+        :param func: The function to call. It is called with no arguments.
+        :param after:
+            Tasks (as returned by previous calls to ``submit()``) that must
+            complete before this task is started.
+        :param resource:
+            The resource the task uses, such as a registry address, or None.
+        :return: The task, to use as a dependency for later tasks.
+        """
+        return self._group.submit(func, after, resource)
+
+    def join(self):
+        """
+        Wait for all submitted tasks to complete and stop the worker threads.
+        Re-raise the first error raised by a task, if any.
+        """
+        try:
+            self._group.join()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            for thread in self._threads:
+                thread.join()
+
+    def _submit(self, task, after):
+        with self._cond:
+            group = task.group
+            while (group.max_pending is not None and not group.errors and
+                   group.pending >= group.max_pending):
+                self._cond.wait()
+            if group.errors:
+                raise group.errors[0]
+            self._pending += 1
+            group.pending += 1
+            for dependency in after:
+                if not dependency.done:
+                    task.waiting += 1
+                    dependency.dependents.append(task)
+            if not task.waiting:
+                self._ready.append(task)
+                # Groups being joined wait on the same condition, so waking
+                # just one thread might not wake a worker
+                self._cond.notify_all()
+        return task
+
+    def _acquire(self, resource):
+        if resource is None or self._limit is None:
+            return True
+        limit = self._limit(resource)
+        running = self._running.get(resource, 0)
+        if limit is not None and running >= limit:
+            return False
+        self._running[resource] = running + 1
+        return True
+
+    def _release(self, resource):
+        if resource not in self._running:
+            return
+        self._running[resource] -= 1
+        blocked = self._blocked.get(resource)
+        while blocked:
+            task = blocked.popleft()
+            if task.group.errors:
+                # Skip the rest of a group once one of its tasks fails, and
+                # let the next waiting task have the resource instead
+                self._finish(task)
+                continue
+            # Let the next task waiting for the resource go first
+            self._ready.appendleft(task)
+            break
+
+    def _finish(self, task):
+        # Called with the condition held, once a task has run or been skipped
+        task.done = True
+        self._pending -= 1
+        task.group.pending -= 1
+        for dependent in task.dependents:
+            dependent.waiting -= 1
+            if not dependent.waiting:
+                self._ready.append(dependent)
+        self._cond.notify_all()
+
+    def _next_task(self):
+        with self._cond:
+            while True:
+                while self._ready:
+                    task = self._ready.popleft()
+                    if task.group.errors:
+                        # Skip the rest of a group once one of its tasks fails
+                        self._finish(task)
+                    elif self._acquire(task.resource):
+                        return task
+                    else:
+                        self._blocked.setdefault(
+                            task.resource, deque()).append(task)
+                if self._closed and not self._pending:
+                    return None
+                self._cond.wait()
+
+    def _work(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+
+            try:
+                if task.context is None:
+                    task.func()
+                else:
+                    task.context.run(task.func)
+            except BaseException as e:
+                with self._cond:
+                    task.group.errors.append(e)
+                    self._release(task.resource)
+                    self._finish(task)
+            else:
+                with self._cond:
+                    self._release(task.resource)
+                    self._finish(task)
+
+
+class TaskGroup(object):
+    """ A group of tasks run by a TaskPool. See ``TaskPool.group()``. """
+
+    def __init__(self, pool, max_pending=None):
+        self.pool = pool
+        self.max_pending = max_pending
+        self.pending = 0
+        self.errors = []
+
+    def submit(self, func, after=(), resource=None):
+        """ Submit a task to be run. See ``TaskPool.submit()``. """
+        return self.pool._submit(_Task(func, self, resource), after)
+
+    def join(self):
+        """
+        Wait for all the group's tasks to complete, and re-raise the first
+        error raised by one of them, if any.
+        """
+        with self.pool._cond:
+            while self.pending:
+                self.pool._cond.wait()
+        if self.errors:
+            raise self.errors[0]
+
+
+class _Task(object):
+    def __init__(self, func, group, resource=None):
+        self.func = func
+        self.group = group
+        self.resource = resource
+        # Run the task with the context variables of the code that submitted
+        # it, e.g. where the deploy daemon sends the output of each request
+        self.context = None if copy_context is None else copy_context()
+        self.done = False
+        self.waiting = 0
+        self.dependents = []
+
+
+def run_concurrently(funcs, jobs):
+    """
+    Call each of the given functions on a pool of worker threads. Functions
+    are started in the order given. If any function raises an error, no
+    further functions are started, the functions already running are waited
+    for, and the first error is re-raised.
+
+    :param funcs: An iterable of functions that take no arguments.
+    :param int jobs: The maximum number of functions to run at once.
+    """
+    pool = TaskPool(jobs)
+    try:
+        for func in funcs:
+            pool.submit(func)
+    finally:
+        pool.join()
 
 
 class DockerCiDeployRunner(object):
 
     logger = print
-
-    def __init__(self, executable='docker', dry_run=False, verbose=False):
+    # The number of images that are read from the tag map at a time when
+    # images are tagged and pushed serially, and the number of tasks that may
+    # be queued ahead of the running ones when they're not
+    batch_size = 256
+
+    def __init__(self, executable='docker', dry_run=False, verbose=False,
+                 jobs=1, push_once=False, insecure_registries=(),
+                 registry_jobs=None, cache=None, metrics=None, tracer=None,
+                 profiler=None, pool=None, in_flight=None):
+        """
+        :param jobs:
+            The maximum number of Docker commands to run at once. Commands are
+            run one after another if this is 1.
+        :param registry_jobs:
+            A dict mapping registry addresses to the maximum number of
+            commands pushing to that registry to run at once, when ``jobs`` is
+            greater than 1. The limit for any other registries is set by the
+            None key.
+        :param push_once:
+            If True, only push one tag per image to each repository and add
+            the remaining tags using the registry API.
+        :param insecure_registries:
+            Registries to access using plain HTTP rather than HTTPS.
+        :param cache:
+            A DeployCache to record pushes in, or None. See ``skip_cached()``.
+        :param metrics:
+            A DeployMetrics to record how long Docker commands take, and what
+            is pushed and skipped, in, or None.
+        :param tracer:
+            A TraceRecorder to record a timeline of the Docker commands and
+            registry requests in, or None.
+        :param profiler:
+            A profiler to take a snapshot with once images have been tagged
+            and once they have been pushed, or None.
+        :param pool:
+            A TaskPool shared with other runners to run the Docker commands
+            on, or None. If given, its limits are used rather than ``jobs``
+            and ``registry_jobs``.
+        :param in_flight:
+            An InFlight (see ``docker_ci_deploy.daemon``) shared with other
+            runners, so that pushes of the same tags from the same images
+            that are running at the same time are only done once, or None.
+        """
         self.executable = executable
         self.dry_run = dry_run
         self.verbose = verbose
+        self.jobs = jobs
+        self.push_once = push_once
+        self.insecure_registries = insecure_registries
+        self.registry_jobs = registry_jobs or {}
+        self.cache = cache
+        self.metrics = metrics
+        self.tracer = tracer
+        self.profiler = profiler
+        self.pool = pool
+        self.in_flight = in_flight
+
+        # The IDs of the source images, for recording pushes in the cache
+        self._image_ids = {}
+        # The (image ID or source image, source image) each target tag is
+        # pushed from, for finding conflicting targets with --dedupe. Unlike
+        # the images, these are kept for the whole deploy, so that conflicts
+        # between images in different batches are found too.
+        self._targets = {}
+        # The image each scheduled image must be pushed after, and the set of
+        # images that others must be pushed after
+        self._bases = {}
+        self._base_images = set()
+
+        # The registry clients share one pool of connections, and the
+        # credentials for each registry are only looked up once
+        self._registry_clients = {}
+        self._registry_pool = None
+        self._credential_store = None
+        self._registry_clients_lock = threading.Lock()
 
     def _log(self, *args, **kwargs):
         if kwargs.get('if_verbose', False) and not self.verbose:
             return
-        self.logger(*args)
+        with _output_lock:
+            self.logger(*args)
 
-    def _docker_cmd(self, args):
-        args = [self.executable] + args
+    @property
+    def _stream_output(self):
+        # Only stream output when it can't be interleaved with other commands'
+        return self.jobs == 1 and self.pool is None
 
+    def _docker_cmd(self, args):
         if self.dry_run:
-            self._log(*args)
-            return
+            self._log(*([self.executable] + args))
+            return None
+
+        if self.metrics is None and self.tracer is None:
+            return self._run_docker(args)
+        registry = _tag_registry(args[1]) if args[0] == 'push' else None
+        with self.measure(args[0], registry, name='docker ' + args[0],
+                          args=args[1:]):
+            return self._run_docker(args)
+
+    @contextmanager
+    def measure(self, operation, registry=None, name=None, **details):
+        """
+        Measure how long the code in a ``with`` block takes for the metrics,
+        and record it as a span in the trace.
 
-        cmd(args)
+        :param operation: The name of the operation, e.g. 'push'.
+        :param registry: The registry the operation talks to, if any.
+        :param name: The name of the span, if not the operation's name.
+        :param details: Details to record with the span.
+        """
+        if registry is not None:
+            details['registry'] = registry
+        measured = (_nothing() if self.metrics is None
+                    else self.metrics.measure(operation, registry))
+        span = (_nothing() if self.tracer is None
+                else self.tracer.span(name or operation, 'deploy', **details))
+        with measured, span as span_details:
+            yield span_details
+
+    def _record_push_output(self, registry, output):
+        if self.metrics is None or not output:
+            return
+        self.metrics.add('manifest_bytes', sum(
+            int(size) for size in PUSH_MANIFEST_BYTES_REGEX.findall(output)),
+            registry=registry)
+        pushed = PUSH_BYTES_REGEX.findall(output)
+        if pushed:
+            self.metrics.add('pushed_bytes', sum(map(int, pushed)),
+                             registry=registry)
+        for status in PUSH_LAYER_REGEX.findall(output):
+            self.metrics.add('layers', registry=registry,
+                             status=PUSH_LAYER_STATUSES[status])
+
+    def _run_docker(self, args):
+        """
+        Run a Docker CLI command, given its arguments, and return (the end of)
+        its output.
+        """
+        return cmd([self.executable] + args, stream=self._stream_output)
 
     def docker_tag(self, in_tag, out_tag):
         """ Run ``docker tag`` with the given tags. """
@@ -295,12 +1075,664 @@ class DockerCiDeployRunner(object):
         self._docker_cmd(['tag', in_tag, out_tag])
 
     def docker_push(self, tag):
-        """ Run ``docker push`` with the given tag. """
+        """
+        Run ``docker push`` with the given tag.
+
+        :return:
+            The digest of the pushed manifest, or None if it is unknown.
+        """
         self._log('Pushing tag "%s"...' % (tag,), if_verbose=True)
-        self._docker_cmd(['push', tag])
+        output = self._docker_cmd(['push', tag])
+        self._record_push_output(_tag_registry(tag), output)
+        digests = PUSH_DIGEST_REGEX.findall(output or b'')
+        return digests[-1].decode('ascii') if digests else None
+
+    def inspect_images(self, images, force=False):
+        """
+        Get low-level information about local images, as returned by
+        ``docker image inspect``, using a single Docker command.
+
+        :param force:
+            If True, inspect the images even if this is a dry run. Inspecting
+            images doesn't change anything.
+        :return:
+            A dict mapping each image to its information, or None if this is a
+            dry run.
+        """
+        images = list(OrderedDict.fromkeys(images))
+        if self.dry_run and not force:
+            self._log(*([self.executable, 'image', 'inspect'] + images))
+            return None
+        if not images:
+            return {}
+        with self.measure('inspect', name='docker image inspect',
+                          images=len(images)):
+            return dict(zip(images, self._inspect_images(images)))
+
+    def _inspect_images(self, images):
+        import json
+        import subprocess
+
+        out = subprocess.check_output(
+            [self.executable, 'image', 'inspect'] + images)
+        return json.loads(out.decode('utf-8'))
+
+    def credential_store(self):
+        """ Get the (shared) store of the credentials for registries. """
+        from docker_ci_deploy.registry import CredentialStore
+
+        with self._registry_clients_lock:
+            if self._credential_store is None:
+                self._credential_store = CredentialStore()
+            return self._credential_store
+
+    def registry_client(self, domain):
+        """ Get the (shared) registry API client for a registry. """
+        from docker_ci_deploy.registry import ConnectionPool, RegistryClient
+
+        credential_store = self.credential_store()
+        with self._registry_clients_lock:
+            client = self._registry_clients.get(domain)
+            if client is None:
+                if self._registry_pool is None:
+                    # No more connections to each registry than can be used
+                    # at once
+                    self._registry_pool = ConnectionPool(
+                        self.jobs, tracer=self.tracer)
+                client = RegistryClient(
+                    domain, secure=domain not in self.insecure_registries,
+                    pool=self._registry_pool,
+                    credential_store=credential_store)
+                self._registry_clients[domain] = client
+            return client
+
+    def registry_tag(self, in_tag, out_tags):
+        """
+        Add tags to an image that has already been pushed, by uploading its
+        manifest again under each of the new tags using the registry API.
+
+        :param in_tag: The image tag that has been pushed.
+        :param out_tags:
+            The new image tags. These must be in the same repository as
+            ``in_tag``.
+        :return: The digest of the manifest, or None if this is a dry run.
+        """
+        from docker_ci_deploy.registry import split_repository
+
+        for out_tag in out_tags:
+            message = 'Tagging "%s" as "%s" in the registry...' % (
+                in_tag, out_tag)
+            self._log(message, if_verbose=not self.dry_run)
+        if self.dry_run:
+            return None
+
+        name, tag = split_image_tag(in_tag)
+        domain, repository = split_repository(name)
+        with self.measure('registry-tag', domain, name='registry tag',
+                          tags=[in_tag] + list(out_tags)):
+            client = self.registry_client(domain)
+            media_type, manifest, digest = client.get_manifest(
+                repository, tag or 'latest')
+            for out_tag in out_tags:
+                client.put_manifest(
+                    repository, split_image_tag(out_tag)[1] or 'latest',
+                    media_type, manifest)
+            return digest
+
+    def dedupe(self, tag_map, details=None):
+        """
+        Merge the target tags of source images that are the same image, so
+        that each image is tagged and pushed as one, and check that no target
+        tag would be pushed from two different images. If the details are
+        given, target tags already seen in earlier calls are checked too, and
+        are not pushed again from the same image.
+
+        :param tag_map:
+            A list of (source image tag, list of target image tags) pairs.
+        :param details:
+            The source images' information, as returned by
+            ``inspect_images()``, to find the source images with the same ID.
+            If None, only identical source image tags in this call are
+            merged, and as different source image tags may still be the same
+            image, a target tag is pushed from each of them rather than
+            raising an error. Target tags aren't remembered between calls, so
+            that memory use doesn't grow with the number of images.
+        :return: The tag map with each image's target tags merged.
+        :raises ValueError:
+            If the details are given and a target tag would be pushed from
+            two different images.
+        """
+        merged = OrderedDict()
+        seen = self._targets if details is not None else {}
+        for image, push_tags in tag_map:
+            key = image if details is None else details[image]['Id']
+            if key not in merged:
+                merged[key] = (image, [])
+            elif merged[key][0] != image:
+                self._log('Pushing "%s" as "%s", which is the same image' % (
+                    image, merged[key][0]), if_verbose=True)
+
+            targets = merged[key][1]
+            for push_tag in push_tags:
+                pushed = seen.get(push_tag)
+                if pushed is None:
+                    seen[push_tag] = (key, image)
+                    targets.append(push_tag)
+                elif pushed[0] != key:
+                    if details is not None:
+                        raise ValueError(
+                            'The tag "%s" would be pushed from both "%s" and '
+                            '"%s"' % (push_tag, pushed[1], image))
+                    targets.append(push_tag)
+        return list(merged.values())
+
+    def schedule(self, tag_map, details):
+        """
+        Order the images to make the most of the layers they share. Each image
+        that shares layers with an earlier image is pushed after its "base":
+        the image it shares the most leading layers with. The base's layers
+        are then already in the registry, rather than being uploaded by both
+        images at once. Images that more work depends on, measured by image
+        size, are started first so that the largest ones don't finish last.
+
+        :param tag_map:
+            A list of (source image tag, list of target image tags) pairs.
+        :param details:
+            The source images' information, as returned by
+            ``inspect_images()``.
+        :return: The tag map in the order to push the images in.
+        """
+        push_tags = OrderedDict(tag_map)
+        layers = dict((image, details[image].get('RootFS', {}).get('Layers')
+                       or []) for image in push_tags)
+        sizes = dict((image, details[image].get('Size') or 0)
+                     for image in push_tags)
+
+        # Images are added to a trie of their layers in order of their number
+        # of layers, so that base images are added before the images built on
+        # them. Each node is an (image that added it, children) pair.
+        order = sorted(push_tags, key=lambda image: len(layers[image]))
+        trie = {}
+        bases = {}
+        for image in order:
+            children = trie
+            for layer in layers[image]:
+                node = children.get(layer)
+                if node is None:
+                    node = children[layer] = (image, {})
+                elif node[0] != image:
+                    bases[image] = node[0]
+                children = node[1]
+
+        # Each image's priority is the size of the layers it adds to its base
+        # plus the priority of the largest image pushed after it
+        priorities = dict((image, 0) for image in order)
+        for image in reversed(order):
+            base = bases.get(image)
+            size = sizes[image] - (sizes[base] if base is not None else 0)
+            priorities[image] += max(size, 0)
+            if base is not None:
+                priorities[base] = max(priorities[base], priorities[image])
+
+        # Ties are broken by the order images were added to the trie, so that
+        # bases always come before the images built on them
+        position = dict((image, i) for i, image in enumerate(order))
+        scheduled = sorted(
+            push_tags, key=lambda image: (-priorities[image], position[image]))
+
+        for i, image in enumerate(scheduled, 1):
+            base = bases.get(image)
+            message = '%d. "%s" (%s, %d layers)' % (
+                i, image, _format_size(sizes[image]), len(layers[image]))
+            if base is not None:
+                message += ' after "%s"' % (base,)
+                self._bases[image] = base
+                self._base_images.add(base)
+            self._log('Push plan: ' + message, if_verbose=not self.dry_run)
+        return [(image, push_tags[image]) for image in scheduled]
+
+    def skip_unchanged(self, tag_map, details=None):
+        """
+        Remove the target tags that the registry already has for exactly the
+        same image as the local source image. Each repository's tags are
+        listed once, and only the tags that may be unchanged are looked up.
+
+        :param tag_map:
+            A list of (source image tag, list of target image tags) pairs.
+        :param details:
+            The source images' information, as returned by
+            ``inspect_images()``. The images are inspected if this is None.
+        :return: The tag map with unchanged target tags removed.
+        """
+        from docker_ci_deploy.registry import split_repository
+
+        if details is None:
+            details = self.inspect_images([image for image, _ in tag_map])
+        if details is None:
+            return tag_map
+
+        # The registry can only have the same image in a repository if the
+        # image has been pushed to (or pulled from) that repository before
+        candidates = OrderedDict()
+        for image, push_tags in tag_map:
+            repo_digests = details[image].get('RepoDigests') or []
+            for push_tag in push_tags:
+                name, tag = split_image_tag(push_tag)
+                if any(d.startswith(name + '@') for d in repo_digests):
+                    candidates.setdefault(
+                        split_repository(name), set()).add(tag or 'latest')
+
+        remote_digests = {}
+
+        def fetch_digests(domain, repository, tags):
+            client = self.registry_client(domain)
+            for tag in sorted(tags.intersection(client.list_tags(repository))):
+                remote_digests[(domain, repository, tag)] = (
+                    client.manifest_digest(repository, tag))
+
+        run_concurrently([
+            partial(fetch_digests, domain, repository, tags)
+            for (domain, repository), tags in candidates.items()], self.jobs)
+
+        changed_tag_map = []
+        for image, push_tags in tag_map:
+            repo_digests = details[image].get('RepoDigests') or []
+            changed_tags = []
+            for push_tag in push_tags:
+                name, tag = split_image_tag(push_tag)
+                remote_digest = remote_digests.get(
+                    split_repository(name) + (tag or 'latest',))
+                if (remote_digest is not None and
+                        '%s@%s' % (name, remote_digest) in repo_digests):
+                    self._log('Not pushing unchanged tag "%s"' % (push_tag,),
+                              if_verbose=True)
+                    self._count_skip('unchanged')
+                else:
+                    changed_tags.append(push_tag)
+            changed_tag_map.append((image, changed_tags))
+        return changed_tag_map
+
+    def skip_cached(self, tag_map, details=None):
+        """
+        Remove the target tags that the cache records were recently pushed
+        from the same local images, and remember the images' IDs so that
+        their pushes can be recorded in the cache.
+
+        :param tag_map:
+            A list of (source image tag, list of target image tags) pairs.
+        :param details:
+            The source images' information, as returned by
+            ``inspect_images()``. The images are inspected if this is None.
+        :return: The tag map with the cached target tags removed.
+        """
+        if details is None:
+            details = self.inspect_images([image for image, _ in tag_map])
+        if details is None:
+            return tag_map
+
+        self.remember_image_ids(details)
+        uncached_tag_map = []
+        for image, push_tags in tag_map:
+            image_id = details[image]['Id']
+            uncached_tags = []
+            for push_tag in push_tags:
+                if self.cache.is_pushed(push_tag, image_id):
+                    self._log('Not pushing tag "%s", which was already pushed'
+                              % (push_tag,), if_verbose=True)
+                    self._count_skip('cached')
+                else:
+                    uncached_tags.append(push_tag)
+            uncached_tag_map.append((image, uncached_tags))
+        return uncached_tag_map
+
+    def remember_image_ids(self, details):
+        """
+        Remember the IDs of inspected images, which identify what their tags
+        are pushed from when recording pushes in the cache and sharing them
+        with other runners.
+
+        :param details:
+            The images' information, as returned by ``inspect_images()``.
+        """
+        for image, image_details in details.items():
+            self._image_ids[image] = image_details['Id']
+
+    def _count_skip(self, reason):
+        if self.metrics is not None:
+            self.metrics.add('skipped_tags', reason=reason)
+
+    def _record(self, image, tags, digest):
+        image_id = self._image_ids.get(image)
+        if self.cache is None or image_id is None or self.dry_run:
+            return
+        for tag in tags:
+            self.cache.record(tag, image_id, digest)
+
+    def _push_and_record(self, image, tag):
+        digest = self._share_in_flight(
+            image, ('push', tag), partial(self.docker_push, tag), tag)
+        self._record(image, [tag], digest)
+
+    def _registry_tag_and_record(self, image, in_tag, out_tags):
+        digest = self._share_in_flight(
+            image, ('registry-tag', in_tag, tuple(out_tags)),
+            partial(self.registry_tag, in_tag, out_tags), ', '.join(out_tags))
+        self._record(image, out_tags, digest)
+
+    def _in_flight_key(self, *key):
+        """
+        Make a key that identifies an operation, so that it can be shared
+        with the same operation by other runners: one with the same Docker
+        client, on the same images.
+        """
+        return (type(self).__name__, self.executable) + key
+
+    def _share_in_flight(self, image, key, func, tags):
+        """
+        Call a function that pushes tags from an image, unless another runner
+        is already doing the same, in which case wait for it to finish and
+        return its result (or raise its error) instead.
+        """
+        # Without the image's ID, the same tag could be from another image
+        image_id = self._image_ids.get(image)
+        if self.in_flight is None or self.dry_run or image_id is None:
+            return func()
+        return self.in_flight.run(
+            self._in_flight_key(image, image_id, *key),
+            func, waiting=partial(
+                self._log, 'Waiting for "%s" to be pushed by another '
+                'deploy...' % (tags,)))
+
+    def _plan(self, image, push_tags):
+        """
+        Plan the work needed to deploy one image as a list of phases. Each
+        phase is a list of (function, registry) pairs, where the functions can
+        be called in any order once all the functions in the previous phase
+        have completed, and the registry is the address of the registry the
+        function pushes to, or None if it doesn't push anything.
+        """
+        from docker_ci_deploy.registry import split_repository
+
+        repositories = [split_repository(split_image_tag(t)[0])
+                        for t in push_tags]
+        if not self.push_once:
+            return [
+                [(partial(self.docker_tag, image, t), None)
+                 for t in push_tags],
+                [(partial(self._push_and_record, image, t), domain)
+                 for t, (domain, _) in zip(push_tags, repositories)],
+            ]
+
+        repository_tags = OrderedDict()
+        for push_tag, repository in zip(push_tags, repositories):
+            repository_tags.setdefault(repository, []).append(push_tag)
+
+        return [
+            [(partial(self.docker_tag, image, tags[0]), None)
+             for tags in repository_tags.values()],
+            [(partial(self._push_and_record, image, tags[0]), domain)
+             for (domain, _), tags in repository_tags.items()],
+            [(partial(self._registry_tag_and_record,
+                      image, tags[0], tags[1:]), domain)
+             for (domain, _), tags in repository_tags.items()
+             if len(tags) > 1],
+        ]
+
+    def close(self):
+        """ Release any resources held by the runner. """
+        if self._registry_pool is None:
+            return
+        stats = self._registry_pool.stats()
+        if self.metrics is not None:
+            self.metrics.add('retries', stats['retries'])
+        self._log('Registry connections: %d requests, %d opened, %d reused'
+                  % (stats['requests'], stats['connections'],
+                     stats['reused']), if_verbose=True)
+        self._registry_pool.close()
+
+    def _registry_limit(self, registry):
+        return self.registry_jobs.get(registry, self.registry_jobs.get(None))
+
+    def deploy(self, tag_map):
+        """
+        Tag and push images. If ``jobs`` is 1, the images are deployed in
+        batches of ``batch_size`` images, and all the images in a batch are
+        tagged before any of their tags are pushed. Otherwise, the tags for
+        each image are pushed as soon as all the tags for that image have been
+        created, while other images may still be being tagged, and pushes to
+        each registry are limited by ``registry_jobs``. That's also how the
+        images are deployed if there is a shared ``pool``.
+
+        :param tag_map:
+            An iterable of (source image tag, list of target image tags) pairs.
+            It is consumed as the images are deployed, so it can be a
+            generator that reads the images from a file.
+        """
+        plans = ((image, self._plan(image, push_tags))
+                 for image, push_tags in tag_map)
+        if self.jobs > 1 or self.pool is not None:
+            self._deploy_pipelined(plans)
+            # Tagging and pushing overlap, so there's no point in between
+            self._checkpoint('pushed')
+            return
+
+        for batch in _chunks(plans, self.batch_size):
+            for i, phases in enumerate(zip(*[phases for _, phases in batch])):
+                for phase in phases:
+                    for func, _ in phase:
+                        func()
+                if i == 0:
+                    self._checkpoint('tagged')
+            self._checkpoint('pushed')
+
+    def _checkpoint(self, label):
+        if self.profiler is not None:
+            self.profiler.checkpoint(label)
+
+    def _deploy_pipelined(self, plans):
+        if self.pool is not None:
+            pool = self.pool.group(max_pending=self.jobs + self.batch_size)
+        else:
+            pool = TaskPool(self.jobs, max_pending=self.jobs + self.batch_size,
+                            limit=self._registry_limit)
+        # The last tasks for each image that other images are scheduled after
+        base_tasks = {}
+        try:
+            for image, phases in plans:
+                base = self._bases.pop(image, None)
+                previous = []
+                for i, phase in enumerate(phases):
+                    after = previous
+                    if i == 1 and base is not None:
+                        # Tag straight away, but push after the base image
+                        after = previous + base_tasks.get(base, [])
+                    previous = [
+                        pool.submit(func, after=after, resource=registry)
+                        for func, registry in phase] or after
+                if image in self._base_images:
+                    base_tasks[image] = previous
+        finally:
+            pool.join()
+
+
+class DockerEngineRunner(DockerCiDeployRunner):
+    """
+    A runner that uses the Docker Engine API to talk to the Docker daemon
+    directly, rather than running the Docker CLI for each command.
+    """
+
+    def __init__(self, socket_path=None, **kwargs):
+        """
+        :param socket_path:
+            The path to the Docker daemon's unix socket. If None, the default
+            socket is used.
+        """
+        super(DockerEngineRunner, self).__init__(**kwargs)
+        from docker_ci_deploy.engine import DockerEngineClient
+        self.engine = DockerEngineClient(socket_path)
+
+    def _run_docker(self, args):
+        command = args[0]
+        if command == 'tag':
+            name, tag = split_image_tag(args[2])
+            self.engine.tag(args[1], name, tag)
+            return b''
+        elif command == 'push':
+            return self._push(args[1])
+        else:
+            raise ValueError('Unsupported Docker command: %s' % (command,))
+
+    def _inspect_images(self, images):
+        return [self.engine.inspect_image(image) for image in images]
+
+    def _in_flight_key(self, *key):
+        return super(DockerEngineRunner, self)._in_flight_key(
+            self.engine.socket_path, *key)
+
+    def close(self):
+        super(DockerEngineRunner, self).close()
+        self.engine.close()
+
+    def _push(self, image_tag):
+        from docker_ci_deploy.engine import (
+            encode_registry_auth, format_progress)
+        from docker_ci_deploy.registry import split_repository
+
+        name, tag = split_image_tag(image_tag)
+        domain, _ = split_repository(name)
+        registry_auth = encode_registry_auth(
+            self.credential_store().get(domain), domain)
+
+        lines = (format_progress(message)
+                 for message in self.engine.push(name, tag, registry_auth))
+        return _write_lines((line for line in lines if line is not None),
+                            stream=self._stream_output)
+
+
+class ArchiveRunner(DockerCiDeployRunner):
+    """
+    A runner that pushes images from ``docker save`` archives or OCI image
+    layouts straight to their registries using the registry API, without a
+    Docker daemon. Tagging an image only records which image the new tag
+    refers to.
+    """
+
+    def __init__(self, archives, chunk_size=None, compress=False,
+                 compress_chunk_size=None, **kwargs):
+        """
+        :param archives:
+            The paths to the archives or image layout directories to push
+            images from.
+        :param chunk_size:
+            The number of bytes to upload in each request, or None to upload
+            each blob in one request. Chunked uploads are recorded in the
+            cache, if there is one, so that they can be resumed.
+        :param compress:
+            If True, compress uncompressed layers with gzip before pushing
+            them.
+        :param compress_chunk_size:
+            The number of bytes of each layer to compress at a time, in
+            parallel. The compressed layers, and so the image digests, only
+            change if this does.
+        """
+        super(ArchiveRunner, self).__init__(**kwargs)
+        from docker_ci_deploy.archive import BlobTracker, open_archive
+        self.archives = [open_archive(path) for path in archives]
+        # The same images are only pushed the same way from the same
+        # archives with the same compression
+        self._archive_key = (
+            tuple(os.path.abspath(path) for path in archives),
+            compress_chunk_size if compress else False)
+        self.chunk_size = chunk_size
+        # Shared by all the pushes so that no blob is uploaded twice
+        self.blobs = BlobTracker()
+        self.compressor = None
+        if compress:
+            from docker_ci_deploy.archive import LayerCompressor
+            from docker_ci_deploy.compress import (
+                DEFAULT_CHUNK_SIZE, ParallelGzip)
+            self.compressor = LayerCompressor(ParallelGzip(
+                chunk_size=compress_chunk_size or DEFAULT_CHUNK_SIZE))
+        # The source image each target tag was tagged from
+        self._sources = {}
+
+    def archive_images(self):
+        """ Get the names of all the images in the archives. """
+        return list(OrderedDict.fromkeys(chain.from_iterable(
+            archive.images for archive in self.archives)))
+
+    def _find_image(self, image):
+        """
+        Find a source image, or the image a tag was tagged from, in the
+        archives.
+
+        :return: An (archive, ArchiveImage) pair.
+        """
+        name, tag = split_image_tag(self._sources.get(image, image))
+        name_tag = join_image_tag(name, tag or 'latest')
+        for archive in self.archives:
+            if name_tag in archive.images:
+                return archive, archive.images[name_tag]
+        raise ValueError('The image "%s" is not in %s' % (
+            name_tag, ', '.join(archive.path for archive in self.archives)))
+
+    def _run_docker(self, args):
+        command = args[0]
+        if command == 'tag':
+            self._find_image(args[1])
+            self._sources[args[2]] = self._sources.get(args[1], args[1])
+            return b''
+        elif command == 'push':
+            return self._push(args[1])
+        else:
+            raise ValueError('Unsupported Docker command: %s' % (command,))
+
+    def _inspect_images(self, images):
+        return [self._find_image(image)[1].details() for image in images]
+
+    def _in_flight_key(self, *key):
+        return super(ArchiveRunner, self)._in_flight_key(
+            self._archive_key, *key)
+
+    def close(self):
+        super(ArchiveRunner, self).close()
+        if self.compressor is not None:
+            self.compressor.close()
 
+    def _push(self, image_tag):
+        from docker_ci_deploy.archive import push_image
+        from docker_ci_deploy.registry import split_repository
+
+        archive, image = self._find_image(image_tag)
+        name, tag = split_image_tag(image_tag)
+        domain, repository = split_repository(name)
+        lines = chain(
+            ['The push refers to repository [%s]' % (name,)],
+            push_image(archive, image, self.registry_client(domain),
+                       repository, tag or 'latest', self.chunk_size,
+                       self.cache, self.compressor, self.blobs))
+        return _write_lines(lines, stream=self._stream_output)
+
+
+def main(raw_args=sys.argv[1:], request=None):
+    """
+    Run the command.
+
+    :param raw_args: The command-line arguments.
+    :param request:
+        The DeployRequest, if the deploy daemon is running the command for a
+        client (see ``docker_ci_deploy.daemon``). Relative paths are resolved
+        against the client's working directory, '-' for ``--from-file`` is
+        the client's stdin, and the Docker commands are run on the daemon's
+        shared pool.
+    """
+    if request is None and raw_args[:1] == ['--serve']:
+        return serve(raw_args[1:])
+
+    # Parsing the arguments includes importing argparse
+    started = time.time()
+    import argparse
 
-def main(raw_args=sys.argv[1:]):
     parser = argparse.ArgumentParser(
         description='Tag and push Docker images to a registry.')
     parser.add_argument('-t', '--tag', nargs='+', action='append',
@@ -323,8 +1755,9 @@ def main(raw_args=sys.argv[1:]):
                         help='Combine with --version-semver to tag the image '
                              "with the major version '0' when that is part of "
                              'the version. This is not done by default.')
-    parser.add_argument('-r', '--registry',
-                        help='Address for the registry to push to')
+    parser.add_argument('-r', '--registry', action='append',
+                        help='Address for the registry to push to. Repeat '
+                             'to push to several registries.')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Verbose logging output')
     parser.add_argument('--dry-run', action='store_true',
@@ -332,7 +1765,127 @@ def main(raw_args=sys.argv[1:]):
     parser.add_argument('--executable', default='docker',
                         help='Path to the Docker client executable (default: '
                              '%(default)s)')
-    parser.add_argument('image', nargs='+',
+    parser.add_argument('--backend', choices=['cli', 'engine', 'archive'],
+                        default='cli',
+                        help="How to talk to Docker: 'cli' runs the Docker "
+                             "client executable, 'engine' uses the Docker "
+                             'Engine API over the Docker daemon\'s socket, '
+                             "'archive' pushes images from the --archive "
+                             'files without Docker (default: %(default)s)')
+    parser.add_argument('--docker-socket', metavar='PATH',
+                        help='Combine with --backend engine to set the path '
+                             "to the Docker daemon's socket (default: from "
+                             'DOCKER_HOST or /var/run/docker.sock)')
+    parser.add_argument('--archive', action='append', default=[],
+                        metavar='PATH',
+                        help='Combine with --backend archive to push images '
+                             'from a docker save archive or an OCI image '
+                             'layout directory. Repeat to read several '
+                             'archives. All the images in the archives are '
+                             'pushed if no images are given.')
+    parser.add_argument('--chunk-size', metavar='SIZE',
+                        help='Combine with --backend archive to upload blobs '
+                             'in chunks of this many bytes, e.g. 64M. With '
+                             '--cache-file, uploads that are interrupted are '
+                             'resumed from the last chunk the next time.')
+    parser.add_argument('--compress', action='store_true',
+                        help='Combine with --backend archive to compress '
+                             'uncompressed layers with gzip before pushing '
+                             'them, using all the CPUs')
+    parser.add_argument('--compress-chunk-size', metavar='SIZE',
+                        help='Combine with --compress to set how much of a '
+                             'layer is compressed at a time. Compressed '
+                             'layers are the same on every run with the same '
+                             'chunk size. (default: 1M)')
+    parser.add_argument('--push-once', action='store_true',
+                        help='Push only one tag per image to each repository '
+                             'and add the other tags using the registry API')
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help='Compare the images with the tags already in '
+                             'the registry and only tag and push the tags '
+                             'that have changed')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Find the images that are the same image, by '
+                             'ID, and tag and push them together. Exit with '
+                             'an error if a tag would be pushed from two '
+                             'different images. Images are checked in '
+                             'batches of %d as they are read, so by the '
+                             'time a conflict is found, the images in '
+                             'earlier batches may already have been pushed.'
+                             % (DockerCiDeployRunner.batch_size,))
+    parser.add_argument('--layer-schedule', action='store_true',
+                        help="Order the pushes using the images' layers and "
+                             'sizes, so that images that share layers are '
+                             'pushed one after another and the largest '
+                             'images start first. The plan is printed in a '
+                             'dry run.')
+    parser.add_argument('--cache-file', metavar='PATH',
+                        default=os.environ.get('DOCKER_CI_DEPLOY_CACHE_FILE'),
+                        help='Record the tags that are pushed, and the image '
+                             'IDs they are pushed from, in this file, and '
+                             'skip pushing tags again from the same images '
+                             '(default: from DOCKER_CI_DEPLOY_CACHE_FILE)')
+    parser.add_argument('--cache-max-age', type=int, metavar='SECONDS',
+                        help='Combine with --cache-file to push tags again '
+                             'if they were last pushed longer ago than this '
+                             '(default: 86400)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Combine with --cache-file to push all tags, '
+                             'while still recording them in the cache')
+    parser.add_argument('--metrics-file', action='append', default=[],
+                        metavar='PATH',
+                        help='Write metrics for the run to this file when it '
+                             'finishes: a JSON summary if the path ends in '
+                             '.json, or otherwise the Prometheus text format. '
+                             'Repeat to write both.')
+    parser.add_argument('--trace-file', metavar='PATH',
+                        help='Write a timeline of the run to this file in the '
+                             'Chrome trace event format, to open in Perfetto '
+                             'or chrome://tracing')
+    parser.add_argument('--profile', choices=['cpu', 'mem'],
+                        help="Profile the run: 'cpu' writes cProfile stats, "
+                             "'mem' writes the lines that allocated the most "
+                             'memory after generating tags, tagging and '
+                             'pushing, using tracemalloc')
+    parser.add_argument('--profile-file', metavar='PATH',
+                        help='Combine with --profile to set the file to '
+                             'write the profile to (default: '
+                             'docker-ci-deploy.cpu.prof or '
+                             'docker-ci-deploy.mem.txt)')
+    parser.add_argument('--insecure-registry', action='append', default=[],
+                        metavar='REGISTRY',
+                        help='Access the given registry over plain HTTP when '
+                             'using the registry API')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Maximum number of Docker commands to run in '
+                             'parallel (default: %(default)s)')
+    parser.add_argument('--registry-jobs', action='append', default=[],
+                        metavar='[REGISTRY=]JOBS',
+                        help='Combine with --jobs to limit the number of '
+                             'pushes to run in parallel to the given '
+                             'registry, or to each registry if no registry '
+                             'is given')
+    parser.add_argument('-f', '--from-file',
+                        type=(argparse.FileType('r') if request is None
+                              else request.open),
+                        metavar='FILE',
+                        help="Read more images to push from a file, or '-' "
+                             'to read them from stdin. Each line is either '
+                             'an image tag or a JSON object with an "image" '
+                             'tag and optional "tags" and "version" for that '
+                             'image. Images are pushed as they are read.')
+    parser.add_argument('--daemon', metavar='ADDRESS',
+                        default=os.environ.get('DOCKER_CI_DEPLOY_DAEMON'),
+                        help="Send the command to a deploy daemon (see "
+                             "'%(prog)s --serve --help') at this address, "
+                             'e.g. unix:///run/docker-ci-deploy.sock or '
+                             'http://127.0.0.1:8700, and wait for it to '
+                             'finish (default: from DOCKER_CI_DEPLOY_DAEMON)')
+    parser.add_argument('--serve', action='store_true',
+                        help="Run a deploy daemon instead of deploying (see "
+                             "'%(prog)s --serve --help'). This must be the "
+                             'first argument.')
+    parser.add_argument('image', nargs='*',
                         help='Tags (full image names) to push')
 
     _add_deprecated_arguments(parser)
@@ -340,9 +1893,42 @@ def main(raw_args=sys.argv[1:]):
     args = parser.parse_args(raw_args)
     _resolve_deprecated_arguments(args)
 
-    if args.version_latest and not args.version:
+    if args.serve:
+        parser.error("the --serve option can't be sent to a deploy daemon"
+                     if request is not None else
+                     'the --serve option must be the first argument')
+    if args.archive and args.backend != 'archive':
+        parser.error('the --archive option requires --backend archive')
+    if args.backend == 'archive' and not args.archive:
+        parser.error('the --backend archive option requires --archive')
+    if args.chunk_size is not None and args.backend != 'archive':
+        parser.error('the --chunk-size option requires --backend archive')
+    chunk_size = None
+    if args.chunk_size is not None:
+        chunk_size = _parse_size(args.chunk_size)
+        if not chunk_size:
+            parser.error('the --chunk-size option must be a number of bytes '
+                         "of at least 1, optionally followed by 'k', 'M' or "
+                         "'G'")
+    if args.compress and args.backend != 'archive':
+        parser.error('the --compress option requires --backend archive')
+    if args.compress_chunk_size is not None and not args.compress:
+        parser.error('the --compress-chunk-size option requires --compress')
+    compress_chunk_size = None
+    if args.compress_chunk_size is not None:
+        compress_chunk_size = _parse_size(args.compress_chunk_size)
+        if not compress_chunk_size:
+            parser.error('the --compress-chunk-size option must be a number '
+                         "of bytes of at least 1, optionally followed by "
+                         "'k', 'M' or 'G'")
+    if not args.image and args.from_file is None and not args.archive:
+        parser.error('at least one image or the --from-file option is '
+                     'required')
+
+    # Versions may be given for each image in the file
+    if args.version_latest and not (args.version or args.from_file):
         parser.error('the --version-latest option requires --version')
-    if args.version_semver and not args.version:
+    if args.version_semver and not (args.version or args.from_file):
         parser.error('the --version-semver option requires --version')
 
     if args.semver_precision and not args.version_semver:
@@ -350,43 +1936,292 @@ def main(raw_args=sys.argv[1:]):
     if args.semver_zero and not args.version_semver:
         parser.error('the --semver-zero option requires --version-semver')
 
-    runner = DockerCiDeployRunner(dry_run=args.dry_run, verbose=args.verbose,
-                                  executable=args.executable)
+    if args.jobs < 1:
+        parser.error('the --jobs option must be at least 1')
+
+    registry_jobs = _parse_registry_jobs(parser, args.registry_jobs)
+
+    if args.docker_socket and args.backend != 'engine':
+        parser.error('the --docker-socket option requires --backend engine')
+
+    if args.profile_file and not args.profile:
+        parser.error('the --profile-file option requires --profile')
+    # The daemon runs the commands it is sent rather than forwarding them,
+    # even if DOCKER_CI_DEPLOY_DAEMON is set in its environment
+    daemon = args.daemon if request is None else None
+    if args.profile and (daemon or request is not None):
+        parser.error("the --profile option can't be used with a deploy "
+                     'daemon')
+
+    if daemon:
+        from docker_ci_deploy.daemon import forward
+        stdin = None
+        if args.from_file is sys.stdin:
+            stdin = sys.stdin.read()
+        elif args.from_file is not None:
+            args.from_file.close()
+        status = forward(daemon, raw_args, os.getcwd(), stdin)
+        if status:
+            sys.exit(status)
+        return
+
+    if request is not None:
+        request.resolve_paths(args, _PATH_OPTIONS)
+        # Like a shell, only look the executable up on the PATH if it's a name
+        if os.sep in args.executable:
+            args.executable = request.path(args.executable)
+
+    if args.profile:
+        from docker_ci_deploy.profiling import make_profiler
+        try:
+            profiler = make_profiler(args.profile, args.profile_file)
+        except ValueError as e:
+            parser.error(str(e))
+        profiler.start()
+    else:
+        profiler = None
+
+    if args.cache_file:
+        from docker_ci_deploy.cache import DEFAULT_MAX_AGE, DeployCache
+        max_age = 0 if args.no_cache else args.cache_max_age
+        cache = DeployCache(
+            args.cache_file,
+            DEFAULT_MAX_AGE if max_age is None else max_age)
+    else:
+        cache = None
+
+    if args.metrics_file:
+        from docker_ci_deploy.metrics import DeployMetrics
+        metrics = DeployMetrics()
+    else:
+        metrics = None
+
+    if args.trace_file:
+        from docker_ci_deploy.trace import TraceRecorder
+        tracer = TraceRecorder()
+        tracer.record('parse arguments', 'deploy', started, time.time())
+    else:
+        tracer = None
+
+    runner_kwargs = dict(
+        dry_run=args.dry_run, verbose=args.verbose,
+        executable=args.executable, jobs=args.jobs, push_once=args.push_once,
+        insecure_registries=args.insecure_registry,
+        registry_jobs=registry_jobs, cache=cache, metrics=metrics,
+        tracer=tracer, profiler=profiler)
+    if request is not None:
+        runner_kwargs.update(pool=request.pool, in_flight=request.in_flight)
+    if args.backend == 'engine':
+        runner = DockerEngineRunner(
+            socket_path=args.docker_socket, **runner_kwargs)
+    elif args.backend == 'archive':
+        runner = ArchiveRunner(
+            args.archive, chunk_size=chunk_size, compress=args.compress,
+            compress_chunk_size=compress_chunk_size, **runner_kwargs)
+        if not args.image and args.from_file is None:
+            args.image = runner.archive_images()
+    else:
+        runner = DockerCiDeployRunner(**runner_kwargs)
     # Flatten list of tags
-    tags = chain.from_iterable(args.tag) if args.tag is not None else None
+    tags = (list(chain.from_iterable(args.tag))
+            if args.tag is not None else None)
 
-    if args.version:
+    def make_version_tagger(version):
+        if not version:
+            return None
         if args.version_semver:
             versions = generate_semver_versions(
-                args.version, args.semver_precision or 1, args.semver_zero)
+                version, args.semver_precision or 1, args.semver_zero)
         else:
-            versions = [args.version]
-        version_tagger = VersionTagger(versions, args.version_latest)
-    else:
-        version_tagger = None
+            versions = [version]
+        return VersionTagger(versions, args.version_latest)
+    version_tagger = make_version_tagger(args.version)
 
     if args.registry:
-        registry_tagger = RegistryTagger(args.registry)
+        registry_tagger = RegistryTagger(*args.registry)
     else:
         registry_tagger = None
 
-    # Generate tags
-    def tagger(image):
-        return generate_tags(image, tags, version_tagger, registry_tagger)
-    tag_map = [(image, tagger(image)) for image in args.image]
+    specs = [ImageSpec(image, None, None) for image in args.image]
+    if args.from_file is not None:
+        specs = chain(specs, read_image_specs(args.from_file))
+
+    # Generate tags lazily, so that images are pushed as they are read
+    def generate_image_tags(image, image_tags, version):
+        return generate_tags(
+            image, image_tags if image_tags is not None else tags,
+            version_tagger if version is None
+            else make_version_tagger(version),
+            registry_tagger)
+
+    def generate_tag_map():
+        versioned = bool(args.version)
+        for image, image_tags, version in specs:
+            with runner.measure('generate-tags', name='generate_tags',
+                                image=image):
+                push_tags = generate_image_tags(image, image_tags, version)
+            versioned = versioned or bool(version)
+            yield image, push_tags
+        if profiler is not None:
+            profiler.checkpoint('tags generated')
+        # The file is read as the images are pushed, so this can only be
+        # found out at the end
+        version_options = [option for option, used in [
+            ('--version-latest', args.version_latest),
+            ('--version-semver', args.version_semver)] if used]
+        if version_options and not versioned:
+            with _output_lock:
+                print('WARNING: the %s option%s had no effect, as neither '
+                      '--version nor a "version" for any image was given'
+                      % (' and '.join(version_options),
+                         's' if len(version_options) > 1 else ''),
+                      file=sys.stderr)
+    tag_map = generate_tag_map()
+
+    # Images are checked in batches, and inspected with one Docker command
+    # for each batch, without holding all the images in memory. A deploy
+    # daemon only shares pushes between deploys of images with the same IDs.
+    inspect = (args.dedupe or args.skip_unchanged or args.layer_schedule or
+               cache is not None or (request is not None and not args.dry_run))
+
+    def prepare_batch(batch):
+        details = None
+        if inspect:
+            # The images are only inspected in a dry run to print the plan
+            details = runner.inspect_images(
+                [image for image, _ in batch], force=args.layer_schedule)
+        try:
+            batch = runner.dedupe(batch, details if args.dedupe else None)
+        except ValueError as e:
+            parser.error(str(e))
+        if details is None:
+            return batch
+        runner.remember_image_ids(details)
+        if cache is not None and not args.dry_run:
+            batch = runner.skip_cached(batch, details)
+        if args.skip_unchanged and not args.dry_run:
+            batch = runner.skip_unchanged(batch, details)
+        if args.layer_schedule:
+            batch = runner.schedule(batch, details)
+        return batch
+
+    def read_batches(tag_map):
+        # The file is read as the images are pushed, so a bad line can only
+        # be reported once it is reached
+        try:
+            for batch in _chunks(tag_map, runner.batch_size):
+                yield batch
+        except ValueError as e:
+            parser.error(str(e))
+    tag_map = chain.from_iterable(
+        prepare_batch(batch) for batch in read_batches(tag_map))
+
+    succeeded = False
+    try:
+        with (_nothing() if tracer is None
+              else tracer.span('deploy', 'deploy')):
+            runner.deploy(tag_map)
+        succeeded = True
+    finally:
+        runner.close()
+        # Record whatever was pushed, even if something else failed
+        if cache is not None:
+            cache.save()
+        if metrics is not None:
+            metrics.finish(succeeded)
+            for path in args.metrics_file:
+                metrics.write(path)
+        if tracer is not None:
+            tracer.write(args.trace_file)
+        if profiler is not None:
+            profiler.stop()
+
+
+# The options that are paths to files, or lists of paths
+_PATH_OPTIONS = [
+    'archive', 'cache_file', 'docker_socket', 'metrics_file', 'trace_file']
+
+
+def _parse_registry_jobs(parser, values):
+    """
+    Parse the values of the --registry-jobs option.
+
+    :return:
+        A dict mapping registry addresses to the maximum number of pushes to
+        run at once, with the limit for any other registries under None.
+    """
+    registry_jobs = {}
+    for value in values:
+        registry, _, jobs = value.rpartition('=')
+        if not jobs.isdigit() or int(jobs) < 1:
+            parser.error("the --registry-jobs option must be a number of at "
+                         "least 1, optionally preceded by 'REGISTRY='")
+        registry_jobs[registry or None] = int(jobs)
+    return registry_jobs
+
 
-    # Tag images
-    for image, push_tags in tag_map:
-        for push_tag in push_tags:
-            runner.docker_tag(image, push_tag)
+def serve(raw_args):
+    """
+    Run the deploy daemon until it is interrupted. See
+    ``docker_ci_deploy.daemon``.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='%s --serve' % (os.path.basename(sys.argv[0]),),
+        description='Run a daemon that deploys images for docker-ci-deploy '
+                    'commands run with --daemon, sharing one pool of '
+                    'workers between them. Pushes of the same tags from the '
+                    'same images that are requested at the same time are '
+                    'only done once.')
+    parser.add_argument('-l', '--listen', metavar='ADDRESS',
+                        default=os.environ.get('DOCKER_CI_DEPLOY_DAEMON'),
+                        help='The address to listen on, e.g. '
+                             'unix:///run/docker-ci-deploy.sock or '
+                             'http://127.0.0.1:8700. Only loopback hosts '
+                             'can be used, as anything that can connect to '
+                             'it can run commands as this user. (default: '
+                             'from DOCKER_CI_DEPLOY_DAEMON)')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Maximum number of Docker commands to run in '
+                             'parallel, for all the deploys together '
+                             '(default: %(default)s)')
+    parser.add_argument('--registry-jobs', action='append', default=[],
+                        metavar='[REGISTRY=]JOBS',
+                        help='Limit the number of pushes to run in parallel '
+                             'to the given registry, or to each registry if '
+                             'no registry is given, for all the deploys '
+                             'together')
+    args = parser.parse_args(raw_args)
 
-    # Push tags
-    for _, push_tags in tag_map:
-        for push_tag in push_tags:
-            runner.docker_push(push_tag)
+    if sys.version_info < (3, 7):
+        parser.error('the deploy daemon requires Python 3.7 or later')
+    if not args.listen:
+        parser.error('the --listen option is required')
+    if args.jobs < 1:
+        parser.error('the --jobs option must be at least 1')
+    registry_jobs = _parse_registry_jobs(parser, args.registry_jobs)
+
+    from docker_ci_deploy.daemon import DeployServer
+    pool = TaskPool(args.jobs, limit=lambda registry: registry_jobs.get(
+        registry, registry_jobs.get(None)))
+    try:
+        server = DeployServer(args.listen, main, pool)
+    except ValueError as e:
+        parser.error(str(e))
+    print('Listening on %s' % (args.listen,))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        pool.join()
 
 
 def _add_deprecated_arguments(parser):
+    import argparse
+
     parser.add_argument('--tag-version', help=argparse.SUPPRESS,
                         default=argparse.SUPPRESS)
     parser.add_argument('--tag-latest', action='store_true',
@@ -0,0 +1,682 @@
+# -*- coding: utf-8 -*-
+"""
+Reading images from ``docker save`` archives and OCI image layout directories,
+and pushing them straight to a registry without a Docker daemon.
+https://github.com/opencontainers/image-spec/blob/main/image-layout.md
+"""
+import hashlib
+import json
+import mmap
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import partial
+
+OCI_MANIFEST_TYPE = 'application/vnd.oci.image.manifest.v1+json'
+OCI_CONFIG_TYPE = 'application/vnd.oci.image.config.v1+json'
+OCI_LAYER_TYPE = 'application/vnd.oci.image.layer.v1.tar'
+OCI_GZIP_LAYER_TYPE = 'application/vnd.oci.image.layer.v1.tar+gzip'
+# The media types of uncompressed layers, and of the same layers compressed
+GZIP_MEDIA_TYPES = {
+    OCI_LAYER_TYPE: OCI_GZIP_LAYER_TYPE,
+    'application/vnd.docker.image.rootfs.diff.tar':
+        'application/vnd.docker.image.rootfs.diff.tar.gzip',
+}
+INDEX_MEDIA_TYPES = (
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+)
+
+# The annotations that name the images in an OCI image layout's index
+IMAGE_NAME_ANNOTATION = 'io.containerd.image.name'
+REF_NAME_ANNOTATION = 'org.opencontainers.image.ref.name'
+
+GZIP_MAGIC = b'\x1f\x8b'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ArchiveError(Exception):
+    """ An archive isn't a valid image archive. """
+
+
+# A blob in an archive, and the path to its content within the archive
+Blob = namedtuple('Blob', ['digest', 'size', 'media_type', 'path'])
+
+
+def _sha256_digest(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def _blob_path(digest):
+    """
+    Get the path to a blob in an OCI image layout.
+    e.g. 'sha256:abc' => 'blobs/sha256/abc'
+    """
+    algorithm, _, encoded = digest.partition(':')
+    return 'blobs/%s/%s' % (algorithm, encoded)
+
+
+def _short_name(name):
+    """
+    Shorten a fully-qualified image name like the Docker client does.
+    e.g. 'docker.io/library/name:tag' => 'name:tag'
+         'docker.io/user/name:tag' => 'user/name:tag'
+    """
+    if name.startswith('docker.io/'):
+        name = name[len('docker.io/'):]
+        if name.startswith('library/') and '/' not in name[len('library/'):]:
+            name = name[len('library/'):]
+    return name
+
+
+def _view(mapped, start, size):
+    try:
+        return memoryview(mapped)[start:start + size]
+    except TypeError:  # pragma: no cover
+        return buffer(mapped, start, size)  # noqa: F821 (Python 2)
+
+
+@contextmanager
+def _map_file(path, offset, size):
+    if size == 0:
+        yield memoryview(b'')
+        return
+
+    # Mappings must start at a multiple of the allocation granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), offset - start + size,
+                           access=mmap.ACCESS_READ, offset=start)
+    try:
+        view = _view(mapped, offset - start, size)
+        try:
+            yield view
+        finally:
+            if hasattr(view, 'release'):
+                view.release()
+    except BaseException:
+        # Don't let a view that is still exported hide the original error
+        try:
+            mapped.close()
+        except BufferError:
+            pass
+        raise
+    mapped.close()
+
+
+class ArchiveImage(object):
+    """
+    An image in an archive: its manifest, the blobs the manifest refers to,
+    and, if the manifest is an index, the images for each platform.
+    """
+
+    def __init__(self, name, media_type, manifest, image_id, blobs=(),
+                 children=(), config=None, missing=()):
+        """
+        :param name: The image name and tag, or None for a platform image.
+        :param manifest: The raw manifest, exactly as it is to be pushed.
+        :param image_id: The ID Docker would give the image.
+        :param blobs: The Blobs that the manifest refers to.
+        :param children: The ArchiveImages an index refers to.
+        :param config: The parsed image configuration.
+        :param missing: The digests of any blobs not in the archive.
+        """
+        self.name = name
+        self.media_type = media_type
+        self.manifest = manifest
+        self.digest = _sha256_digest(manifest)
+        self.image_id = image_id
+        self.blobs = list(blobs)
+        self.children = list(children)
+        self.config = config
+        self.missing = list(missing)
+
+    def all_blobs(self):
+        """ Get the blobs of this image and its children, without repeats. """
+        blobs = OrderedDict()
+        for child in self.children:
+            blobs.update((blob.digest, blob) for blob in child.all_blobs())
+        blobs.update((blob.digest, blob) for blob in self.blobs)
+        return list(blobs.values())
+
+    def all_missing(self):
+        missing = list(self.missing)
+        for child in self.children:
+            missing.extend(child.all_missing())
+        return missing
+
+    def details(self):
+        """
+        Get information about the image in the same form as
+        ``docker image inspect``.
+        """
+        config = self.config
+        if config is None and self.children:
+            config = self.children[0].config
+        return {
+            'Id': self.image_id,
+            'RepoTags': [self.name],
+            'RepoDigests': [],
+            'RootFS': {
+                'Type': 'layers',
+                'Layers': ((config or {}).get('rootfs') or {}).get(
+                    'diff_ids') or [],
+            },
+            'Size': sum(blob.size for blob in self.all_blobs()),
+        }
+
+
+class _Archive(object):
+    """
+    The images in an archive, which is read as either an OCI image layout, if
+    it has an ``index.json``, or otherwise in the ``docker save`` format.
+    Subclasses implement access to the files in the archive.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Images in an OCI image layout may only be named by their tag
+        self.default_name = os.path.basename(
+            os.path.normpath(path)).split('.')[0].lower()
+        self.images = OrderedDict()
+        if self._exists('index.json'):
+            self._load_oci()
+        elif self._exists('manifest.json'):
+            self._load_docker()
+        else:
+            raise ArchiveError(
+                '%s is not a docker save archive or an OCI image layout' %
+                (path,))
+
+    def _exists(self, name):
+        raise NotImplementedError()
+
+    def _read(self, name):
+        """ Read a (small) file from the archive. """
+        raise NotImplementedError()
+
+    def _region(self, name):
+        """
+        Find the content of a file in the archive.
+
+        :return: A (file path, offset, size) tuple.
+        """
+        raise NotImplementedError()
+
+    def _read_json(self, name):
+        try:
+            return json.loads(self._read(name).decode('utf-8'))
+        except ValueError as e:
+            raise ArchiveError('Invalid %s in %s: %s' % (name, self.path, e))
+
+    def open_blob(self, blob):
+        """
+        Map a blob's content into memory, so that it can be sent or hashed
+        without being read into memory all at once.
+
+        :return:
+            A context manager for a read-only memoryview of the content.
+        """
+        path, offset, size = self._region(blob.path)
+        if size != blob.size:
+            raise ArchiveError('The size of %s in %s is %d, not %d' % (
+                blob.digest, self.path, size, blob.size))
+        return _map_file(path, offset, size)
+
+    def _hash_blob(self, path, size):
+        blob = Blob(None, size, None, path)
+        sha256 = hashlib.sha256()
+        with self.open_blob(blob) as data:
+            for start in range(0, size, HASH_CHUNK_SIZE):
+                sha256.update(data[start:start + HASH_CHUNK_SIZE])
+        return 'sha256:' + sha256.hexdigest()
+
+    def _load_docker(self):
+        for entry in self._read_json('manifest.json'):
+            config_data = self._read(entry['Config'])
+            config = json.loads(config_data.decode('utf-8'))
+            diff_ids = (config.get('rootfs') or {}).get('diff_ids') or []
+            if len(diff_ids) != len(entry['Layers']):
+                raise ArchiveError(
+                    'The layers of %s in %s do not match its configuration' %
+                    (entry['Config'], self.path))
+
+            config_blob = Blob(_sha256_digest(config_data), len(config_data),
+                               OCI_CONFIG_TYPE, entry['Config'])
+            layers = [self._docker_layer(path, diff_id)
+                      for path, diff_id in zip(entry['Layers'], diff_ids)]
+            manifest = _dump_manifest({
+                'schemaVersion': 2,
+                'mediaType': OCI_MANIFEST_TYPE,
+                'config': self._descriptor(config_blob),
+                'layers': [self._descriptor(layer) for layer in layers],
+            })
+
+            for name in entry.get('RepoTags') or []:
+                self.images[name] = ArchiveImage(
+                    name, OCI_MANIFEST_TYPE, manifest, config_blob.digest,
+                    [config_blob] + layers, config=config)
+
+    def _docker_layer(self, path, diff_id):
+        _, _, size = self._region(path)
+        blob = Blob(diff_id, size, OCI_LAYER_TYPE, path)
+        with self.open_blob(blob) as data:
+            compressed = bytes(data[:2]) == GZIP_MAGIC
+        if not compressed:
+            # The diff ID is the digest of the uncompressed layer
+            return blob
+        return Blob(self._hash_blob(path, size), size, OCI_GZIP_LAYER_TYPE,
+                    path)
+
+    @staticmethod
+    def _descriptor(blob):
+        return {'mediaType': blob.media_type, 'size': blob.size,
+                'digest': blob.digest}
+
+    def _load_oci(self):
+        for descriptor in self._read_json('index.json').get('manifests', []):
+            name = self._image_name(descriptor.get('annotations') or {})
+            if name is not None:
+                self.images[name] = self._load_manifest(descriptor, name)
+
+    def _image_name(self, annotations):
+        name = annotations.get(IMAGE_NAME_ANNOTATION)
+        if name is None:
+            ref = annotations.get(REF_NAME_ANNOTATION)
+            if ref is None:
+                return None
+            if ':' in ref or '/' in ref:
+                name = ref
+            else:
+                # The reference name is just a tag
+                name = '%s:%s' % (self.default_name, ref)
+        return _short_name(name)
+
+    def _load_manifest(self, descriptor, name=None):
+        digest = descriptor['digest']
+        path = _blob_path(digest)
+        if not self._exists(path):
+            # e.g. docker save only saves the local platform of an image
+            return ArchiveImage(name, descriptor.get('mediaType'), b'',
+                                digest, missing=[digest])
+
+        data = self._read(path)
+        if _sha256_digest(data) != digest:
+            raise ArchiveError('The content of %s in %s does not match its '
+                               'digest' % (digest, self.path))
+        manifest = json.loads(data.decode('utf-8'))
+        media_type = descriptor.get('mediaType') or manifest.get('mediaType')
+
+        if media_type in INDEX_MEDIA_TYPES:
+            children = [self._load_manifest(child)
+                        for child in manifest.get('manifests', [])]
+            return ArchiveImage(name, media_type, data, digest,
+                                children=children)
+
+        blobs = []
+        missing = []
+        for blob in [manifest['config']] + manifest.get('layers', []):
+            blob_path = _blob_path(blob['digest'])
+            if self._exists(blob_path):
+                blobs.append(Blob(blob['digest'], blob['size'],
+                                  blob.get('mediaType'), blob_path))
+            else:
+                missing.append(blob['digest'])
+        config = None
+        if not missing:
+            config = json.loads(
+                self._read(blobs[0].path).decode('utf-8'))
+        return ArchiveImage(name, media_type, data,
+                            manifest['config']['digest'], blobs,
+                            config=config, missing=missing)
+
+
+class DirectoryArchive(_Archive):
+    """ An OCI image layout, or an extracted archive, in a directory. """
+
+    def _file(self, name):
+        return os.path.join(self.path, *name.split('/'))
+
+    def _exists(self, name):
+        return os.path.isfile(self._file(name))
+
+    def _read(self, name):
+        with open(self._file(name), 'rb') as f:
+            return f.read()
+
+    def _region(self, name):
+        path = self._file(name)
+        return path, 0, os.path.getsize(path)
+
+
+class TarArchive(_Archive):
+    """
+    An uncompressed tar archive, as written by ``docker save``. Compressed
+    archives aren't supported because their content can't be mapped into
+    memory.
+    """
+
+    def __init__(self, path):
+        # Only the members' headers are read, to find where their content is
+        try:
+            with tarfile.open(path, 'r:') as tar:
+                self._members = dict(
+                    (posixpath.normpath(member.name), member)
+                    for member in tar)
+        except tarfile.TarError as e:
+            raise ArchiveError(
+                '%s is not an uncompressed tar archive: %s' % (path, e))
+        super(TarArchive, self).__init__(path)
+
+    def _member(self, name):
+        name = posixpath.normpath(name)
+        # Follow links, but not round in circles
+        for _ in range(len(self._members)):
+            member = self._members.get(name)
+            if member is None or not (member.issym() or member.islnk()):
+                return member
+            if member.issym():
+                name = posixpath.normpath(posixpath.join(
+                    posixpath.dirname(name), member.linkname))
+            else:
+                name = posixpath.normpath(member.linkname)
+        return None
+
+    def _exists(self, name):
+        member = self._member(name)
+        return member is not None and member.isfile()
+
+    def _read(self, name):
+        path, offset, size = self._region(name)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def _region(self, name):
+        member = self._member(name)
+        if member is None or not member.isfile():
+            raise ArchiveError('There is no %s in %s' % (name, self.path))
+        return self.path, member.offset_data, member.size
+
+
+class LayerCompressor(object):
+    """
+    Compresses the uncompressed layers of images with gzip before they are
+    pushed, rewriting the images' manifests to refer to the compressed
+    layers. Each layer is compressed once per run, however many images and
+    repositories it is pushed to, into a temporary file.
+    """
+
+    def __init__(self, compressor):
+        """
+        :param compressor: The ParallelGzip to compress layers with.
+        """
+        self.compressor = compressor
+        self.directory = tempfile.mkdtemp(prefix='docker-ci-deploy-')
+        # The compressed blob for each uncompressed blob's digest, the lock
+        # for compressing each one, and the files compressed blobs are in
+        self._blobs = {}
+        self._locks = {}
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def compress_image(self, archive, image):
+        """
+        Get an image with its uncompressed layers compressed. The image is
+        returned unchanged if it has no uncompressed layers.
+        """
+        if image.all_missing():
+            # The image can't be pushed anyway
+            return image
+
+        if image.children:
+            children = [self.compress_image(archive, child)
+                        for child in image.children]
+            digests = dict((old.digest, new) for old, new in zip(
+                image.children, children) if new is not old)
+            if not digests:
+                return image
+            index = json.loads(image.manifest.decode('utf-8'))
+            for descriptor in index.get('manifests', []):
+                new = digests.get(descriptor['digest'])
+                if new is not None:
+                    descriptor.update(
+                        digest=new.digest, size=len(new.manifest))
+            return ArchiveImage(
+                image.name, image.media_type, _dump_manifest(index),
+                image.image_id, children=children)
+
+        compressed = dict(
+            (blob.digest, self._compress_blob(archive, blob))
+            for blob in image.blobs if blob.media_type in GZIP_MEDIA_TYPES)
+        if not compressed:
+            return image
+        manifest = json.loads(image.manifest.decode('utf-8'))
+        for descriptor in manifest.get('layers', []):
+            blob = compressed.get(descriptor['digest'])
+            if blob is not None:
+                descriptor.update(digest=blob.digest, size=blob.size,
+                                  mediaType=blob.media_type)
+        return ArchiveImage(
+            image.name, image.media_type, _dump_manifest(manifest),
+            image.image_id, [compressed.get(blob.digest, blob)
+                             for blob in image.blobs],
+            config=image.config)
+
+    def _compress_blob(self, archive, blob):
+        with self._lock:
+            lock = self._locks.setdefault(blob.digest, threading.Lock())
+        # Other threads pushing the same layer wait for it to be compressed
+        with lock:
+            compressed = self._blobs.get(blob.digest)
+            if compressed is not None:
+                return compressed
+
+            fd, path = tempfile.mkstemp(dir=self.directory, suffix='.gz')
+            with os.fdopen(fd, 'wb') as f:
+                with archive.open_blob(blob) as data:
+                    digest, size = self.compressor.compress(data, f.write)
+            compressed = Blob(
+                digest, size, GZIP_MEDIA_TYPES[blob.media_type], path)
+            with self._lock:
+                self._files[digest] = path
+                self._blobs[blob.digest] = compressed
+            return compressed
+
+    def open_blob(self, archive, blob):
+        """
+        Map a blob's content into memory, from the compressed layers or else
+        from the archive.
+        """
+        with self._lock:
+            path = self._files.get(blob.digest)
+        if path is None:
+            return archive.open_blob(blob)
+        return _map_file(path, 0, blob.size)
+
+    def close(self):
+        """ Remove the compressed layers. """
+        self.compressor.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _dump_manifest(manifest):
+    return json.dumps(manifest, sort_keys=True).encode('utf-8')
+
+
+def open_archive(path):
+    """
+    Read the images in a ``docker save`` archive or an OCI image layout
+    directory, or a tar archive of one.
+
+    :return: An archive whose ``images`` are keyed by image name and tag.
+    :raises ArchiveError: If the path isn't a supported archive.
+    """
+    if os.path.isdir(path):
+        return DirectoryArchive(path)
+    return TarArchive(path)
+
+
+class BlobTracker(object):
+    """
+    Tracks the blobs in each registry during a run so that no blob is
+    uploaded twice: once a blob is in one repository, it is mounted into
+    others in the same registry, and while a blob is being uploaded to one
+    repository, pushes of it to others wait for that upload to finish.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # The first repository each (registry, digest) was found in, and an
+        # Event for each upload in progress
+        self._repositories = {}
+        self._uploads = {}
+
+    def claim(self, domain, digest):
+        """
+        Find a repository in a registry that has a blob, waiting for any
+        upload of the blob in progress to finish first.
+
+        :return:
+            The repository, or None if there isn't one, in which case the
+            caller must call ``release()`` once it has pushed the blob or
+            failed to.
+        """
+        key = (domain, digest)
+        while True:
+            with self._lock:
+                repository = self._repositories.get(key)
+                if repository is not None:
+                    return repository
+                event = self._uploads.get(key)
+                if event is None:
+                    self._uploads[key] = threading.Event()
+                    return None
+            event.wait()
+
+    def add(self, domain, digest, repository):
+        """ Record that a repository has a blob. """
+        with self._lock:
+            self._repositories.setdefault((domain, digest), repository)
+
+    def release(self, domain, digest):
+        """ Let others push a blob that was claimed. """
+        with self._lock:
+            event = self._uploads.pop((domain, digest), None)
+        if event is not None:
+            event.set()
+
+
+def push_image(archive, image, client, repository, reference,
+               chunk_size=None, uploads=None, compressor=None, blobs=None):
+    """
+    Push an image from an archive to a repository: the blobs that the
+    repository doesn't already have, then the manifests for each platform if
+    the image is an index, then the image's manifest.
+
+    :param client: The RegistryClient for the registry to push to.
+    :param reference: The tag to push the image as.
+    :param chunk_size:
+        The number of bytes to upload in each request, or None to upload each
+        blob in one request.
+    :param uploads:
+        A DeployCache to record the progress of chunked uploads in, so that
+        they can be resumed if they're interrupted, or None.
+    :param compressor:
+        A LayerCompressor to compress uncompressed layers with, or None to
+        push them as they are.
+    :param blobs:
+        A BlobTracker shared by all the pushes in the run, so that blobs
+        pushed to other repositories are mounted rather than uploaded again,
+        or None.
+    :return:
+        A generator of progress messages, like the output of ``docker push``.
+        The image is pushed as the generator is consumed.
+    """
+    missing = image.all_missing()
+    if missing:
+        raise ArchiveError('%s in %s refers to blobs that are not in the '
+                           'archive: %s' % (image.name, archive.path,
+                                            ', '.join(missing)))
+
+    if compressor is not None:
+        image = compressor.compress_image(archive, image)
+    for blob in image.all_blobs():
+        short_digest = blob.digest.partition(':')[2][:12]
+        if blobs is None:
+            yield '%s: %s' % (short_digest, _push_blob(
+                archive, blob, client, repository, chunk_size, uploads,
+                compressor))
+            continue
+
+        source = blobs.claim(client.domain, blob.digest)
+        if source == repository:
+            yield '%s: Layer already exists' % (short_digest,)
+            continue
+        if source is not None:
+            if client.mount_blob(repository, blob.digest, source):
+                blobs.add(client.domain, blob.digest, repository)
+                yield '%s: Mounted from %s' % (short_digest, source)
+                continue
+            # The other repository must have lost the blob, so push it
+            # without claiming it
+
+        try:
+            message = _push_blob(archive, blob, client, repository,
+                                 chunk_size, uploads, compressor)
+            blobs.add(client.domain, blob.digest, repository)
+        finally:
+            if source is None:
+                blobs.release(client.domain, blob.digest)
+        yield '%s: %s' % (short_digest, message)
+
+    _push_manifests(client, repository, image.children)
+    client.put_manifest(repository, reference, image.media_type,
+                        image.manifest)
+    yield '%s: digest: %s size: %d' % (
+        reference, image.digest, len(image.manifest))
+
+
+def _push_blob(archive, blob, client, repository, chunk_size, uploads,
+               compressor):
+    """
+    Upload a blob unless the repository already has it.
+
+    :return: A message saying what was done.
+    """
+    if client.blob_exists(repository, blob.digest):
+        return 'Layer already exists'
+
+    key = '%s/%s@%s' % (client.domain, repository, blob.digest)
+    session = progress = None
+    if chunk_size is not None and uploads is not None:
+        session = uploads.get_upload(key)
+        progress = partial(uploads.record_upload, key)
+
+    if compressor is not None:
+        opened = compressor.open_blob(archive, blob)
+    else:
+        opened = archive.open_blob(blob)
+    with opened as data:
+        start = client.upload_blob(
+            repository, blob.digest, data, chunk_size,
+            location=session[0] if session is not None else None,
+            progress=progress)
+    if progress is not None:
+        uploads.forget_upload(key)
+    if start:
+        return 'Pushed %d bytes, resuming from byte %d' % (
+            blob.size - start, start)
+    return 'Pushed %d bytes' % (blob.size,)
+
+
+def _push_manifests(client, repository, images):
+    for image in images:
+        _push_manifests(client, repository, image.children)
+        client.put_manifest(
+            repository, image.digest, image.media_type, image.manifest)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+An on-disk record of the tags that have been pushed, and the local images they
+were pushed from, so that pushing the same images again can be skipped. Blob
+uploads in progress are recorded too, so that they can be resumed.
+"""
+import json
+import threading
+import time
+
+from docker_ci_deploy.files import write_atomic
+
+# Entries older than this are ignored, so that tags are pushed again every so
+# often in case they were changed in the registry by something else
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+class DeployCache(object):
+    """
+    A cache of the image ID, registry digest and time of the last successful
+    push of each target tag, and of the blob upload sessions in progress,
+    stored as a JSON file. The cache is read when it is created and written
+    by ``save()``, or whenever an upload's progress is recorded. Changes made
+    by other processes in the meantime are merged rather than overwritten.
+    """
+
+    def __init__(self, path, max_age=DEFAULT_MAX_AGE):
+        """
+        :param path: The path to the cache file. It need not exist yet.
+        :param max_age:
+            The age, in seconds, after which an entry is ignored. If 0, all
+            existing tag entries are ignored but new entries are still
+            recorded, and upload sessions expire after ``DEFAULT_MAX_AGE``.
+        """
+        self.path = path
+        self.max_age = max_age
+        self._entries, self._uploads = self._load()
+        self._updates = {}
+        # Upload sessions that have been removed are updated to None
+        self._upload_updates = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError):
+            return {}, {}
+        except ValueError:
+            # A corrupt cache is no worse than an empty one
+            return {}, {}
+        if not isinstance(data, dict):
+            return {}, {}
+        return data.get('tags', {}), data.get('uploads', {})
+
+    def _fresh(self, entry, now, max_age=None):
+        if max_age is None:
+            max_age = self.max_age
+        return now - entry.get('time', 0) < max_age
+
+    def _fresh_upload(self, upload, now):
+        # Unlike tags, uploads are only worth resuming while they're recent,
+        # even when the tags are all being pushed again
+        return self._fresh(upload, now, self.max_age or DEFAULT_MAX_AGE)
+
+    def is_pushed(self, tag, image_id):
+        """
+        Check whether a tag was pushed from the same local image, and that
+        not too long ago.
+        """
+        with self._lock:
+            entry = self._updates.get(tag) or self._entries.get(tag)
+        return (entry is not None and entry.get('image_id') == image_id and
+                self._fresh(entry, time.time()))
+
+    def record(self, tag, image_id, digest):
+        """ Record that a tag was pushed from an image. """
+        with self._lock:
+            self._updates[tag] = {
+                'image_id': image_id, 'digest': digest, 'time': time.time()}
+
+    def get_upload(self, key):
+        """
+        Get the upload session recorded for a blob.
+
+        :param key: Identifies the blob and the repository it is uploaded to.
+        :return: A (location, offset) tuple, or None.
+        """
+        with self._lock:
+            if key in self._upload_updates:
+                entry = self._upload_updates[key]
+            else:
+                entry = self._uploads.get(key)
+        if entry is None or not self._fresh_upload(entry, time.time()):
+            return None
+        return entry['location'], entry['offset']
+
+    def record_upload(self, key, location, offset):
+        """
+        Record the progress of a blob upload, writing it to the cache file
+        straight away in case the upload is interrupted.
+        """
+        with self._lock:
+            self._upload_updates[key] = {
+                'location': location, 'offset': offset, 'time': time.time()}
+            self._write()
+
+    def forget_upload(self, key):
+        """ Remove a blob upload session once the upload is finished. """
+        with self._lock:
+            if key in self._upload_updates or key in self._uploads:
+                self._upload_updates[key] = None
+                self._write()
+
+    def save(self):
+        """
+        Write the recorded pushes to the cache file, dropping entries that
+        have expired.
+        """
+        with self._lock:
+            if self._updates or self._upload_updates:
+                self._write()
+
+    def _write(self):
+        entries, uploads = self._load()
+        entries.update(self._updates)
+        for key, upload in self._upload_updates.items():
+            if upload is None:
+                uploads.pop(key, None)
+            else:
+                uploads[key] = upload
+        now = time.time()
+        entries = dict((tag, entry) for tag, entry in entries.items()
+                       if self._fresh(entry, now) or not self.max_age)
+        uploads = dict((key, upload) for key, upload in uploads.items()
+                       if self._fresh_upload(upload, now))
+
+        write_atomic(self.path, json.dumps(
+            {'tags': entries, 'uploads': uploads}, sort_keys=True))
+        self._entries = entries
+        self._uploads = uploads
+        self._updates = {}
+        self._upload_updates = {}
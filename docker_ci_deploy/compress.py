@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Block-parallel gzip compression, like pigz. The input is split into chunks
+that are compressed on a pool of threads, each as a separate gzip member. A
+series of gzip members is itself a valid gzip file (RFC 1952) that gunzip and
+Docker decompress as one.
+"""
+import hashlib
+import multiprocessing
+import struct
+import sys
+import threading
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_LEVEL = 6
+
+# No modification time, file name or operating system, so that members don't
+# depend on when or where they were compressed
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def gzip_member(data, level=DEFAULT_LEVEL):
+    """ Compress some data as a single gzip member. """
+    if isinstance(data, memoryview) and sys.version_info < (3,):
+        # Python 2's zlib only accepts strings and buffers
+        data = data.tobytes()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    return b''.join([GZIP_HEADER, deflated, struct.pack(
+        '<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)])
+
+
+class ParallelGzip(object):
+    """
+    A gzip compressor that compresses chunks of its input in parallel. zlib
+    releases the GIL while it compresses, so the threads use all the cores.
+    The output only depends on the input, the chunk size, the compression
+    level and the version of zlib, so the digests of compressed layers are
+    the same every time they're compressed.
+    """
+
+    def __init__(self, jobs=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 level=DEFAULT_LEVEL):
+        """
+        :param jobs:
+            The number of threads to compress with, or None for one per CPU.
+        :param chunk_size: The number of bytes to compress in each member.
+        :param level: The zlib compression level.
+        """
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.level = level
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def compress(self, data, write):
+        """
+        Compress data, writing the output in order as it is produced. At most
+        a few chunks per thread are held in memory at a time.
+
+        :param data:
+            A bytes-like object, such as a memoryview of a memory-mapped file.
+        :param write: A function to call with each piece of the output.
+        :return: A (digest, size) tuple for the compressed output.
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.jobs)
+        sha256 = hashlib.sha256()
+        sizes = []
+
+        def finish(result):
+            member = result.get()
+            sha256.update(member)
+            sizes.append(len(member))
+            write(member)
+
+        # An empty input still needs one (empty) member to be valid gzip
+        starts = range(0, len(data), self.chunk_size) or [0]
+        pending = deque()
+        for start in starts:
+            pending.append(self._pool.apply_async(gzip_member, (
+                data[start:start + self.chunk_size], self.level)))
+            # Keep every thread busy, but don't run too far ahead of write()
+            if len(pending) > self.jobs * 2:
+                finish(pending.popleft())
+        while pending:
+            finish(pending.popleft())
+        return 'sha256:' + sha256.hexdigest(), sum(sizes)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
@@ -0,0 +1,594 @@
+# -*- coding: utf-8 -*-
+"""
+A long-running deploy daemon, and the client that sends it commands. CI jobs
+on the same host that run ``docker-ci-deploy --daemon ADDRESS ...`` don't each
+pay for starting Python and importing everything: the command is sent to the
+daemon, which runs it as if it had been run in the client's working directory
+and sends back the output and exit status.
+
+The Docker commands of all the deploys are run on one shared pool of workers,
+with shared limits, and pushes of the same tags from the same images that are
+requested at the same time (e.g. by two jobs building the same commit) are
+only done once, with every deploy that asked for them waiting for the result.
+
+The daemon speaks HTTP, over a unix socket or a local TCP port. A deploy is
+requested with ``POST /deploy`` and a JSON body with the command's ``args``,
+the ``cwd`` to resolve paths against, and the ``stdin`` to read images from
+if ``--from-file -`` is given. The response is a JSON message on each line:
+``{"stream": "stdout" or "stderr", "data": ...}`` for the output as it is
+written, and finally ``{"exit": status}``. ``GET /status`` returns the number
+of deploys running and of pushes shared.
+"""
+import codecs
+import io
+import json
+import os
+import socket
+import threading
+import traceback
+from collections import deque
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # pragma: no cover
+    ContextVar = None  # Python < 3.7
+
+try:
+    from http.client import HTTPConnection
+    from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, TCPServer, UnixStreamServer
+except ImportError:  # pragma: no cover
+    from httplib import HTTPConnection  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, TCPServer, UnixStreamServer
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # pragma: no cover
+    from urlparse import urlsplit  # Python 2
+
+from docker_ci_deploy.engine import UnixHTTPConnection
+
+
+# The hosts a daemon may listen on, and that requests to it may be addressed
+# to. Web pages can make requests to local addresses, and to addresses that
+# their own host names resolve to, so requests that could come from a browser
+# must be rejected too: anything that can make requests can run commands.
+LOOPBACK_HOSTS = frozenset(['localhost', '127.0.0.1', '::1'])
+
+
+class DaemonError(Exception):
+    """ The deploy daemon couldn't be reached or rejected a request. """
+
+
+def parse_address(address):
+    """
+    Parse the address of a deploy daemon.
+
+    :param address:
+        'unix://PATH' (or just an absolute PATH) for a unix socket, or
+        'http://HOST:PORT' for a TCP port, where HOST is one of
+        ``LOOPBACK_HOSTS``.
+    :return: A ('unix', path) or ('tcp', (host, port)) pair.
+    """
+    if address.startswith('/'):
+        return 'unix', address
+    if address.startswith('unix://'):
+        path = address[len('unix://'):]
+        if path:
+            return 'unix', path
+    elif address.startswith('http://'):
+        url = urlsplit(address)
+        try:
+            port = url.port
+        except ValueError:
+            port = None
+        if url.hostname in LOOPBACK_HOSTS and port and url.path in ('', '/'):
+            return 'tcp', (url.hostname, port)
+    raise ValueError(
+        "invalid deploy daemon address '%s': expected unix://PATH or "
+        'http://HOST:PORT, where HOST is localhost, 127.0.0.1 or ::1'
+        % (address,))
+
+
+def _connect(address, timeout=None):
+    kind, location = parse_address(address)
+    if kind == 'unix':
+        return UnixHTTPConnection(location, timeout=timeout)
+    host, port = location
+    return HTTPConnection(host, port, timeout=timeout)
+
+
+def forward(address, args, cwd, stdin=None, stdout=None, stderr=None):
+    """
+    Run a command on a deploy daemon, writing its output as it arrives.
+
+    :param address: The daemon's address. See ``parse_address()``.
+    :param args: The command-line arguments.
+    :param cwd: The directory to resolve relative paths against.
+    :param stdin: The text to read for ``--from-file -``, or None.
+    :param stdout: The stream to write the output to (default: sys.stdout).
+    :param stderr: The stream to write errors to (default: sys.stderr).
+    :return: The command's exit status.
+    """
+    import sys
+
+    streams = {'stdout': stdout or sys.stdout, 'stderr': stderr or sys.stderr}
+    body = json.dumps({'args': list(args), 'cwd': cwd, 'stdin': stdin})
+    connection = _connect(address)
+    try:
+        try:
+            connection.request('POST', '/deploy', body.encode('utf-8'),
+                               {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+        except (socket.error, IOError) as e:
+            raise DaemonError('Failed to connect to the deploy daemon at %s: '
+                              '%s' % (address, e))
+        if response.status != 200:
+            raise DaemonError('The deploy daemon at %s rejected the command '
+                              'with status %d: %s' % (
+                                  address, response.status,
+                                  response.read().decode('utf-8', 'replace')))
+
+        for line in iter(response.readline, b''):
+            message = json.loads(line.decode('utf-8'))
+            if 'exit' in message:
+                return message['exit']
+            stream = streams[message['stream']]
+            stream.write(message['data'])
+            stream.flush()
+        raise DaemonError('The deploy daemon at %s stopped before the command '
+                          'finished' % (address,))
+    finally:
+        connection.close()
+
+
+class InFlight(object):
+    """
+    Calls that are running, by key, so that a call made while an identical
+    one is running waits for it and shares its result, rather than being
+    made again. Once a call finishes, the next call with its key is made
+    again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        # The number of calls that shared another call's result
+        self.shared = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._calls)
+
+    def run(self, key, func, waiting=None):
+        """
+        Call a function, or wait for the call with the same key that is
+        already running.
+
+        :param key: A hashable key that identifies the call.
+        :param func: The function to call. It is called with no arguments.
+        :param waiting:
+            A function to call, with no arguments, before waiting for another
+            call, or None.
+        :return:
+            The function's result. If it raises an error, so does every call
+            waiting for it.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                running = False
+            else:
+                self.shared += 1
+                running = True
+
+        if running:
+            if waiting is not None:
+                waiting()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DeployRequest(object):
+    """ A command that a client asked the daemon to run. """
+
+    def __init__(self, args, cwd, stdin=None, pool=None, in_flight=None):
+        """
+        :param args: The command-line arguments.
+        :param cwd: The client's working directory.
+        :param stdin: The text to read for ``--from-file -``, or None.
+        :param pool: The daemon's shared TaskPool.
+        :param in_flight: The daemon's shared InFlight.
+        """
+        self.args = args
+        self.cwd = cwd
+        self.stdin = io.StringIO(stdin or u'')
+        self.pool = pool
+        self.in_flight = in_flight
+        self._files = []
+
+    def path(self, path):
+        """ Resolve a path against the client's working directory. """
+        return os.path.join(self.cwd, os.path.expanduser(path))
+
+    def open(self, path):
+        """
+        Open a file to read, like ``argparse.FileType('r')``, but in the
+        client's working directory and with the client's stdin for '-'.
+        """
+        import argparse
+
+        if path == '-':
+            return self.stdin
+        try:
+            f = open(self.path(path))
+        except (IOError, OSError) as e:
+            raise argparse.ArgumentTypeError(
+                "can't open '%s': %s" % (path, e))
+        self._files.append(f)
+        return f
+
+    def close(self):
+        """ Close the files opened for the command. """
+        while self._files:
+            self._files.pop().close()
+
+    def resolve_paths(self, args, names):
+        """
+        Resolve the paths given for some parsed options against the client's
+        working directory.
+
+        :param args: The parsed arguments.
+        :param names: The names of the options, whose values are paths, lists
+            of paths, or None.
+        """
+        for name in names:
+            value = getattr(args, name)
+            if isinstance(value, list):
+                setattr(args, name, [self.path(path) for path in value])
+            elif value is not None:
+                setattr(args, name, self.path(value))
+
+
+# The (stdout, stderr) that the output of the current request is sent to
+_request_output = None if ContextVar is None else ContextVar(
+    'request_output', default=None)
+
+
+class _OutputRouter(object):
+    """
+    Stands in for sys.stdout or sys.stderr, and writes to the current
+    request's stream instead of the real one, if there is a current request.
+    Tasks on the shared pool run in the context of the request that
+    submitted them (see ``TaskPool``), so their output goes to it too.
+    """
+
+    def __init__(self, index, stream):
+        self._index = index
+        self._stream = stream
+
+    def __getattr__(self, name):
+        streams = _request_output.get()
+        stream = self._stream if streams is None else streams[self._index]
+        return getattr(stream, name)
+
+
+class _ResponseWriter(object):
+    """
+    Writes JSON messages to a response. Messages are queued and written by a
+    thread of the writer's own, so a client that is slow to read its output
+    never holds up the command writing it, or anything waiting to write
+    output while that command holds the output lock. If the client goes away,
+    further messages are dropped, but the request carries on.
+    """
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._messages = deque()
+        self._cond = threading.Condition()
+        self._closing = False
+        self.closed = False
+        self._thread = threading.Thread(target=self._write_messages)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, message):
+        data = json.dumps(message).encode('utf-8') + b'\n'
+        with self._cond:
+            if self.closed:
+                return
+            self._messages.append(data)
+            self._cond.notify()
+
+    def close(self):
+        """ Wait for the queued messages to be written. """
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _write_messages(self):
+        while True:
+            with self._cond:
+                while not self._messages and not self._closing:
+                    self._cond.wait()
+                if not self._messages:
+                    return
+                # Write everything queued so far in one go
+                data = b''.join(self._messages)
+                self._messages.clear()
+            try:
+                self._wfile.write(data)
+                self._wfile.flush()
+            except (socket.error, IOError):
+                with self._cond:
+                    self.closed = True
+                    self._messages.clear()
+                return
+
+
+class _RequestStream(object):
+    """ A text stream that sends what is written to it to a client. """
+
+    def __init__(self, writer, name):
+        self._writer = writer
+        self._name = name
+        self.buffer = _RequestBuffer(self)
+
+    def write(self, data):
+        if data:
+            self._writer.send({'stream': self._name, 'data': data})
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class _RequestBuffer(object):
+    """
+    The binary stream underneath a _RequestStream. Bytes are decoded as
+    UTF-8, keeping partial characters until the rest of them are written.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self._stream.write(self._decoder.decode(bytes(data)))
+
+    def flush(self):
+        pass
+
+
+class _ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class DeployServer(object):
+    """
+    Serves deploy requests, running each one with the command's ``main()``
+    on its own thread and sending its output back to the client.
+    """
+
+    def __init__(self, address, main, pool):
+        """
+        :param address: The address to listen on. See ``parse_address()``.
+        :param main:
+            The function that runs a command, given its arguments and a
+            DeployRequest as ``request``.
+        :param pool: The TaskPool to share between all the requests.
+        """
+        if ContextVar is None:
+            raise ValueError('the deploy daemon requires Python 3.7 or later')
+        self.address = address
+        self.main = main
+        self.pool = pool
+        self.in_flight = InFlight()
+        self.running = 0
+        self._lock = threading.Lock()
+
+        kind, location = parse_address(address)
+        handler = type('Handler', (_DeployHandler,), {'daemon': self})
+        if kind == 'unix':
+            _remove_stale_socket(location)
+            self._server = _ThreadingUnixServer(location, handler)
+        else:
+            self._server = _ThreadingTCPServer(location, handler)
+        self._socket_path = location if kind == 'unix' else None
+        self._real_streams = None
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Serve requests until ``shutdown()`` is called. The output of each
+        request is sent to its client, while anything else is still written
+        to stdout and stderr.
+        """
+        import sys
+
+        self._real_streams = sys.stdout, sys.stderr
+        sys.stdout = _OutputRouter(0, sys.stdout)
+        sys.stderr = _OutputRouter(1, sys.stderr)
+        try:
+            self._server.serve_forever(poll_interval=poll_interval)
+        finally:
+            sys.stdout, sys.stderr = self._real_streams
+
+    def shutdown(self):
+        """ Stop ``serve_forever()``, from another thread. """
+        self._server.shutdown()
+
+    def close(self):
+        """ Stop listening. Requests that are running carry on. """
+        self._server.server_close()
+        if self._socket_path is not None and os.path.exists(
+                self._socket_path):
+            os.remove(self._socket_path)
+
+    def status(self):
+        """ Get the number of requests running and of shared pushes. """
+        with self._lock:
+            running = self.running
+        return {'running': running, 'in_flight': len(self.in_flight),
+                'shared': self.in_flight.shared}
+
+    def run(self, request, writer):
+        """
+        Run a request's command, sending its output to the client.
+
+        :return: The command's exit status.
+        """
+        token = _request_output.set((_RequestStream(writer, 'stdout'),
+                                     _RequestStream(writer, 'stderr')))
+        with self._lock:
+            self.running += 1
+        try:
+            self.main(request.args, request=request)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            _request_output.get()[1].write('%s\n' % (e.code,))
+            return 1
+        except Exception:
+            traceback.print_exc(file=_request_output.get()[1])
+            return 1
+        finally:
+            request.close()
+            with self._lock:
+                self.running -= 1
+            _request_output.reset(token)
+        return 0
+
+
+def _remove_stale_socket(path):
+    """
+    Remove a unix socket left behind by a daemon that is no longer running,
+    but never one that a daemon is still listening on.
+    """
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (socket.error, IOError):
+        os.remove(path)
+    else:
+        raise ValueError('a deploy daemon is already listening on %s' % (
+            path,))
+    finally:
+        sock.close()
+
+
+class _DeployHandler(BaseHTTPRequestHandler):
+    daemon = None
+
+    def address_string(self):
+        # Clients connected to a unix socket have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_request(self, data):
+        try:
+            body = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+        if not isinstance(body, dict):
+            return None
+        args, cwd, stdin = body.get('args'), body.get('cwd'), body.get('stdin')
+        if (not isinstance(args, list) or
+                not all(isinstance(arg, type(u'')) for arg in args) or
+                not isinstance(cwd, type(u'')) or not os.path.isabs(cwd) or
+                not (stdin is None or isinstance(stdin, type(u'')))):
+            return None
+        return DeployRequest(
+            args, cwd, stdin, self.daemon.pool, self.daemon.in_flight)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self._send_json(404, {'message': 'Not found'})
+            return
+        self._send_json(200, self.daemon.status())
+
+    def _is_local(self):
+        """
+        Check that a request is addressed to a loopback host, so that a web
+        page on a host name that resolves to one (DNS rebinding) is refused.
+        """
+        host = self.headers.get('Host') or ''
+        if host.startswith('['):
+            host = host[1:].partition(']')[0]
+        else:
+            host = host.rpartition(':')[0] if ':' in host else host
+        return host in LOOPBACK_HOSTS
+
+    def do_POST(self):
+        if self.path != '/deploy':
+            self._send_json(404, {'message': 'Not found'})
+            return
+        # Read the body even if the request is rejected, so that the client
+        # isn't still sending it when the connection is closed
+        data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self._is_local():
+            self._send_json(403, {'message': 'Requests must be addressed to '
+                                             'a loopback host'})
+            return
+        # Browsers can send other content types without asking first
+        content_type = self.headers.get('Content-Type') or ''
+        if content_type.partition(';')[0].strip() != 'application/json':
+            self._send_json(415, {'message': 'expected application/json'})
+            return
+        request = self._read_request(data)
+        if request is None:
+            self._send_json(400, {
+                'message': 'expected an object with a list of "args", an '
+                           'absolute "cwd" and optionally "stdin"'})
+            return
+
+        # The output is streamed until the connection is closed
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        writer = _ResponseWriter(self.wfile)
+        status = self.daemon.run(request, writer)
+        writer.send({'exit': status})
+        writer.close()
+        self.log_message('"%s" exited with status %d',
+                         ' '.join(request.args), status)
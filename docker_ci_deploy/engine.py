@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+A minimal client for the Docker Engine API, spoken over the Docker daemon's
+unix socket.
+https://docs.docker.com/engine/api/
+"""
+import base64
+import json
+import os
+import socket
+import threading
+
+try:
+    from http.client import BadStatusLine, HTTPConnection
+except ImportError:  # pragma: no cover
+    from httplib import BadStatusLine, HTTPConnection  # Python 2
+
+try:
+    from urllib.parse import quote, urlencode
+except ImportError:  # pragma: no cover
+    from urllib import quote, urlencode  # Python 2
+
+from docker_ci_deploy.registry import IDEMPOTENT_METHODS, is_dropped
+
+DEFAULT_SOCKET_PATH = '/var/run/docker.sock'
+
+
+class DockerEngineError(Exception):
+    """ The Docker daemon returned an error. """
+
+
+def default_socket_path():
+    """
+    Get the path to the Docker daemon's socket, from the ``DOCKER_HOST``
+    environment variable if that is set to a unix socket.
+    """
+    docker_host = os.environ.get('DOCKER_HOST', '')
+    if docker_host.startswith('unix://'):
+        return docker_host[len('unix://'):]
+    return DEFAULT_SOCKET_PATH
+
+
+def encode_registry_auth(credentials, domain):
+    """
+    Encode registry credentials for the ``X-Registry-Auth`` header.
+
+    :param credentials: A (username, password) tuple or None.
+    """
+    auth = {}
+    if credentials is not None:
+        username, password = credentials
+        auth = {'username': username, 'password': password,
+                'serveraddress': domain}
+    return base64.urlsafe_b64encode(
+        json.dumps(auth).encode('utf-8')).decode('ascii')
+
+
+def format_progress(message):
+    """
+    Format a message from a streamed JSON progress response as a line of text
+    like the Docker CLI does when it isn't writing to a terminal. Returns None
+    for messages that only report progress.
+    """
+    if message.get('progressDetail'):
+        return None
+    status = message.get('status')
+    if status is None:
+        return None
+    if 'id' in message:
+        return '%s: %s' % (message['id'], status)
+    return status
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """ An HTTP connection over a unix socket. """
+
+    def __init__(self, socket_path, timeout=None):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerEngineClient(object):
+    """
+    A client for the Docker daemon. Each thread that uses the client keeps one
+    persistent connection to the daemon.
+    """
+
+    def __init__(self, socket_path=None):
+        if socket_path is None:
+            socket_path = default_socket_path()
+        self.socket_path = socket_path
+        self._local = threading.local()
+        # Every thread's connection, so that they can all be closed
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        """
+        Get the calling thread's connection to the daemon, connecting again
+        if the daemon has closed it while it was idle.
+
+        :return:
+            A (connection, reused) pair, where reused is True if the
+            connection is already open.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = UnixHTTPConnection(self.socket_path)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        elif connection.sock is not None and is_dropped(connection):
+            # Closed by the daemon while idle, so nothing was sent
+            connection.close()
+        return connection, connection.sock is not None
+
+    def _close_connection(self):
+        """ Close the calling thread's connection to the daemon. """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+            with self._lock:
+                self._connections.remove(connection)
+
+    def close(self):
+        """
+        Close every thread's connection to the daemon, once no more requests
+        are being made. A thread that makes another request reconnects.
+        """
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.close()
+
+    def _request(self, method, path, query=None, headers={}):
+        if query:
+            path += '?' + urlencode(query)
+        connection, reused = self._connection()
+        while True:
+            sent = False
+            try:
+                connection.request(method, path, headers=headers)
+                sent = True
+                return connection.getresponse()
+            except (BadStatusLine, socket.error, IOError):
+                self._close_connection()
+                # The daemon may have closed the idle connection before the
+                # request arrived, but once the request has been sent, it
+                # may also have received it, so only make the request again
+                # if that's safe
+                if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                    raise
+                connection, reused = self._connection()
+
+    def _check_response(self, method, path, response):
+        if response.status < 400:
+            return
+        body = response.read()
+        try:
+            message = json.loads(body.decode('utf-8'))['message']
+        except (ValueError, KeyError):
+            message = body.decode('utf-8', 'replace')
+        raise DockerEngineError('%s %s failed with status %d: %s' % (
+            method, path, response.status, message))
+
+    def tag(self, image, repository, tag):
+        """ Tag an image, like ``docker tag``. """
+        path = '/images/%s/tag' % (quote(image, safe='/:@'),)
+        query = {'repo': repository}
+        if tag:
+            query['tag'] = tag
+        response = self._request('POST', path, query)
+        self._check_response('POST', path, response)
+        response.read()
+
+    def inspect_image(self, image):
+        """ Get low-level information about an image. """
+        path = '/images/%s/json' % (quote(image, safe='/:@'),)
+        response = self._request('GET', path)
+        self._check_response('GET', path, response)
+        return json.loads(response.read().decode('utf-8'))
+
+    def push(self, name, tag, registry_auth):
+        """
+        Push an image, like ``docker push``. The daemon's progress messages are
+        yielded as they are received.
+
+        :param tag:
+            The tag to push, or None for "latest". Like ``docker push``, and
+            unlike the API without a tag, the repository's other tags aren't
+            pushed.
+        :param registry_auth: The encoded ``X-Registry-Auth`` header value.
+        """
+        path = '/images/%s/push' % (quote(name, safe='/:'),)
+        query = {'tag': tag or 'latest'}
+        response = self._request(
+            'POST', path, query, headers={'X-Registry-Auth': registry_auth})
+        self._check_response('POST', path, response)
+
+        complete = False
+        try:
+            # The daemon writes one JSON message per line
+            for line in iter(_readline(response), b''):
+                line = line.strip()
+                if not line:
+                    continue
+                message = json.loads(line.decode('utf-8'))
+                if 'error' in message:
+                    raise DockerEngineError(message['error'])
+                yield message
+            complete = True
+        finally:
+            if not complete:
+                # Don't reuse a connection with an unread response
+                self._close_connection()
+
+
+def _readline(response):
+    """
+    Get a function that reads a line from a response. Python 2's
+    HTTPResponse has no ``readline()``, so the line is read a byte at a time,
+    which still decodes a chunked response.
+    """
+    if hasattr(response, 'readline'):
+        return response.readline
+
+    def readline():
+        line = b''
+        while not line.endswith(b'\n'):
+            byte = response.read(1)
+            if not byte:
+                break
+            line += byte
+        return line
+    return readline
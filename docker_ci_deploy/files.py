@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Writing the files that a deploy leaves behind for other processes to read,
+such as the cache, metrics and trace files.
+"""
+import os
+import tempfile
+
+# os.replace() overwrites the destination on all platforms but isn't available
+# in Python 2
+_replace = getattr(os, 'replace', os.rename)
+
+
+def write_atomic(path, data):
+    """
+    Write text to a file, replacing it in one step so that nothing ever reads
+    it half-written. The file's directory is created if it doesn't exist.
+
+    :param path: The path of the file.
+    :param data: The text to write.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        _replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Measurements of a deploy run: how long each operation took, how much was
+pushed, and what was skipped, retried or failed. They are written once the
+run finishes as a JSON summary, or in the Prometheus text format so that the
+node exporter's textfile collector can pick them up.
+"""
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from docker_ci_deploy.files import write_atomic
+
+# The upper bounds, in seconds, of the buckets of the duration histograms
+DEFAULT_BUCKETS = (
+    0.001, 0.01, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+METRIC_PREFIX = 'docker_ci_deploy_'
+
+# The help text for each counter, by name
+COUNTERS = {
+    'failures': 'Operations that failed.',
+    'pushed_bytes': 'Bytes of blobs uploaded (by the archive backend only).',
+    'layers': 'Layers in pushed images, by what was done with them.',
+    'manifest_bytes': 'Bytes of the image manifests pushed.',
+    'retries': 'Registry requests retried on a new connection.',
+    'skipped_tags': 'Tags that were not pushed, by the reason why.',
+}
+
+
+def _percentile(values, fraction):
+    """ Get a percentile of some sorted values, using the nearest rank. """
+    if not values:
+        return None
+    return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+
+def _counter_key(name, **labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _escape_label(value):
+    return (value.replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join(
+        '%s="%s"' % (name, _escape_label(value))
+        for name, value in labels),)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class DeployMetrics(object):
+    """
+    Durations and counts collected during a deploy run. Durations are kept
+    for each operation (e.g. 'push') and registry, and counters for each
+    name and set of labels. Safe to use from any number of threads.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets:
+            The upper bounds, in seconds, of the buckets of the duration
+            histograms in the Prometheus output.
+        """
+        self.buckets = buckets
+        self.started = time.time()
+        self.finished = None
+        self.succeeded = None
+        # (operation, registry) => list of durations
+        self._durations = {}
+        # (name, sorted label pairs) => count
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, operation, registry=None):
+        """
+        Measure how long the code in a ``with`` block takes. If it raises an
+        exception, the operation is also counted as a failure.
+
+        :param operation: The name of the operation, e.g. 'push'.
+        :param registry:
+            The address of the registry the operation talks to, if any.
+        """
+        start = time.time()
+        try:
+            yield
+        except BaseException:
+            self.add('failures', operation=operation, registry=registry or '')
+            raise
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                self._durations.setdefault(
+                    (operation, registry), []).append(duration)
+
+    def add(self, name, value=1, **labels):
+        """
+        Add to a counter.
+
+        :param name: The name of the counter, one of ``COUNTERS``.
+        :param labels: The labels of the count, e.g. registry='docker.io'.
+        """
+        key = _counter_key(name, **labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def finish(self, succeeded):
+        """ Record that the run has finished, and whether it succeeded. """
+        self.finished = time.time()
+        self.succeeded = succeeded
+
+    def summary(self):
+        """
+        Summarise the metrics as a dict that can be serialized as JSON, with
+        the median, 95th percentile and total of the durations of each
+        operation.
+        """
+        with self._lock:
+            durations = dict(self._durations)
+            counters = dict(self._counters)
+
+        operations = []
+        for (operation, registry), values in sorted(
+                durations.items(), key=lambda item: (
+                    item[0][0], item[0][1] or '')):
+            values = sorted(values)
+            operations.append({
+                'operation': operation,
+                'registry': registry,
+                'count': len(values),
+                'failures': counters.get(_counter_key(
+                    'failures', operation=operation,
+                    registry=registry or ''), 0),
+                'total_seconds': sum(values),
+                'p50_seconds': _percentile(values, 0.5),
+                'p95_seconds': _percentile(values, 0.95),
+                'max_seconds': values[-1],
+            })
+
+        return {
+            'started': self.started,
+            'duration_seconds': (
+                None if self.finished is None
+                else self.finished - self.started),
+            'succeeded': self.succeeded,
+            'operations': operations,
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(counters.items())],
+        }
+
+    def prometheus_lines(self):
+        """
+        Get the metrics in the Prometheus text exposition format, as a list
+        of lines.
+        """
+        with self._lock:
+            durations = dict(self._durations)
+            counters = dict(self._counters)
+
+        name = METRIC_PREFIX + 'operation_duration_seconds'
+        lines = [
+            '# HELP %s Time taken by each operation.' % (name,),
+            '# TYPE %s histogram' % (name,),
+        ]
+        for (operation, registry), values in sorted(
+                durations.items(), key=lambda item: (
+                    item[0][0], item[0][1] or '')):
+            labels = [('operation', operation), ('registry', registry or '')]
+            for bound in self.buckets:
+                lines.append('%s_bucket%s %d' % (
+                    name, _format_labels(labels + [('le', str(bound))]),
+                    sum(1 for value in values if value <= bound)))
+            lines.append('%s_bucket%s %d' % (
+                name, _format_labels(labels + [('le', '+Inf')]),
+                len(values)))
+            lines.append('%s_sum%s %s' % (
+                name, _format_labels(labels), repr(float(sum(values)))))
+            lines.append('%s_count%s %d' % (
+                name, _format_labels(labels), len(values)))
+
+        for counter in sorted(COUNTERS):
+            name = METRIC_PREFIX + counter + '_total'
+            lines.extend([
+                '# HELP %s %s' % (name, COUNTERS[counter]),
+                '# TYPE %s counter' % (name,),
+            ])
+            lines.extend(
+                '%s%s %s' % (name, _format_labels(labels),
+                             _format_value(value))
+                for (counter_name, labels), value in sorted(counters.items())
+                if counter_name == counter)
+
+        gauges = [
+            ('last_run_start_time_seconds',
+             'When the last run started, in seconds since the epoch.',
+             self.started),
+        ]
+        if self.finished is not None:
+            gauges.extend([
+                ('last_run_duration_seconds', 'How long the last run took.',
+                 self.finished - self.started),
+                ('last_run_success', 'Whether the last run succeeded.',
+                 1 if self.succeeded else 0),
+            ])
+        for gauge, help_text, value in gauges:
+            name = METRIC_PREFIX + gauge
+            lines.extend([
+                '# HELP %s %s' % (name, help_text),
+                '# TYPE %s gauge' % (name,),
+                '%s %s' % (name, _format_value(value)),
+            ])
+        return lines
+
+    def write(self, path):
+        """
+        Write the metrics to a file: a JSON summary if the path ends in
+        '.json', or otherwise the Prometheus text format. The file is
+        replaced in one step, so nothing ever reads it half-written.
+        """
+        if path.endswith('.json'):
+            content = json.dumps(self.summary(), indent=2, sort_keys=True)
+        else:
+            content = '\n'.join(self.prometheus_lines())
+        write_atomic(path, content + '\n')
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Profilers for finding out why a deploy is slow or uses a lot of memory,
+without wrapping the command by hand. The CPU profiler writes cProfile stats
+that can be read with ``python -m pstats`` or a viewer such as snakeviz. The
+memory profiler writes a report of the lines that allocated the most memory,
+from tracemalloc snapshots taken at the end of each phase of the deploy.
+"""
+import sys
+import threading
+
+# The number of lines to list in each memory snapshot
+DEFAULT_TOP = 25
+
+
+class CpuProfiler(object):
+    """
+    Profiles the time spent in every function with cProfile, in every thread
+    that is started while it's running.
+    """
+
+    def __init__(self, path):
+        """ :param path: The path to write the pstats file to. """
+        import cProfile
+
+        self.path = path
+        self._profile_class = cProfile.Profile
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def _profile_thread(self, *args):
+        # Called as the profile function of each new thread before it runs.
+        # Enabling a profiler replaces this function for the thread.
+        profile = self._profile_class()
+        try:
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12 there can only be one profiler at a time, and
+            # it already profiles every thread. Remove this function so that
+            # it isn't called again for every event in the thread.
+            sys.setprofile(None)
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    def start(self):
+        threading.setprofile(self._profile_thread)
+        self._profile_thread()
+
+    def checkpoint(self, label):
+        """ The CPU profile covers the whole run, so this does nothing. """
+
+    def stop(self):
+        """ Stop profiling and write the stats from all the threads. """
+        import pstats
+
+        threading.setprofile(None)
+        with self._lock:
+            profiles = list(self._profiles)
+        # Creating the stats disables the profiler
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # A profiler that was never enabled has no stats
+                pass
+        stats.dump_stats(self.path)
+
+
+class MemoryProfiler(object):
+    """
+    Traces memory allocations with tracemalloc, and lists the lines that
+    allocated the most memory that is still in use at each checkpoint, and
+    what changed since the previous checkpoint.
+    """
+
+    def __init__(self, path, top=DEFAULT_TOP, frames=1):
+        """
+        :param path: The path to write the report to.
+        :param top: The number of lines to list for each checkpoint.
+        :param frames: The number of frames of each traceback to keep.
+        """
+        import tracemalloc
+
+        self.path = path
+        self.top = top
+        self.frames = frames
+        self._tracemalloc = tracemalloc
+        self._snapshot = None
+        self._checkpoints = 0
+        self._lines = []
+
+    def start(self):
+        self._tracemalloc.start(self.frames)
+
+    def checkpoint(self, label):
+        """ Take a snapshot and add its top lines to the report. """
+        tracemalloc = self._tracemalloc
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        self._checkpoints += 1
+        self._lines.extend([
+            '=== %d. %s ===' % (self._checkpoints, label),
+            'Current: %d bytes, peak: %d bytes' % (current, peak),
+            '',
+            'Top %d lines:' % (self.top,),
+        ])
+        self._lines.extend(
+            str(stat) for stat in snapshot.statistics('lineno')[:self.top])
+        if self._snapshot is not None:
+            self._lines.extend(['', 'Top %d changes:' % (self.top,)])
+            self._lines.extend(
+                str(stat) for stat in
+                snapshot.compare_to(self._snapshot, 'lineno')[:self.top])
+        self._lines.append('')
+        self._snapshot = snapshot
+
+    def stop(self):
+        """ Take a final snapshot, stop tracing and write the report. """
+        self.checkpoint('end')
+        self._tracemalloc.stop()
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(self._lines))
+
+
+def make_profiler(kind, path=None):
+    """
+    Create a profiler.
+
+    :param kind: 'cpu' or 'mem'.
+    :param path:
+        The path to write the profile to, or None for
+        'docker-ci-deploy.<kind>.prof' (or '.txt' for the memory report) in
+        the current directory.
+    """
+    if kind == 'cpu':
+        return CpuProfiler(path or 'docker-ci-deploy.cpu.prof')
+    if kind == 'mem':
+        if sys.version_info < (3, 4):
+            raise ValueError('Memory profiling requires Python 3.4 or later')
+        return MemoryProfiler(path or 'docker-ci-deploy.mem.txt')
+    raise ValueError('Unknown kind of profiler: %s' % (kind,))
@@ -0,0 +1,726 @@
+# -*- coding: utf-8 -*-
+"""
+A minimal client for the Docker Registry HTTP API V2.
+https://docs.docker.com/registry/spec/api/
+"""
+import base64
+import json
+import os
+import re
+import select
+import socket
+import subprocess
+import threading
+import time
+
+try:
+    from http.client import BadStatusLine, HTTPConnection, HTTPSConnection
+except ImportError:  # pragma: no cover
+    from httplib import (  # Python 2
+        BadStatusLine, HTTPConnection, HTTPSConnection)
+
+try:
+    from urllib.parse import urlencode, urlsplit
+except ImportError:  # pragma: no cover
+    from urllib import urlencode  # Python 2
+    from urlparse import urlsplit
+
+DEFAULT_DOMAIN = 'docker.io'
+# The registry API for Docker Hub isn't served from the domain in image names
+DEFAULT_REGISTRY_HOST = 'registry-1.docker.io'
+OFFICIAL_REPO_PREFIX = 'library/'
+
+# The default maximum number of connections to each registry host
+DEFAULT_MAX_CONNECTIONS = 8
+# The default number of seconds to wait to connect to a registry, or for it
+# to send or accept any data
+DEFAULT_TIMEOUT = 120
+# The requests that can be made again if the connection fails partway
+# through, because making them twice does the same as making them once
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+# The lifetime of a bearer token if the token server doesn't give one
+DEFAULT_TOKEN_LIFETIME = 60
+# Tokens are renewed this many seconds (or half their lifetime, if that is
+# less) before they expire, so that they don't expire during a request
+TOKEN_EXPIRY_MARGIN = 30
+
+MANIFEST_MEDIA_TYPES = (
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+)
+
+
+class RegistryError(Exception):
+    """ An error response was received from a registry. """
+
+    def __init__(self, method, url, status, body=b''):
+        super(RegistryError, self).__init__(
+            '%s %s failed with status %d: %s' % (
+                method, url, status, body.decode('utf-8', 'replace')))
+        self.status = status
+
+
+def split_repository(name):
+    """
+    Split an image name (without a tag) into the address of the registry it
+    is stored in and the repository path within that registry, following the
+    same rules as the Docker client.
+    e.g. 'registry:5000/user/name' => ('registry:5000', 'user/name')
+         'user/name' => ('docker.io', 'user/name')
+         'name' => ('docker.io', 'library/name')
+    """
+    parts = name.split('/', 1)
+    if len(parts) == 2 and (
+            '.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+        return parts[0], parts[1]
+
+    if len(parts) == 1:
+        return DEFAULT_DOMAIN, OFFICIAL_REPO_PREFIX + name
+    return DEFAULT_DOMAIN, name
+
+
+def registry_host(domain):
+    """ Get the host that serves the registry API for an image domain. """
+    if domain == DEFAULT_DOMAIN:
+        return DEFAULT_REGISTRY_HOST
+    return domain
+
+
+def docker_config_path():
+    """ Get the path to the Docker client's config file. """
+    config_dir = os.environ.get('DOCKER_CONFIG')
+    if config_dir is None:
+        config_dir = os.path.join(os.path.expanduser('~'), '.docker')
+    return os.path.join(config_dir, 'config.json')
+
+
+def _load_docker_config(config_path=None):
+    if config_path is None:
+        config_path = docker_config_path()
+    try:
+        with open(config_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _config_keys(domain):
+    """
+    Get the keys that a registry's credentials may be stored under in the
+    Docker client's config file, in order of preference.
+    """
+    keys = [domain]
+    if domain == DEFAULT_DOMAIN:
+        keys = ['https://index.docker.io/v1/', 'index.docker.io', domain]
+    for key in list(keys):
+        keys.extend(['https://' + key, 'http://' + key])
+    return keys
+
+
+def run_credential_helper(helper, server_url):
+    """
+    Get the credentials for a registry from a Docker credential helper, i.e.
+    by running ``docker-credential-<helper> get``.
+
+    :return: A (username, password) tuple or None if there are none.
+    """
+    try:
+        process = subprocess.Popen(
+            ['docker-credential-' + helper, 'get'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    out, _ = process.communicate(server_url.encode('utf-8'))
+    if process.returncode != 0:
+        return None
+    try:
+        response = json.loads(out.decode('utf-8'))
+        return response['Username'], response['Secret']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def _config_credentials(config, domain):
+    keys = _config_keys(domain)
+    helpers = config.get('credHelpers', {})
+    helper = next((helpers[key] for key in keys if key in helpers),
+                  config.get('credsStore'))
+    if helper:
+        credentials = run_credential_helper(helper, keys[0])
+        if credentials is not None:
+            return credentials
+
+    auths = config.get('auths', {})
+    for key in keys:
+        auth = auths.get(key, {}).get('auth')
+        if auth:
+            username, _, password = (
+                base64.b64decode(auth).decode('utf-8').partition(':'))
+            return username, password
+    return None
+
+
+def load_basic_credentials(domain, config_path=None):
+    """
+    Read the username and password stored by ``docker login`` for a registry
+    from the Docker client's config file, or from the credential helper the
+    config file names for the registry.
+
+    :return: A (username, password) tuple or None if there are none.
+    """
+    return _config_credentials(_load_docker_config(config_path), domain)
+
+
+class CredentialStore(object):
+    """
+    The credentials stored by ``docker login``, looked up at most once for
+    each registry. Looking up credentials can mean running a credential
+    helper, which may itself make requests (e.g. to a cloud provider's API),
+    so a store is shared by everything that talks to registries in a run.
+    """
+
+    def __init__(self, config_path=None):
+        """
+        :param config_path:
+            The path to the Docker client's config file, or None for the
+            default path.
+        """
+        self.config_path = config_path
+        self._config = None
+        self._credentials = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, domain):
+        """
+        Get the credentials for a registry.
+
+        :return: A (username, password) tuple or None if there are none.
+        """
+        with self._lock:
+            if self._config is None:
+                self._config = _load_docker_config(self.config_path)
+            # Looking up one registry's credentials doesn't hold up others
+            lock = self._locks.setdefault(domain, threading.Lock())
+        with lock:
+            if domain not in self._credentials:
+                self._credentials[domain] = _config_credentials(
+                    self._config, domain)
+            return self._credentials[domain]
+
+
+def parse_auth_challenge(header):
+    """
+    Parse a ``WWW-Authenticate`` header into the scheme and its parameters.
+    e.g. 'Bearer realm="https://auth",service="reg"' =>
+         ('bearer', {'realm': 'https://auth', 'service': 'reg'})
+    """
+    scheme, _, params = header.strip().partition(' ')
+    return scheme.lower(), dict(
+        re.findall(r'(\w+)="([^"]*)"', params))
+
+
+class ConnectionPool(object):
+    """
+    A pool of persistent (keep-alive) HTTP connections to each host, so that
+    requests don't each pay for a new TCP connection and TLS handshake. The
+    number of connections to each host is bounded, and threads wait for a
+    connection to be free once the limit is reached. The pool can be shared
+    by any number of threads.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, tracer=None,
+                 timeout=DEFAULT_TIMEOUT):
+        """
+        :param max_connections:
+            The maximum number of connections to each host, whether in use or
+            idle.
+        :param tracer:
+            A TraceRecorder to record each request in as a span, or None.
+        :param timeout:
+            The number of seconds to wait to connect, or for the server to
+            send or accept any data, before giving up on a request.
+        """
+        self.max_connections = max_connections
+        self.tracer = tracer
+        self.timeout = timeout
+        # The idle connections and number of open connections for each
+        # (scheme, host) pair
+        self._idle = {}
+        self._open = {}
+        self._condition = threading.Condition()
+        self._stats = {
+            'requests': 0, 'connections': 0, 'reused': 0, 'retries': 0}
+
+    def stats(self):
+        """
+        Get the numbers of requests made, connections opened, requests that
+        reused an open connection, and requests retried, or moved to another
+        connection, because an idle connection had been closed.
+        """
+        with self._condition:
+            return dict(self._stats)
+
+    def _acquire(self, key):
+        """
+        Get an idle connection to a host, or a new one if there are fewer
+        than the maximum.
+
+        :return: A (connection, reused) pair.
+        """
+        with self._condition:
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    connection = idle.pop()
+                    if not is_dropped(connection):
+                        return connection, True
+                    # Closed by the server while idle, so nothing was sent
+                    self._open[key] -= 1
+                    self._stats['retries'] += 1
+                    connection.close()
+                    continue
+                if self._open.get(key, 0) < self.max_connections:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    self._stats['connections'] += 1
+                    break
+                self._condition.wait()
+
+        scheme, host = key
+        connection_class = (
+            HTTPSConnection if scheme == 'https' else HTTPConnection)
+        return connection_class(host, timeout=self.timeout), False
+
+    def _release(self, key, connection, reusable):
+        with self._condition:
+            if reusable:
+                self._idle.setdefault(key, []).append(connection)
+            else:
+                self._open[key] -= 1
+            self._condition.notify()
+        if not reusable:
+            connection.close()
+
+    def request(self, url, method='GET', body=None, headers={}):
+        """
+        Make an HTTP request, reading the whole response.
+
+        :return: A (status, headers, body) tuple. Header names are lowercase.
+        """
+        if self.tracer is None:
+            return self._request(url, method, body, headers)
+        with self.tracer.span(
+                '%s %s' % (method, urlsplit(url).path), 'registry',
+                url=url) as details:
+            response = self._request(url, method, body, headers)
+            details['status'] = response[0]
+            return response
+
+    def _request(self, url, method, body, headers):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        connection, reused = self._acquire(key)
+        while True:
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response_body = response.read()
+            except (BadStatusLine, socket.error):
+                self._release(key, connection, False)
+                # The server may have closed the idle connection before the
+                # request arrived, but it may also have received it, so only
+                # make the request again if that's safe
+                if not reused or method not in IDEMPOTENT_METHODS:
+                    raise
+                with self._condition:
+                    self._stats['retries'] += 1
+                connection, reused = self._acquire(key)
+                continue
+            except BaseException:
+                self._release(key, connection, False)
+                raise
+            break
+
+        with self._condition:
+            self._stats['requests'] += 1
+            self._stats['reused'] += 1 if reused else 0
+        self._release(key, connection, not response.will_close)
+        response_headers = dict(
+            (k.lower(), v) for k, v in response.getheaders())
+        return response.status, response_headers, response_body
+
+    def close(self):
+        """ Close the idle connections. """
+        with self._condition:
+            idle = [connection for connections in self._idle.values()
+                    for connection in connections]
+            for key, connections in self._idle.items():
+                self._open[key] -= len(connections)
+            self._idle = {}
+        for connection in idle:
+            connection.close()
+
+
+def is_dropped(connection):
+    """
+    Check whether an idle connection has been closed by the server. There is
+    nothing for the client to read from an idle connection unless it has
+    been closed (or the server sent something unexpected), either of which
+    makes it unusable.
+    """
+    if connection.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (ValueError, select.error):
+        return True
+    return bool(readable)
+
+
+def _location_path(location):
+    """
+    Get the path, relative to '/v2/', that a ``Location`` header refers to.
+    The header may be an absolute URL or just a path.
+    e.g. 'http://reg/v2/name/blobs/uploads/a?b=c' => 'name/blobs/uploads/a?b=c'
+    """
+    url = urlsplit(location)
+    path = url.path.split('/v2/', 1)[1]
+    if url.query:
+        path += '?' + url.query
+    return path
+
+
+def _next_page_path(link):
+    """
+    Get the path, relative to '/v2/', of the next page from a ``Link`` header.
+    e.g. '</v2/name/tags/list?n=2&last=b>; rel="next"' =>
+         'name/tags/list?n=2&last=b'
+    """
+    if link is None:
+        return None
+    match = re.match(r'\s*<([^>]*)>\s*;\s*rel="?next"?', link)
+    if match is None:
+        return None
+    return _location_path(match.group(1))
+
+
+class RegistryClient(object):
+    """
+    A client for a single registry. Authenticates with the credentials stored
+    by ``docker login``, using bearer tokens if the registry asks for them.
+    Once the registry has asked for a bearer token, tokens for each scope are
+    fetched before making requests, and renewed shortly before they expire,
+    rather than waiting for the registry to reject a request.
+    """
+
+    def __init__(self, domain, secure=True, credentials=None, pool=None,
+                 credential_store=None):
+        """
+        :param domain: The registry address, as used in image names.
+        :param secure: If False, use plain HTTP rather than HTTPS.
+        :param credentials:
+            A (username, password) tuple. If None, the credentials are read
+            from the Docker client's config file.
+        :param pool:
+            The ConnectionPool to make requests with, which may be shared
+            with other clients. If None, the client has its own pool.
+        :param credential_store:
+            The CredentialStore to look up the credentials in if none are
+            given, which may be shared with other clients.
+        """
+        self.domain = domain
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.base_url = '%s://%s' % (
+            'https' if secure else 'http', registry_host(domain))
+        if credentials is None:
+            if credential_store is None:
+                credential_store = CredentialStore()
+            credentials = credential_store.get(domain)
+        self._credentials = credentials
+        # scope => (token, time to renew it)
+        self._tokens = {}
+        # The realm and service of the registry's last bearer challenge
+        self._bearer_params = None
+        # scope => the lock held while fetching a token for it
+        self._token_locks = {}
+        self._tokens_lock = threading.Lock()
+
+    def _basic_auth_header(self):
+        if self._credentials is None:
+            return None
+        return 'Basic ' + base64.b64encode(
+            ':'.join(self._credentials).encode('utf-8')).decode('ascii')
+
+    def _fetch_token(self, params):
+        query = dict((k, params[k]) for k in ('service', 'scope')
+                     if k in params)
+        url = params['realm']
+        if query:
+            url += '?' + urlencode(query)
+
+        headers = {}
+        basic_auth = self._basic_auth_header()
+        if basic_auth is not None:
+            headers['Authorization'] = basic_auth
+
+        # Measure the token's lifetime from before it was requested rather
+        # than from its issued_at time, so that clock skew doesn't matter
+        requested = time.time()
+        status, _, body = self.pool.request(url, headers=headers)
+        if status != 200:
+            raise RegistryError('GET', url, status, body)
+        response = json.loads(body.decode('utf-8'))
+        token = response.get('token') or response['access_token']
+        lifetime = response.get('expires_in') or DEFAULT_TOKEN_LIFETIME
+        return token, requested + lifetime - min(
+            TOKEN_EXPIRY_MARGIN, lifetime / 2.0)
+
+    def _token(self, params, rejected=None):
+        """
+        Get a bearer token for a scope, fetching a new one if there is none
+        for the scope yet, it will soon expire, or it was just rejected.
+        """
+        scope = params.get('scope')
+        with self._tokens_lock:
+            # Fetching a token for one scope doesn't hold up others
+            lock = self._token_locks.setdefault(scope, threading.Lock())
+        with lock:
+            token, renew_at = self._tokens.get(scope, (None, 0))
+            if (token is None or 'Bearer ' + token == rejected or
+                    time.time() >= renew_at):
+                token, renew_at = self._fetch_token(params)
+                self._tokens[scope] = (token, renew_at)
+            return token
+
+    def _authorization(self, challenge, rejected=None):
+        """
+        Get the Authorization header value to answer a challenge with, or None
+        if there is no point in retrying the request.
+
+        :param rejected: The Authorization value that was just rejected.
+        """
+        scheme, params = parse_auth_challenge(challenge)
+        if scheme == 'basic':
+            authorization = self._basic_auth_header()
+        elif scheme == 'bearer':
+            self._bearer_params = dict(
+                (k, v) for k, v in params.items() if k != 'scope')
+            authorization = 'Bearer ' + self._token(params, rejected)
+        else:
+            return None
+
+        if authorization == rejected:
+            return None
+        return authorization
+
+    def request(self, method, path, body=None, headers={}, scope=None):
+        """
+        Make a request to the registry API, authenticating if required.
+
+        :param path: The path of the request, relative to '/v2/'.
+        :return: A (status, headers, body) tuple.
+        """
+        url = '%s/v2/%s' % (self.base_url, path)
+        request_headers = dict(headers)
+        if scope is not None and self._bearer_params is not None:
+            request_headers['Authorization'] = 'Bearer ' + self._token(
+                dict(self._bearer_params, scope=scope))
+
+        status, response_headers, response_body = self.pool.request(
+            url, method, body, request_headers)
+
+        challenge = response_headers.get('www-authenticate')
+        if status == 401 and challenge:
+            authorization = self._authorization(
+                challenge, request_headers.get('Authorization'))
+            if authorization is not None:
+                request_headers['Authorization'] = authorization
+                status, response_headers, response_body = self.pool.request(
+                    url, method, body, request_headers)
+
+        if status >= 400:
+            raise RegistryError(method, url, status, response_body)
+        return status, response_headers, response_body
+
+    def get_manifest(self, repository, reference):
+        """
+        Fetch an image manifest.
+
+        :return: A (media type, raw manifest bytes, digest) tuple.
+        """
+        _, headers, body = self.request(
+            'GET', '%s/manifests/%s' % (repository, reference),
+            headers={'Accept': ', '.join(MANIFEST_MEDIA_TYPES)},
+            scope='repository:%s:pull' % (repository,))
+        return (headers.get('content-type'), body,
+                headers.get('docker-content-digest'))
+
+    def manifest_digest(self, repository, reference):
+        """
+        Get the digest of an image manifest without fetching the manifest.
+
+        :return: The digest, or None if there is no such manifest.
+        """
+        try:
+            _, headers, _ = self.request(
+                'HEAD', '%s/manifests/%s' % (repository, reference),
+                headers={'Accept': ', '.join(MANIFEST_MEDIA_TYPES)},
+                scope='repository:%s:pull' % (repository,))
+        except RegistryError as e:
+            if e.status == 404:
+                return None
+            raise
+        return headers.get('docker-content-digest')
+
+    def list_tags(self, repository, page_size=1000):
+        """
+        List all the tags in a repository, following pagination links.
+
+        :return: The list of tags, which is empty if the repository doesn't
+            exist.
+        """
+        tags = []
+        path = '%s/tags/list?n=%d' % (repository, page_size)
+        while path is not None:
+            try:
+                _, headers, body = self.request(
+                    'GET', path, scope='repository:%s:pull' % (repository,))
+            except RegistryError as e:
+                if e.status == 404:
+                    break
+                raise
+            tags.extend(json.loads(body.decode('utf-8')).get('tags') or [])
+            path = _next_page_path(headers.get('link'))
+        return tags
+
+    def put_manifest(self, repository, reference, media_type, manifest):
+        """ Upload an image manifest, e.g. to add a tag to an image. """
+        self.request(
+            'PUT', '%s/manifests/%s' % (repository, reference),
+            body=manifest, headers={'Content-Type': media_type},
+            scope='repository:%s:pull,push' % (repository,))
+
+    def blob_exists(self, repository, digest):
+        """ Check whether a repository already has a blob. """
+        try:
+            self.request('HEAD', '%s/blobs/%s' % (repository, digest),
+                         scope='repository:%s:pull' % (repository,))
+        except RegistryError as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
+    def mount_blob(self, repository, digest, from_repository):
+        """
+        Add a blob that another repository in the registry has to a
+        repository, without uploading it again.
+
+        :return:
+            True if the blob was mounted, or False if the registry couldn't
+            mount it, e.g. because the other repository doesn't have it.
+        """
+        status, _, _ = self.request(
+            'POST', '%s/blobs/uploads/?%s' % (repository, urlencode(
+                [('mount', digest), ('from', from_repository)])),
+            scope='repository:%s:pull,push' % (repository,))
+        # Otherwise the registry starts an ordinary upload, which is left to
+        # expire
+        return status == 201
+
+    def upload_blob(self, repository, digest, data, chunk_size=None,
+                    location=None, progress=None):
+        """
+        Upload a blob, either in a single request or in chunks. A chunked
+        upload can be resumed from where an earlier, interrupted upload of the
+        same blob stopped.
+
+        :param data:
+            The blob's content, as a bytes-like object such as a memoryview of
+            a memory-mapped file, so that it is sent without being copied.
+        :param chunk_size:
+            The number of bytes to upload in each request, or None to upload
+            the whole blob in one request.
+        :param location:
+            The location of an earlier chunked upload session to resume, if
+            the registry still has it.
+        :param progress:
+            A function called with the upload session's location and the
+            number of bytes the registry has received after each chunk.
+        :return:
+            The byte that the upload started from: where the registry said an
+            earlier upload stopped when it was resumed, otherwise 0.
+        """
+        scope = 'repository:%s:pull,push' % (repository,)
+        offset = 0
+        if chunk_size is not None and location is not None:
+            location, offset = self._upload_status(location, scope)
+        else:
+            location = None
+        if location is None:
+            _, headers, _ = self.request(
+                'POST', '%s/blobs/uploads/' % (repository,), scope=scope)
+            location = headers['location']
+
+        start = offset
+        body = data
+        if chunk_size is not None:
+            size = len(data)
+            while offset < size:
+                end = min(offset + chunk_size, size)
+                chunk = data[offset:end]
+                try:
+                    _, headers, _ = self.request(
+                        'PATCH', _location_path(location), body=chunk,
+                        headers={
+                            'Content-Type': 'application/octet-stream',
+                            'Content-Range': '%d-%d' % (offset, end - 1),
+                        }, scope=scope)
+                finally:
+                    # A slice of a memory-mapped file must be released
+                    # before the mapping can be closed, even when a failed
+                    # request's traceback still refers to it
+                    if hasattr(chunk, 'release'):
+                        chunk.release()
+                location = headers.get('location') or location
+                offset = end
+                if progress is not None:
+                    progress(location, offset)
+            body = b''
+
+        path = _location_path(location)
+        path += '&' if '?' in path else '?'
+        self.request(
+            'PUT', path + urlencode({'digest': digest}), body=body,
+            headers={'Content-Type': 'application/octet-stream'},
+            scope=scope)
+        return start
+
+    def _upload_status(self, location, scope):
+        """
+        Find out how much of a blob an upload session has received.
+
+        :return:
+            A (location, offset) tuple, where the location is None if the
+            upload can't be resumed.
+        """
+        try:
+            _, headers, _ = self.request(
+                'GET', _location_path(location), scope=scope)
+        except RegistryError as e:
+            if e.status == 404:
+                return None, 0
+            raise
+        match = re.match(r'^(?:bytes=)?0-(\d+)$', headers.get('range', ''))
+        # Some registries report "0-0" before anything has been received,
+        # which is ambiguous, so start again rather than risk a gap
+        if match is None or int(match.group(1)) == 0:
+            return None, 0
+        return headers.get('location') or location, int(match.group(1)) + 1
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-ins for the services that docker-ci-deploy talks to, shared by the
+tests and the benchmarks.
+"""
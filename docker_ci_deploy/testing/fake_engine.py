@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+A small in-memory stand-in for the Docker daemon, implementing just enough of
+the Docker Engine API over a unix socket for testing.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler  # Python 2
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+try:
+    from urllib.parse import parse_qs, unquote, urlsplit
+except ImportError:  # pragma: no cover
+    from urllib import unquote  # Python 2
+    from urlparse import parse_qs, urlsplit
+
+from docker_ci_deploy.testing.fake_registry import NO_FAULTS
+
+
+class _ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class FakeDockerEngine(object):
+    """
+    A Docker daemon listening on a unix socket on a background thread.
+    Requests made to it are recorded in ``requests`` as (method, path, query)
+    tuples and the number of connections made is counted in ``connections``.
+    """
+
+    def __init__(self, socket_path, images=(), faults=NO_FAULTS,
+                 drop_connections=False, drop_requests=False):
+        """
+        :param socket_path: The path to create the socket at.
+        :param images: Image tags that exist to start with.
+        :param faults: The Faults to inject into responses.
+        :param drop_connections:
+            If True, close each connection after one response without telling
+            the client, like a daemon whose keep-alive timeout has passed.
+        :param drop_requests:
+            If True, close each connection on receiving a second request on
+            it, without answering, like a daemon whose keep-alive timeout
+            passes just as the request arrives.
+        """
+        self.socket_path = socket_path
+        self.faults = faults
+        self.drop_connections = drop_connections
+        self.drop_requests = drop_requests
+        self.images = dict(
+            (image, 'sha256:' + hashlib.sha256(image.encode('utf-8'))
+             .hexdigest())
+            for image in images)
+        # Maps 'name@digest' references to image IDs
+        self.repo_digests = {}
+        self.requests = []
+        self.connections = 0
+        self.registry_auths = []
+        self._lock = threading.Lock()
+
+        # A class statement, as type() can't subclass Python 2's classic
+        # BaseHTTPRequestHandler
+        class Handler(_EngineHandler):
+            engine = self
+        self._server = _ThreadingUnixServer(socket_path, Handler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.01})
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        os.remove(self.socket_path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _normalize(image):
+    if re.search(r':[^/]+$', image) is None:
+        return image + ':latest'
+    return image
+
+
+class _EngineHandler(BaseHTTPRequestHandler):
+    engine = None
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.answered = 0
+        with self.engine._lock:
+            self.engine.connections += 1
+
+    def end_headers(self):
+        BaseHTTPRequestHandler.end_headers(self)
+        self.answered += 1
+        if self.engine.drop_connections:
+            self.close_connection = True
+
+    def _drop_request(self):
+        """ Close the connection without answering, if it should be. """
+        if self.engine.drop_requests and self.answered:
+            self.close_connection = True
+            return True
+        return False
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, messages):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for message in messages:
+            data = json.dumps(message).encode('utf-8') + b'\r\n'
+            self.wfile.write(b'%x\r\n' % (len(data),) + data + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_GET(self):
+        engine = self.engine
+        url = urlsplit(self.path)
+        with engine._lock:
+            engine.requests.append(('GET', url.path, {}))
+        if self._drop_request():
+            return
+
+        match = re.match(r'^/images/(.+)/json$', url.path)
+        if match is None:
+            return self._send_json(404, {'message': 'page not found'})
+
+        image = unquote(match.group(1))
+        with engine._lock:
+            image_id = engine.images.get(_normalize(image))
+            repo_digests = [
+                digest for digest, digest_id in engine.repo_digests.items()
+                if digest_id == image_id]
+        if image_id is None:
+            return self._send_json(
+                404, {'message': 'No such image: %s' % (image,)})
+        self._send_json(200, {'Id': image_id, 'RepoDigests': repo_digests})
+
+    def do_POST(self):
+        engine = self.engine
+        url = urlsplit(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        with engine._lock:
+            engine.requests.append(('POST', url.path, query))
+        if self._drop_request():
+            return
+
+        if engine.faults.inject():
+            return self._send_json(500, {'message': 'injected failure'})
+
+        match = re.match(r'^/images/(.+)/(tag|push)$', url.path)
+        if match is None:
+            return self._send_json(404, {'message': 'page not found'})
+
+        name, action = unquote(match.group(1)), match.group(2)
+        if action == 'tag':
+            return self._tag(name, query)
+        return self._push(name, query)
+
+    def _tag(self, image, query):
+        engine = self.engine
+        with engine._lock:
+            image_id = engine.images.get(_normalize(image))
+            if image_id is None:
+                return self._send_json(
+                    404, {'message': 'No such image: %s' % (image,)})
+            target = query['repo'] + ':' + query.get('tag', 'latest')
+            engine.images[target] = image_id
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _push(self, name, query):
+        engine = self.engine
+        tag = query.get('tag', 'latest')
+        image = '%s:%s' % (name, tag)
+        with engine._lock:
+            engine.registry_auths.append(
+                self.headers.get('X-Registry-Auth'))
+            image_id = engine.images.get(image)
+
+        messages = [{
+            'status': 'The push refers to repository [%s]' % (name,)}]
+        if image_id is None:
+            messages.append({
+                'errorDetail': {'message': 'tag does not exist: ' + image},
+                'error': 'An image does not exist locally with the tag: ' +
+                         name,
+            })
+            return self._send_stream(messages)
+
+        layer = image_id[7:19]
+        messages.extend([
+            {'status': 'Preparing', 'progressDetail': {}, 'id': layer},
+            {'status': 'Pushing', 'id': layer,
+             'progressDetail': {'current': 512, 'total': 1024}},
+            {'status': 'Pushed', 'progressDetail': {}, 'id': layer},
+            {'status': '%s: digest: %s size: 528' % (tag, image_id)},
+            {'progressDetail': {}, 'aux': {
+                'Tag': tag, 'Digest': image_id, 'Size': 528}},
+        ])
+        self._send_stream(messages)
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+A small in-memory stand-in for a Docker registry, implementing just enough of
+the Registry HTTP API V2 for testing.
+"""
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # Python 2
+    from SocketServer import ThreadingMixIn
+
+try:
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:  # pragma: no cover
+    from urlparse import parse_qs, urlsplit  # Python 2
+
+MANIFEST_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+
+
+def make_manifest(config=b'{}', layers=()):
+    """ Make a minimal schema 2 image manifest for some content. """
+    def descriptor(media_type, data):
+        return {
+            'mediaType': media_type,
+            'size': len(data),
+            'digest': 'sha256:' + hashlib.sha256(data).hexdigest(),
+        }
+
+    return json.dumps({
+        'schemaVersion': 2,
+        'mediaType': MANIFEST_TYPE,
+        'config': descriptor(
+            'application/vnd.docker.container.image.v1+json', config),
+        'layers': [
+            descriptor('application/vnd.docker.image.rootfs.diff.tar.gzip',
+                       layer)
+            for layer in layers],
+    }, sort_keys=True).encode('utf-8')
+
+
+class Faults(object):
+    """
+    Latency and failures to inject into the responses of a fake server.
+    """
+
+    def __init__(self, latency=0, jitter=0, failure_rate=0, seed=None):
+        """
+        :param latency: The delay, in seconds, before each response.
+        :param jitter:
+            The maximum random amount, in seconds, to add to or subtract from
+            the latency.
+        :param failure_rate:
+            The fraction of requests that should fail with an error.
+        :param seed: The seed for the random number generator.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def inject(self):
+        """
+        Delay the calling thread and return True if the request should fail.
+        """
+        with self._lock:
+            delay = self.latency + self._random.uniform(
+                -self.jitter, self.jitter)
+            fail = self._random.random() < self.failure_rate
+        if delay > 0:
+            time.sleep(delay)
+        return fail
+
+
+NO_FAULTS = Faults()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeRegistry(object):
+    """
+    A registry server running on a background thread on localhost. Requests
+    made to it are recorded in ``requests`` as (method, path) tuples.
+    """
+
+    def __init__(self, auth=None, credentials=('user', 'pass'),
+                 faults=NO_FAULTS, drop_connections=False,
+                 drop_requests=False, token_lifetime=None):
+        """
+        :param auth:
+            None for no authentication, or 'basic' or 'bearer' to require that
+            kind of authentication.
+        :param credentials:
+            The (username, password) tuple clients must authenticate with.
+        :param faults: The Faults to inject into responses.
+        :param drop_connections:
+            If True, close each connection after one response without telling
+            the client, like a server whose keep-alive timeout has passed.
+        :param drop_requests:
+            If True, close each connection on receiving a second request on
+            it, without answering, like a server whose keep-alive timeout
+            passes just as the request arrives.
+        :param token_lifetime:
+            The ``expires_in`` time to give bearer tokens, if any.
+        """
+        self.auth = auth
+        self.credentials = credentials
+        self.faults = faults
+        self.drop_connections = drop_connections
+        self.drop_requests = drop_requests
+        self.token_lifetime = token_lifetime
+        self.manifests = {}
+        self.blobs = {}
+        self.uploads = {}
+        self.requests = []
+        self.tokens_issued = 0
+        self._lock = threading.Lock()
+
+        # A class statement, as type() can't subclass Python 2's classic
+        # BaseHTTPRequestHandler
+        class Handler(_RegistryHandler):
+            registry = self
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.domain = '127.0.0.1:%d' % (self._server.server_address[1],)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.01})
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_manifest(self, repository, tag, manifest,
+                     media_type=MANIFEST_TYPE):
+        """ Store a manifest as if it had been pushed. """
+        digest = 'sha256:' + hashlib.sha256(manifest).hexdigest()
+        with self._lock:
+            self.manifests[(repository, digest)] = (media_type, manifest)
+            self.manifests[(repository, tag)] = (media_type, manifest)
+        return digest
+
+    def add_blob(self, repository, data):
+        """ Store a blob as if it had been uploaded. """
+        digest = 'sha256:' + hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self.blobs[(repository, digest)] = data
+        return digest
+
+    def get_blob(self, repository, digest):
+        with self._lock:
+            return self.blobs.get((repository, digest))
+
+    def tags(self, repository):
+        with self._lock:
+            return sorted(
+                reference for repo, reference in self.manifests
+                if repo == repository and not reference.startswith('sha256:'))
+
+    def get_manifest(self, repository, reference):
+        with self._lock:
+            return self.manifests.get((repository, reference))
+
+    def _basic_auth(self):
+        return 'Basic ' + base64.b64encode(
+            ':'.join(self.credentials).encode('utf-8')).decode('ascii')
+
+
+class _RegistryHandler(BaseHTTPRequestHandler):
+    registry = None
+    protocol_version = 'HTTP/1.1'
+    # The number of responses sent on the connection
+    answered = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b'', headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self.answered += 1
+        if self.registry.drop_connections:
+            self.close_connection = True
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def _authorized(self, scope):
+        registry = self.registry
+        authorization = self.headers.get('Authorization')
+        if registry.auth is None:
+            return True
+        if registry.auth == 'basic':
+            if authorization == registry._basic_auth():
+                return True
+            challenge = 'Basic realm="fake"'
+        else:
+            if authorization == 'Bearer token-for-' + scope:
+                return True
+            challenge = (
+                'Bearer realm="http://%s/token",service="fake",scope="%s"' %
+                (registry.domain, scope))
+        self._read_body()
+        self._send(401, b'{"errors": [{"code": "UNAUTHORIZED"}]}',
+                   {'WWW-Authenticate': challenge})
+        return False
+
+    def _handle(self):
+        registry = self.registry
+        url = urlsplit(self.path)
+        with registry._lock:
+            registry.requests.append((self.command, url.path))
+
+        if registry.drop_requests and self.answered:
+            self._read_body()
+            self.close_connection = True
+            return
+
+        if registry.faults.inject():
+            self._read_body()
+            return self._send(503, b'{"errors": [{"code": "UNAVAILABLE"}]}')
+
+        if url.path == '/token':
+            return self._token(parse_qs(url.query))
+
+        match = re.match(r'^/v2/(.+)/tags/list$', url.path)
+        if match is not None:
+            repository = match.group(1)
+            if self._authorized('repository:%s:pull' % (repository,)):
+                self._tags_list(repository, parse_qs(url.query))
+            return
+
+        for pattern, handle in [
+                (r'^/v2/(.+)/manifests/([^/]+)$', self._manifest),
+                (r'^/v2/(.+)/blobs/uploads/([^/]*)$', self._upload),
+                (r'^/v2/(.+)/blobs/([^/]+)$', self._blob)]:
+            match = re.match(pattern, url.path)
+            if match is not None:
+                break
+        else:
+            self._read_body()
+            return self._send(404)
+
+        repository, reference = match.groups()
+        if self.command in ('GET', 'HEAD'):
+            scope = 'repository:%s:pull' % (repository,)
+        else:
+            scope = 'repository:%s:pull,push' % (repository,)
+        if not self._authorized(scope):
+            return
+        return handle(repository, reference, parse_qs(url.query))
+
+    def _tags_list(self, repository, query):
+        tags = self.registry.tags(repository)
+        if not tags:
+            return self._send(404, b'{"errors": [{"code": "NAME_UNKNOWN"}]}')
+
+        last = query.get('last', [None])[0]
+        if last is not None:
+            tags = [tag for tag in tags if tag > last]
+        headers = {}
+        if 'n' in query:
+            n = int(query['n'][0])
+            if len(tags) > n:
+                tags = tags[:n]
+                headers['Link'] = (
+                    '</v2/%s/tags/list?n=%d&last=%s>; rel="next"' %
+                    (repository, n, tags[-1]))
+        self._send(200, json.dumps(
+            {'name': repository, 'tags': tags}).encode('utf-8'), headers)
+
+    def _token(self, query):
+        registry = self.registry
+        if (registry.auth == 'bearer' and
+                self.headers.get('Authorization') != registry._basic_auth()):
+            return self._send(401)
+        with registry._lock:
+            registry.tokens_issued += 1
+        scope = query.get('scope', [''])[0]
+        response = {'token': 'token-for-' + scope}
+        if registry.token_lifetime is not None:
+            response['expires_in'] = registry.token_lifetime
+        self._send(200, json.dumps(response).encode('utf-8'))
+
+    def _manifest(self, repository, reference, query):
+        registry = self.registry
+        if self.command in ('GET', 'HEAD'):
+            stored = registry.get_manifest(repository, reference)
+            if stored is None:
+                return self._send(404)
+            media_type, manifest = stored
+            digest = 'sha256:' + hashlib.sha256(manifest).hexdigest()
+            return self._send(200, manifest, {
+                'Content-Type': media_type,
+                'Docker-Content-Digest': digest,
+            })
+
+        if self.command == 'PUT':
+            manifest = self._read_body()
+            digest = registry.add_manifest(
+                repository, reference, manifest,
+                self.headers.get('Content-Type'))
+            return self._send(201, headers={'Docker-Content-Digest': digest})
+
+        self._send(405)
+
+    def _blob(self, repository, digest, query):
+        if self.command not in ('GET', 'HEAD'):
+            self._read_body()
+            return self._send(405)
+        data = self.registry.get_blob(repository, digest)
+        if data is None:
+            return self._send(404, b'{"errors": [{"code": "BLOB_UNKNOWN"}]}')
+        self._send(200, data, {'Docker-Content-Digest': digest})
+
+    def _upload(self, repository, upload_id, query):
+        registry = self.registry
+        body = self._read_body()
+        if self.command == 'POST' and not upload_id:
+            digest = query.get('mount', [None])[0]
+            mounted = registry.get_blob(
+                query.get('from', [''])[0], digest or '')
+            if mounted is not None:
+                registry.add_blob(repository, mounted)
+                return self._send(201, headers={
+                    'Location': '/v2/%s/blobs/%s' % (repository, digest),
+                    'Docker-Content-Digest': digest,
+                })
+
+            upload_id = str(uuid.uuid4())
+            with registry._lock:
+                registry.uploads[upload_id] = (repository, body)
+            return self._send(202, headers={
+                'Location': '/v2/%s/blobs/uploads/%s' % (
+                    repository, upload_id),
+                'Docker-Upload-UUID': upload_id,
+            })
+
+        with registry._lock:
+            upload = registry.uploads.get(upload_id)
+        if upload is None or upload[0] != repository:
+            return self._send(
+                404, b'{"errors": [{"code": "BLOB_UPLOAD_UNKNOWN"}]}')
+        status_headers = {
+            'Location': '/v2/%s/blobs/uploads/%s' % (repository, upload_id),
+            'Range': '0-%d' % (max(len(upload[1]) - 1, 0),),
+            'Docker-Upload-UUID': upload_id,
+        }
+        if self.command == 'GET':
+            return self._send(204, headers=status_headers)
+        if self.command == 'PATCH':
+            content_range = self.headers.get('Content-Range')
+            if (content_range is not None and
+                    int(content_range.split('-')[0]) != len(upload[1])):
+                return self._send(416)
+            with registry._lock:
+                registry.uploads[upload_id] = (repository, upload[1] + body)
+            status_headers['Range'] = '0-%d' % (len(upload[1] + body) - 1,)
+            return self._send(202, headers=status_headers)
+        if self.command != 'PUT':
+            return self._send(405)
+
+        data = upload[1] + body
+        digest = query.get('digest', [None])[0]
+        if digest != 'sha256:' + hashlib.sha256(data).hexdigest():
+            return self._send(400, b'{"errors": [{"code": "DIGEST_INVALID"}]}')
+        with registry._lock:
+            del registry.uploads[upload_id]
+        registry.add_blob(repository, data)
+        self._send(201, headers={
+            'Location': '/v2/%s/blobs/%s' % (repository, digest),
+            'Docker-Content-Digest': digest,
+        })
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_PATCH = do_DELETE = _handle
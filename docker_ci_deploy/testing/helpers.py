@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by more than one test module.
+"""
+import gzip
+import hashlib
+import io
+import json
+import tarfile
+import threading
+from contextlib import contextmanager
+
+from docker_ci_deploy.__main__ import main, TaskPool
+from docker_ci_deploy.daemon import DeployServer
+
+
+def digest(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def gzip_compress(data):
+    """ Compress data with gzip, like Python 3's ``gzip.compress()``. """
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def gzip_decompress(data):
+    """ Decompress gzip data, like Python 3's ``gzip.decompress()``. """
+    with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as f:
+        return f.read()
+
+
+def make_config(layers):
+    return json.dumps({
+        'architecture': 'amd64',
+        'os': 'linux',
+        'rootfs': {'type': 'layers', 'diff_ids': [
+            digest(gzip_decompress(layer) if layer[:2] == b'\x1f\x8b'
+                   else layer) for layer in layers]},
+    }).encode('utf-8')
+
+
+def write_docker_archive(path, images):
+    """
+    Write an archive in the format of ``docker save``.
+
+    :param images: A list of (repo tags, list of layer contents) pairs.
+    """
+    files = {}
+    manifest = []
+    for repo_tags, layers in images:
+        config = make_config(layers)
+        config_name = digest(config)[len('sha256:'):] + '.json'
+        files[config_name] = config
+        layer_names = []
+        for layer in layers:
+            layer_name = digest(layer)[len('sha256:'):] + '/layer.tar'
+            files[layer_name] = layer
+            layer_names.append(layer_name)
+        manifest.append({'Config': config_name, 'RepoTags': repo_tags,
+                         'Layers': layer_names})
+    files['manifest.json'] = json.dumps(manifest).encode('utf-8')
+
+    with tarfile.open(path, 'w') as tar:
+        for name, data in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+@contextmanager
+def running_daemon(socket_path):
+    """
+    Run a deploy daemon listening on a unix socket on a background thread.
+    This isn't a fixture because pytest replaces sys.stdout and sys.stderr
+    after setting up fixtures, so the daemon's wouldn't be used.
+    """
+    pool = TaskPool(4)
+    server = DeployServer('unix://' + socket_path, main, pool)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.01})
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        thread.join()
+        server.close()
+        pool.join()
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'needs_contextvars: the test runs the deploy daemon, which '
+                   'requires Python 3.7')
+
+
+def pytest_runtest_setup(item):
+    if (item.get_closest_marker('needs_contextvars') is not None and
+            sys.version_info < (3, 7)):
+        pytest.skip('The deploy daemon requires Python 3.7')
+
+
+@pytest.fixture
+def socket_path():
+    """ A path to create a unix socket at. """
+    # Unix socket paths have a short maximum length, so avoid pytest's tmpdir
+    tmpdir = tempfile.mkdtemp()
+    yield os.path.join(tmpdir, 'docker.sock')
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import socket
+import tarfile
+import threading
+
+import pytest
+from testtools import ExpectedException
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, HasLength
+
+from docker_ci_deploy.archive import (
+    ArchiveError, BlobTracker, LayerCompressor, OCI_GZIP_LAYER_TYPE,
+    OCI_LAYER_TYPE, OCI_MANIFEST_TYPE, open_archive, push_image)
+from docker_ci_deploy.cache import DeployCache
+from docker_ci_deploy.compress import ParallelGzip
+from docker_ci_deploy.registry import RegistryClient
+from docker_ci_deploy.testing.fake_registry import FakeRegistry, Faults
+from docker_ci_deploy.testing.helpers import (
+    digest, gzip_compress, gzip_decompress, make_config,
+    write_docker_archive)
+
+OCI_INDEX_TYPE = 'application/vnd.oci.image.index.v1+json'
+
+
+def write_blob(layout, data):
+    layout.join('blobs', 'sha256', digest(data)[len('sha256:'):]).write(
+        data, mode='wb', ensure=True)
+    return digest(data)
+
+
+def write_oci_manifest(layout, layers):
+    config = make_config(layers)
+
+    def descriptor(media_type, data):
+        return {'mediaType': media_type, 'size': len(data),
+                'digest': write_blob(layout, data)}
+
+    manifest = json.dumps({
+        'schemaVersion': 2,
+        'mediaType': OCI_MANIFEST_TYPE,
+        'config': descriptor('application/vnd.oci.image.config.v1+json',
+                             config),
+        'layers': [descriptor(OCI_GZIP_LAYER_TYPE, layer)
+                   for layer in layers],
+    }).encode('utf-8')
+    return descriptor(OCI_MANIFEST_TYPE, manifest), manifest
+
+
+def write_oci_layout(layout, manifests):
+    """
+    Write an OCI image layout with an index of the given manifest
+    descriptors.
+    """
+    layout.join('oci-layout').write('{"imageLayoutVersion": "1.0.0"}',
+                                    ensure=True)
+    layout.join('index.json').write(json.dumps({
+        'schemaVersion': 2, 'manifests': manifests}))
+
+
+def annotated(descriptor, annotations):
+    return dict(descriptor, annotations=annotations)
+
+
+@pytest.fixture
+def registry(tmpdir, monkeypatch):
+    monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+    with FakeRegistry() as registry:
+        yield registry
+
+
+class TestOpenArchiveFunc(object):
+    def test_docker_archive(self, tmpdir):
+        """
+        When a docker save archive is opened, its images should be named by
+        their repo tags, and have an OCI manifest of their configuration and
+        layers, with the uncompressed layers' digests taken from the
+        configuration.
+        """
+        path = str(tmpdir.join('images.tar'))
+        layer = b'layer' * 1000
+        compressed = gzip_compress(b'compressed')
+        write_docker_archive(path, [
+            (['foo:1', 'foo:latest'], [layer, compressed]),
+            (['bar:1'], [layer]),
+        ])
+        archive = open_archive(path)
+
+        assert_that(list(archive.images), Equals(
+            ['foo:1', 'foo:latest', 'bar:1']))
+        image = archive.images['foo:1']
+        manifest = json.loads(image.manifest.decode('utf-8'))
+        assert_that(manifest['mediaType'], Equals(OCI_MANIFEST_TYPE))
+        assert_that(manifest['layers'], Equals([
+            {'mediaType': OCI_LAYER_TYPE, 'size': len(layer),
+             'digest': digest(layer)},
+            {'mediaType': OCI_GZIP_LAYER_TYPE, 'size': len(compressed),
+             'digest': digest(compressed)},
+        ]))
+        assert_that(image.details()['Id'],
+                    Equals(manifest['config']['digest']))
+        assert_that(image.details()['RootFS']['Layers'], Equals(
+            [digest(layer), digest(b'compressed')]))
+
+        with archive.open_blob(image.blobs[1]) as data:
+            assert_that(bytes(data), Equals(layer))
+
+    def test_oci_layout(self, tmpdir):
+        """
+        When an OCI image layout is opened, its images should be named by
+        their annotations, with names that are only tags given the name of
+        the layout directory.
+        """
+        layout = tmpdir.join('my-image')
+        foo, _ = write_oci_manifest(layout, [b'foo'])
+        bar, _ = write_oci_manifest(layout, [b'bar'])
+        baz, _ = write_oci_manifest(layout, [b'baz'])
+        write_oci_layout(layout, [
+            annotated(foo, {'org.opencontainers.image.ref.name': '1.0'}),
+            annotated(bar, {
+                'io.containerd.image.name': 'docker.io/library/bar:2',
+                'org.opencontainers.image.ref.name': '2'}),
+            annotated(baz, {
+                'org.opencontainers.image.ref.name': 'reg:5000/baz:3'}),
+            bar,
+        ])
+        archive = open_archive(str(layout))
+
+        assert_that(list(archive.images), Equals(
+            ['my-image:1.0', 'bar:2', 'reg:5000/baz:3']))
+        assert_that(archive.images['bar:2'].digest, Equals(bar['digest']))
+        assert_that(archive.images['bar:2'].details()['RootFS']['Layers'],
+                    Equals([digest(b'bar')]))
+
+    def test_oci_layout_tar(self, tmpdir):
+        """
+        When a tar archive of an OCI image layout is opened, its images
+        should be read from the layout rather than its manifest.json.
+        """
+        layout = tmpdir.join('layout')
+        foo, _ = write_oci_manifest(layout, [b'foo'])
+        write_oci_layout(layout, [annotated(
+            foo, {'io.containerd.image.name': 'docker.io/user/foo:1'})])
+        layout.join('manifest.json').write('[]')
+        path = str(tmpdir.join('layout.tar'))
+        with tarfile.open(path, 'w') as tar:
+            tar.add(str(layout), arcname='.')
+
+        archive = open_archive(path)
+
+        assert_that(list(archive.images), Equals(['user/foo:1']))
+
+    def test_not_an_archive(self, tmpdir):
+        """
+        When the path is neither a tar archive nor an image layout, an error
+        should be raised.
+        """
+        path = tmpdir.join('images.tar.gz')
+        path.write_binary(gzip_compress(b'abc'))
+
+        with ExpectedException(
+                ArchiveError, r'.* is not an uncompressed tar archive'):
+            open_archive(str(path))
+        with ExpectedException(
+                ArchiveError,
+                r'.* is not a docker save archive or an OCI image layout'):
+            open_archive(str(tmpdir))
+
+
+class TestPushImageFunc(object):
+    def test_push(self, tmpdir, registry):
+        """
+        When an image is pushed, its blobs should be uploaded before its
+        manifest, and blobs the repository already has should be skipped.
+        """
+        path = str(tmpdir.join('images.tar'))
+        write_docker_archive(path, [(['foo:1'], [b'base', b'app'])])
+        archive = open_archive(path)
+        image = archive.images['foo:1']
+        registry.add_blob('foo', b'base')
+        client = RegistryClient(registry.domain, secure=False)
+
+        lines = list(push_image(archive, image, client, 'foo', 'tag'))
+
+        assert_that(lines, Equals([
+            '%s: Pushed %d bytes' % (
+                image.blobs[0].digest[7:19], image.blobs[0].size),
+            '%s: Layer already exists' % (digest(b'base')[7:19],),
+            '%s: Pushed 3 bytes' % (digest(b'app')[7:19],),
+            'tag: digest: %s size: %d' % (image.digest, len(image.manifest)),
+        ]))
+        assert_that(registry.get_manifest('foo', 'tag'), Equals(
+            (OCI_MANIFEST_TYPE, image.manifest)))
+        assert_that(registry.get_blob('foo', digest(b'app')), Equals(b'app'))
+        assert_that(registry.requests[-1], Equals(
+            ('PUT', '/v2/foo/manifests/tag')))
+
+    def test_push_resumes(self, tmpdir, registry):
+        """
+        When a blob is pushed in chunks and an upload of it was interrupted,
+        the upload should be resumed, and forgotten once it is finished.
+        """
+        path = str(tmpdir.join('images.tar'))
+        layer = b'layer' * 100
+        write_docker_archive(path, [(['foo:1'], [layer])])
+        archive = open_archive(path)
+        cache = DeployCache(str(tmpdir.join('cache.json')))
+        client = RegistryClient(registry.domain, secure=False)
+        key = '%s/foo@%s' % (registry.domain, digest(layer))
+
+        def interrupt(location, offset):
+            cache.record_upload(key, location, offset)
+            raise KeyboardInterrupt()
+
+        with ExpectedException(KeyboardInterrupt):
+            client.upload_blob('foo', digest(layer), layer, chunk_size=100,
+                               progress=interrupt)
+        lines = list(push_image(archive, archive.images['foo:1'], client,
+                                'foo', 'tag', chunk_size=100, uploads=cache))
+
+        assert_that(lines[1], Equals(
+            '%s: Pushed 400 bytes, resuming from byte 100' % (
+                digest(layer)[7:19],)))
+        assert_that(registry.get_blob('foo', digest(layer)), Equals(layer))
+        assert_that(DeployCache(cache.path).get_upload(key), Equals(None))
+
+    def test_push_resumes_from_registry_offset(self, tmpdir, registry):
+        """
+        When a resumed upload starts from somewhere other than the cached
+        offset, the byte it really started from should be reported, and when
+        the upload has to start again, it should be reported as a whole push.
+        """
+        path = str(tmpdir.join('images.tar'))
+        layer, other = b'layer' * 100, b'other' * 100
+        write_docker_archive(path, [(['foo:1'], [layer]),
+                                    (['foo:2'], [other])])
+        archive = open_archive(path)
+        cache = DeployCache(str(tmpdir.join('cache.json')))
+        client = RegistryClient(registry.domain, secure=False)
+        key = '%s/foo@%s' % (registry.domain, digest(layer))
+        other_key = '%s/foo@%s' % (registry.domain, digest(other))
+
+        def interrupt(location, offset):
+            # The cache has a later offset than the registry received
+            cache.record_upload(key, location, 300)
+            raise KeyboardInterrupt()
+
+        with ExpectedException(KeyboardInterrupt):
+            client.upload_blob('foo', digest(layer), layer, chunk_size=200,
+                               progress=interrupt)
+        cache.record_upload(other_key, '/v2/foo/blobs/uploads/gone', 300)
+        lines = [list(push_image(archive, archive.images[name], client,
+                                 'foo', 'tag', chunk_size=100, uploads=cache))
+                 for name in ['foo:1', 'foo:2']]
+
+        assert_that(lines[0][1], Equals(
+            '%s: Pushed 300 bytes, resuming from byte 200' % (
+                digest(layer)[7:19],)))
+        assert_that(lines[1][1], Equals(
+            '%s: Pushed 500 bytes' % (digest(other)[7:19],)))
+
+    def test_push_chunk_fails(self, tmpdir, registry):
+        """
+        When a chunk of a blob fails to upload, the error should be raised
+        rather than one from closing the blob's memory-mapped file.
+        """
+        path = str(tmpdir.join('images.tar'))
+        write_docker_archive(path, [(['foo:1'], [b'layer' * 100])])
+        archive = open_archive(path)
+        client = RegistryClient(registry.domain, secure=False)
+        request = client.request
+
+        def time_out_chunks(method, *args, **kwargs):
+            if method == 'PATCH':
+                raise socket.timeout('timed out')
+            return request(method, *args, **kwargs)
+        client.request = time_out_chunks
+
+        with ExpectedException(socket.timeout, 'timed out'):
+            list(push_image(archive, archive.images['foo:1'], client,
+                            'foo', 'tag', chunk_size=100))
+
+    def test_push_compressed(self, tmpdir, registry):
+        """
+        When images are pushed with a layer compressor, their uncompressed
+        layers should be pushed compressed, and each layer should only be
+        compressed once.
+        """
+        path = str(tmpdir.join('images.tar'))
+        base = b'base' * 1000
+        compressed = gzip_compress(b'app')
+        write_docker_archive(path, [
+            (['foo:1'], [base, compressed]),
+            (['bar:1'], [base]),
+        ])
+        archive = open_archive(path)
+        compressor = LayerCompressor(ParallelGzip(chunk_size=1000))
+        client = RegistryClient(registry.domain, secure=False)
+
+        try:
+            for name, repository in [('foo:1', 'foo'), ('bar:1', 'bar')]:
+                list(push_image(archive, archive.images[name], client,
+                                repository, '1', compressor=compressor))
+            assert_that(os.listdir(compressor.directory), HasLength(1))
+        finally:
+            compressor.close()
+
+        _, manifest = registry.get_manifest('foo', '1')
+        layers = json.loads(manifest.decode('utf-8'))['layers']
+        assert_that([layer['mediaType'] for layer in layers], Equals(
+            [OCI_GZIP_LAYER_TYPE, OCI_GZIP_LAYER_TYPE]))
+        assert_that(layers[1]['digest'], Equals(digest(compressed)))
+        assert_that(gzip_decompress(registry.get_blob(
+            'bar', layers[0]['digest'])), Equals(base))
+        assert_that(os.path.exists(compressor.directory), Equals(False))
+
+    def test_push_mounts_blobs(self, tmpdir, registry):
+        """
+        When images are pushed to several repositories with a blob tracker,
+        blobs already pushed to one repository should be mounted into the
+        others rather than uploaded again.
+        """
+        path = str(tmpdir.join('images.tar'))
+        write_docker_archive(path, [
+            (['foo:1'], [b'base', b'foo']),
+            (['bar:1'], [b'base', b'bar']),
+        ])
+        archive = open_archive(path)
+        client = RegistryClient(registry.domain, secure=False)
+        blobs = BlobTracker()
+
+        list(push_image(archive, archive.images['foo:1'], client, 'foo', '1',
+                        blobs=blobs))
+        lines = list(push_image(archive, archive.images['bar:1'], client,
+                                'bar', '1', blobs=blobs))
+        list(push_image(archive, archive.images['bar:1'], client, 'bar', '2',
+                        blobs=blobs))
+
+        assert_that(lines[1], Equals(
+            '%s: Mounted from foo' % (digest(b'base')[7:19],)))
+        assert_that(registry.get_blob('bar', digest(b'base')),
+                    Equals(b'base'))
+        # The configs and the layers, but the base layer only once
+        uploads = [path for method, path in registry.requests
+                   if method == 'PUT' and '/blobs/uploads/' in path]
+        assert_that(uploads, HasLength(5))
+
+    def test_push_concurrently(self, tmpdir):
+        """
+        When the same image is pushed to several repositories at once with a
+        blob tracker, each blob should only be uploaded once.
+        """
+        path = str(tmpdir.join('images.tar'))
+        write_docker_archive(path, [(['foo:1'], [b'base', b'foo'])])
+        archive = open_archive(path)
+        blobs = BlobTracker()
+
+        with FakeRegistry(faults=Faults(latency=0.01)) as registry:
+            client = RegistryClient(registry.domain, secure=False)
+            threads = [threading.Thread(target=list, args=(push_image(
+                archive, archive.images['foo:1'], client, repository, '1',
+                blobs=blobs),)) for repository in ['a', 'b', 'c', 'd']]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            for repository in ['a', 'b', 'c', 'd']:
+                assert_that(registry.get_blob(repository, digest(b'base')),
+                            Equals(b'base'))
+            uploads = [path for method, path in registry.requests
+                       if method == 'PUT' and '/blobs/uploads/' in path]
+            assert_that(uploads, HasLength(3))
+
+    def test_push_index(self, tmpdir, registry):
+        """
+        When an index is pushed, the manifests it refers to should be pushed
+        by digest before it.
+        """
+        layout = tmpdir.join('layout')
+        amd64, amd64_manifest = write_oci_manifest(layout, [b'amd64'])
+        arm64, arm64_manifest = write_oci_manifest(layout, [b'arm64'])
+        index = json.dumps({'schemaVersion': 2, 'mediaType': OCI_INDEX_TYPE,
+                            'manifests': [amd64, arm64]}).encode('utf-8')
+        write_oci_layout(layout, [{
+            'mediaType': OCI_INDEX_TYPE, 'size': len(index),
+            'digest': write_blob(layout, index),
+            'annotations': {'org.opencontainers.image.ref.name': 'foo:1'},
+        }])
+        archive = open_archive(str(layout))
+        client = RegistryClient(registry.domain, secure=False)
+
+        list(push_image(archive, archive.images['foo:1'], client, 'foo', '1'))
+
+        assert_that(registry.get_manifest('foo', '1'),
+                    Equals((OCI_INDEX_TYPE, index)))
+        assert_that(registry.get_manifest('foo', amd64['digest']),
+                    Equals((OCI_MANIFEST_TYPE, amd64_manifest)))
+        assert_that(registry.get_manifest('foo', arm64['digest']),
+                    Equals((OCI_MANIFEST_TYPE, arm64_manifest)))
+        assert_that(registry.get_blob('foo', digest(b'arm64')),
+                    Equals(b'arm64'))
+
+    def test_missing_blobs(self, tmpdir, registry):
+        """
+        When an image refers to blobs that aren't in the archive, an error
+        should be raised before anything is pushed.
+        """
+        layout = tmpdir.join('layout')
+        foo, _ = write_oci_manifest(layout, [b'foo'])
+        write_oci_layout(layout, [annotated(
+            foo, {'org.opencontainers.image.ref.name': 'foo:1'})])
+        layout.join('blobs', 'sha256', digest(b'foo')[7:]).remove()
+        archive = open_archive(str(layout))
+        client = RegistryClient(registry.domain, secure=False)
+
+        with ExpectedException(
+                ArchiveError,
+                r'.* refers to blobs that are not in the archive: %s' % (
+                    digest(b'foo'),)):
+            list(push_image(
+                archive, archive.images['foo:1'], client, 'foo', '1'))
+        assert_that(registry.requests, Equals([]))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+from testtools.assertions import assert_that
+from testtools.matchers import Equals
+
+from docker_ci_deploy.cache import DEFAULT_MAX_AGE, DeployCache
+
+
+class TestDeployCache(object):
+    def test_missing_file(self, tmpdir):
+        """
+        When the cache file doesn't exist, no tags should have been pushed.
+        """
+        cache = DeployCache(str(tmpdir.join('missing', 'cache.json')))
+
+        assert_that(cache.is_pushed('foo:a', 'sha256:abc'), Equals(False))
+
+    def test_record(self, tmpdir):
+        """
+        When a push is recorded, the tag should have been pushed from the
+        same image, but not from any other image.
+        """
+        cache = DeployCache(str(tmpdir.join('cache.json')))
+        cache.record('foo:a', 'sha256:abc', 'sha256:def')
+
+        assert_that(cache.is_pushed('foo:a', 'sha256:abc'), Equals(True))
+        assert_that(cache.is_pushed('foo:a', 'sha256:xyz'), Equals(False))
+        assert_that(cache.is_pushed('foo:b', 'sha256:abc'), Equals(False))
+
+    def test_save(self, tmpdir):
+        """
+        When the cache is saved, the recorded pushes should be read by a new
+        cache, and entries saved by other caches in the meantime should be
+        kept.
+        """
+        path = str(tmpdir.join('dir', 'cache.json'))
+        cache = DeployCache(path)
+        other_cache = DeployCache(path)
+        cache.record('foo:a', 'sha256:abc', 'sha256:def')
+        other_cache.record('foo:b', 'sha256:abc', None)
+        other_cache.save()
+        cache.save()
+
+        with open(path) as f:
+            tags = json.load(f)['tags']
+        assert_that(sorted(tags), Equals(['foo:a', 'foo:b']))
+        assert_that(tags['foo:a']['digest'], Equals('sha256:def'))
+        assert_that(DeployCache(path).is_pushed('foo:b', 'sha256:abc'),
+                    Equals(True))
+        assert_that(tmpdir.join('dir').listdir(), Equals(
+            [tmpdir.join('dir', 'cache.json')]))
+
+    def test_max_age(self, tmpdir, monkeypatch):
+        """
+        Entries older than the maximum age should be ignored, and should be
+        removed when the cache is saved.
+        """
+        path = str(tmpdir.join('cache.json'))
+        cache = DeployCache(path, max_age=60)
+        cache.record('foo:a', 'sha256:abc', None)
+        cache.save()
+
+        now = time.time()
+        monkeypatch.setattr(time, 'time', lambda: now + 61)
+        cache = DeployCache(path, max_age=60)
+        assert_that(cache.is_pushed('foo:a', 'sha256:abc'), Equals(False))
+
+        cache.record('foo:b', 'sha256:abc', None)
+        cache.save()
+        with open(path) as f:
+            assert_that(list(json.load(f)['tags']), Equals(['foo:b']))
+
+    def test_max_age_zero(self, tmpdir):
+        """
+        When the maximum age is 0, all entries should be ignored, but new
+        entries should still be saved without removing the old ones.
+        """
+        path = str(tmpdir.join('cache.json'))
+        cache = DeployCache(path)
+        cache.record('foo:a', 'sha256:abc', None)
+        cache.save()
+
+        cache = DeployCache(path, max_age=0)
+        assert_that(cache.is_pushed('foo:a', 'sha256:abc'), Equals(False))
+        cache.record('foo:b', 'sha256:abc', None)
+        cache.save()
+
+        assert_that(DeployCache(path).is_pushed('foo:a', 'sha256:abc'),
+                    Equals(True))
+        assert_that(DeployCache(path).is_pushed('foo:b', 'sha256:abc'),
+                    Equals(True))
+
+    def test_corrupt_file(self, tmpdir):
+        """
+        When the cache file can't be parsed, the cache should be empty.
+        """
+        path = tmpdir.join('cache.json')
+        path.write('{"tags": ')
+        cache = DeployCache(str(path))
+
+        assert_that(cache.is_pushed('foo:a', 'sha256:abc'), Equals(False))
+
+    def test_uploads(self, tmpdir):
+        """
+        When the progress of an upload is recorded, it should be written to
+        the cache file straight away, and removed once the upload is
+        forgotten.
+        """
+        path = str(tmpdir.join('cache.json'))
+        cache = DeployCache(path)
+        cache.record('foo:a', 'sha256:abc', None)
+        cache.record_upload('reg/foo@sha256:abc', '/v2/foo/uploads/1', 10)
+
+        other_cache = DeployCache(path)
+        assert_that(other_cache.get_upload('reg/foo@sha256:abc'),
+                    Equals(('/v2/foo/uploads/1', 10)))
+        assert_that(other_cache.get_upload('reg/foo@sha256:def'),
+                    Equals(None))
+        assert_that(other_cache.is_pushed('foo:a', 'sha256:abc'),
+                    Equals(True))
+
+        other_cache.forget_upload('reg/foo@sha256:abc')
+        assert_that(DeployCache(path).get_upload('reg/foo@sha256:abc'),
+                    Equals(None))
+        assert_that(DeployCache(path, max_age=0).get_upload('x'),
+                    Equals(None))
+
+    def test_uploads_max_age_zero(self, tmpdir, monkeypatch):
+        """
+        When the maximum age is 0, upload sessions should still be resumed,
+        but only until they are older than the default maximum age.
+        """
+        path = str(tmpdir.join('cache.json'))
+        DeployCache(path).record_upload('reg/foo@sha256:abc', '/1', 10)
+        assert_that(DeployCache(path, max_age=0).get_upload(
+            'reg/foo@sha256:abc'), Equals(('/1', 10)))
+
+        now = time.time()
+        monkeypatch.setattr(time, 'time', lambda: now + DEFAULT_MAX_AGE + 1)
+        assert_that(DeployCache(path, max_age=0).get_upload(
+            'reg/foo@sha256:abc'), Equals(None))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import io
+import random
+
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, HasLength, NotEquals
+
+from docker_ci_deploy.compress import gzip_member, ParallelGzip
+
+
+def random_data(size, seed=0):
+    rng = random.Random(seed)
+    # Compressible, but not too compressible
+    return b''.join(
+        rng.choice([b'abc', b'def', b'ghi', b'jkl']) for _ in range(size // 3))
+
+
+def compress(data, **kwargs):
+    compressor = ParallelGzip(**kwargs)
+    out = io.BytesIO()
+    try:
+        digest, size = compressor.compress(memoryview(data), out.write)
+    finally:
+        compressor.close()
+    return out.getvalue(), digest, size
+
+
+class TestGzipMemberFunc(object):
+    def test_member(self):
+        """
+        A gzip member should decompress to the original data, and not depend
+        on when it was made.
+        """
+        member = gzip_member(b'abc' * 100)
+
+        assert_that(gzip.GzipFile(fileobj=io.BytesIO(member)).read(),
+                    Equals(b'abc' * 100))
+        assert_that(member[4:8], Equals(b'\0\0\0\0'))
+
+
+class TestParallelGzip(object):
+    def test_compress(self):
+        """
+        When data is compressed in chunks, the output should be one gzip
+        member per chunk that decompress to the data together, and the digest
+        and size of the output should be returned.
+        """
+        data = random_data(100000)
+        output, digest, size = compress(data, jobs=3, chunk_size=10000)
+
+        assert_that(gzip.GzipFile(fileobj=io.BytesIO(output)).read(),
+                    Equals(data))
+        assert_that(output.split(b'\x1f\x8b\x08\x00\x00\x00\x00\x00')[1:],
+                    HasLength(10))
+        assert_that(digest, Equals(
+            'sha256:' + hashlib.sha256(output).hexdigest()))
+        assert_that(size, Equals(len(output)))
+
+    def test_deterministic(self):
+        """
+        The output should be the same whatever the number of threads, but
+        should change with the chunk size.
+        """
+        data = random_data(50000)
+
+        assert_that(compress(data, jobs=1, chunk_size=4096),
+                    Equals(compress(data, jobs=8, chunk_size=4096)))
+        assert_that(compress(data, jobs=8, chunk_size=4096)[1],
+                    NotEquals(compress(data, jobs=8, chunk_size=8192)[1]))
+
+    def test_empty(self):
+        """ Empty data should be compressed to a valid, empty gzip file. """
+        output, _, _ = compress(b'')
+
+        assert_that(gzip.GzipFile(fileobj=io.BytesIO(output)).read(),
+                    Equals(b''))
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import re
+import stat
+import threading
+import time
+
+import pytest
+from testtools import ExpectedException
+from testtools.assertions import assert_that
+from testtools.matchers import Contains, Equals, MatchesRegex
+
+from docker_ci_deploy.__main__ import main
+from docker_ci_deploy.daemon import (
+    _connect, DaemonError, DeployRequest, DeployServer, forward, InFlight,
+    parse_address)
+from docker_ci_deploy.testing.helpers import running_daemon
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'Timed out waiting'
+        time.sleep(0.005)
+
+
+def slow_docker(tmpdir, rebuilt=False):
+    """
+    Create an executable that logs its arguments, and for pushes, waits for
+    a 'release' file to exist before it finishes. Images are inspected with
+    the same ID each time, or if ``rebuilt``, a new one, as if the image was
+    rebuilt after each inspection.
+    """
+    calls_log = tmpdir.join('calls.log')
+    image_id = 'sha256:$$' if rebuilt else 'sha256:abcdef'
+    executable = tmpdir.join('docker')
+    executable.write('\n'.join([
+        '#!/bin/sh',
+        'echo "$@" >> "%s"' % (calls_log,),
+        'if [ "$1" = image ] && [ "$2" = inspect ]; then',
+        '  echo "[{\\"Id\\": \\"%s\\"}]"' % (image_id,),
+        'elif [ "$1" = push ]; then',
+        '  while [ ! -e "%s" ]; do sleep 0.01; done' % (
+            tmpdir.join('release'),),
+        '  echo "pushed $2"',
+        'fi',
+    ]))
+    os.chmod(str(executable), stat.S_IRWXU)
+    return str(executable)
+
+
+def run_forward(address, args, cwd, stdin=None):
+    """ Forward a command and get its (status, stdout, stderr). """
+    stdout, stderr = io.StringIO(), io.StringIO()
+    status = forward(address, args, cwd, stdin, stdout, stderr)
+    return status, stdout.getvalue(), stderr.getvalue()
+
+
+class TestParseAddress(object):
+    def test_unix(self):
+        """ Unix socket addresses should be parsed to their paths. """
+        assert_that(parse_address('unix:///run/dcd.sock'),
+                    Equals(('unix', '/run/dcd.sock')))
+        assert_that(parse_address('/run/dcd.sock'),
+                    Equals(('unix', '/run/dcd.sock')))
+
+    def test_http(self):
+        """ HTTP addresses should be parsed to their hosts and ports. """
+        assert_that(parse_address('http://127.0.0.1:8700'),
+                    Equals(('tcp', ('127.0.0.1', 8700))))
+        assert_that(parse_address('http://[::1]:8700'),
+                    Equals(('tcp', ('::1', 8700))))
+
+    def test_invalid(self):
+        """ Other addresses should be rejected. """
+        for address in ['unix://', 'http://localhost', 'localhost:8700',
+                        'http://localhost:8700/deploy', 'http://0.0.0.0:8700',
+                        'http://example.com:8700']:
+            with ExpectedException(
+                    ValueError, r"invalid deploy daemon address '.*'"):
+                parse_address(address)
+
+
+class TestInFlight(object):
+    def test_shared(self):
+        """
+        When a call is made while one with the same key is running, it should
+        wait for the running call and return its result rather than calling
+        its function.
+        """
+        in_flight = InFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def func():
+            calls.append('first')
+            release.wait(timeout=5)
+            return 'result'
+
+        thread = threading.Thread(
+            target=lambda: results.append(in_flight.run('key', func)))
+        thread.start()
+        wait_for(lambda: calls)
+
+        waiting = []
+        second = threading.Thread(target=lambda: results.append(
+            in_flight.run('key', lambda: calls.append('second'),
+                          waiting=lambda: waiting.append(True))))
+        second.start()
+        wait_for(lambda: waiting)
+        release.set()
+        thread.join()
+        second.join()
+
+        assert_that(calls, Equals(['first']))
+        assert_that(results, Equals(['result', 'result']))
+        assert_that(in_flight.shared, Equals(1))
+        assert_that(len(in_flight), Equals(0))
+
+    def test_error_shared(self):
+        """
+        When the running call raises an error, the calls waiting for it
+        should raise the same error.
+        """
+        in_flight = InFlight()
+        release = threading.Event()
+        errors = []
+
+        def fail():
+            release.wait(timeout=5)
+            raise RuntimeError('failed')
+
+        def run(func):
+            try:
+                in_flight.run('key', func)
+            except RuntimeError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(fail,)),
+                   threading.Thread(target=run, args=(lambda: None,))]
+        threads[0].start()
+        wait_for(lambda: len(in_flight))
+        threads[1].start()
+        wait_for(lambda: in_flight.shared)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert_that(len(errors), Equals(2))
+        assert_that(errors[0], Equals(errors[1]))
+
+    def test_not_running(self):
+        """ Calls that don't overlap should each call their function. """
+        in_flight = InFlight()
+        calls = []
+        in_flight.run('key', lambda: calls.append(1))
+        in_flight.run('key', lambda: calls.append(2))
+
+        assert_that(calls, Equals([1, 2]))
+        assert_that(in_flight.shared, Equals(0))
+
+
+class TestDeployRequest(object):
+    def test_open(self, tmpdir):
+        """
+        Files should be opened in the client's working directory, and '-'
+        should be the client's stdin.
+        """
+        tmpdir.join('images.txt').write('test-image\n')
+        request = DeployRequest([], str(tmpdir), stdin=u'other-image\n')
+
+        with request.open('images.txt') as f:
+            assert_that(f.read(), Equals('test-image\n'))
+        assert_that(request.open('-').read(), Equals('other-image\n'))
+
+    def test_close(self, tmpdir):
+        """
+        When the request is closed, the files opened for it should be closed.
+        """
+        tmpdir.join('images.txt').write('test-image\n')
+        request = DeployRequest([], str(tmpdir))
+        f = request.open('images.txt')
+
+        request.close()
+        assert_that(f.closed, Equals(True))
+
+    def test_resolve_paths(self, tmpdir):
+        """
+        Relative paths should be resolved against the client's working
+        directory, and absolute paths and missing options left alone.
+        """
+        class Args(object):
+            archive = ['images.tar', '/tmp/other.tar']
+            cache_file = 'cache.json'
+            trace_file = None
+
+        args = Args()
+        DeployRequest([], '/work').resolve_paths(
+            args, ['archive', 'cache_file', 'trace_file'])
+
+        assert_that(args.archive,
+                    Equals(['/work/images.tar', '/tmp/other.tar']))
+        assert_that(args.cache_file, Equals('/work/cache.json'))
+        assert_that(args.trace_file, Equals(None))
+
+
+@pytest.mark.needs_contextvars
+class TestDeployServer(object):
+    def test_forward(self, socket_path, tmpdir):
+        """
+        When a command is forwarded to the daemon, its output and exit status
+        should be sent back.
+        """
+        with running_daemon(socket_path) as daemon:
+            status, out, err = run_forward(
+                daemon.address,
+                ['--dry-run', '--tag', 'abc', '--', 'test-image'],
+                str(tmpdir))
+
+        assert_that(status, Equals(0))
+        assert_that(out, Equals('docker tag test-image test-image:abc\n'
+                                'docker push test-image:abc\n'))
+        assert_that(err, Equals(''))
+
+    def test_usage_error(self, socket_path, tmpdir):
+        """
+        When the command's arguments are invalid, the error should be sent
+        back with the exit status 2.
+        """
+        with running_daemon(socket_path) as daemon:
+            status, out, err = run_forward(
+                daemon.address, ['--jobs', '0', 'test-image'], str(tmpdir))
+
+        assert_that(status, Equals(2))
+        assert_that(out, Equals(''))
+        assert_that(err, MatchesRegex(
+            r'.*error: the --jobs option must be at least 1$', re.DOTALL))
+
+    def test_failure(self, socket_path, tmpdir):
+        """
+        When the command fails, the traceback should be sent back with the
+        exit status 1.
+        """
+        with running_daemon(socket_path) as daemon:
+            status, _, err = run_forward(
+                daemon.address, ['--executable', 'false', 'test-image'],
+                str(tmpdir))
+
+        assert_that(status, Equals(1))
+        assert_that(err, Contains('CalledProcessError'))
+
+    def test_client_paths(self, socket_path, tmpdir):
+        """
+        Relative paths should be resolved against the client's working
+        directory, and the client's stdin should be read for '--from-file -'.
+        """
+        with running_daemon(socket_path) as daemon:
+            status, out, _ = run_forward(
+                daemon.address,
+                ['--dry-run', '--metrics-file', 'metrics.json',
+                 '--from-file', '-'],
+                str(tmpdir), stdin=u'test-image\n')
+
+        assert_that(status, Equals(0))
+        assert_that(out, Equals('docker push test-image\n'))
+        with tmpdir.join('metrics.json').open() as f:
+            assert_that(json.load(f)['succeeded'], Equals(True))
+
+    def test_client_files_closed(self, socket_path, tmpdir, monkeypatch):
+        """
+        The files opened for a command should be closed when it finishes,
+        even if it fails.
+        """
+        tmpdir.join('images.txt').write('test-image\n')
+        opened = []
+        open_file = DeployRequest.open
+
+        def record_open(request, path):
+            f = open_file(request, path)
+            opened.append(f)
+            return f
+        monkeypatch.setattr(DeployRequest, 'open', record_open)
+
+        with running_daemon(socket_path) as daemon:
+            for args in [['--dry-run'], ['--jobs', '0']]:
+                run_forward(daemon.address,
+                            args + ['--from-file', 'images.txt'], str(tmpdir))
+
+        assert_that([f.closed for f in opened], Equals([True, True]))
+
+    def test_client_executable(self, socket_path, tmpdir):
+        """
+        A relative path to the Docker client executable should be resolved
+        against the client's working directory.
+        """
+        slow_docker(tmpdir)
+        tmpdir.join('release').write('')
+        with running_daemon(socket_path) as daemon:
+            status, out, _ = run_forward(
+                daemon.address, ['--executable', './docker', 'test-image'],
+                str(tmpdir))
+
+        assert_that(status, Equals(0))
+        assert_that(out, Equals('pushed test-image\n'))
+
+    def test_coalesce(self, socket_path, tmpdir):
+        """
+        When two deploys push the same tag from the same image at the same
+        time, the tag should only be pushed once, and both should succeed.
+        """
+        executable = slow_docker(tmpdir)
+        results = []
+
+        with running_daemon(socket_path) as daemon:
+            def deploy():
+                results.append(run_forward(
+                    daemon.address,
+                    ['--executable', executable, '--tag', 'abc', '--',
+                     'test-image'], str(tmpdir)))
+
+            threads = [threading.Thread(target=deploy) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            wait_for(lambda: daemon.status()['shared'])
+            tmpdir.join('release').write('')
+            for thread in threads:
+                thread.join()
+            status = daemon.status()
+
+        assert_that(sorted(results), Equals([
+            (0, 'Waiting for "test-image:abc" to be pushed by another '
+                'deploy...\n', ''),
+            (0, 'pushed test-image:abc\n', ''),
+        ]))
+        calls = tmpdir.join('calls.log').read().splitlines()
+        assert_that(sorted(calls), Equals(
+            ['image inspect test-image'] * 2 + ['push test-image:abc'] +
+            ['tag test-image test-image:abc'] * 2))
+        assert_that(status, Equals(
+            {'running': 0, 'in_flight': 0, 'shared': 1}))
+
+    def test_coalesce_other_image(self, socket_path, tmpdir):
+        """
+        When two deploys push the same tag at the same time, but from
+        different images, the tag should be pushed by both.
+        """
+        executable = slow_docker(tmpdir, rebuilt=True)
+        calls_log = tmpdir.join('calls.log')
+        results = []
+
+        with running_daemon(socket_path) as daemon:
+            def deploy():
+                results.append(run_forward(
+                    daemon.address,
+                    ['--executable', executable, '--tag', 'abc', '--',
+                     'test-image'], str(tmpdir)))
+
+            threads = [threading.Thread(target=deploy) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            try:
+                wait_for(lambda: calls_log.check() and
+                         calls_log.read().count('push') == 2)
+            finally:
+                tmpdir.join('release').write('')
+            for thread in threads:
+                thread.join()
+            status = daemon.status()
+
+        assert_that(results, Equals([
+            (0, 'pushed test-image:abc\n', ''),
+            (0, 'pushed test-image:abc\n', ''),
+        ]))
+        assert_that(status['shared'], Equals(0))
+
+    def test_client_not_reading(self, socket_path, tmpdir):
+        """
+        When a client stops reading its output, its command should still
+        finish, and other deploys shouldn't be held up.
+        """
+        images = ''.join('test-image-%d\n' % (i,) for i in range(20000))
+        body = json.dumps({
+            'args': ['--dry-run', '--from-file', '-'], 'cwd': str(tmpdir),
+            'stdin': images,
+        }).encode('utf-8')
+        with running_daemon(socket_path) as daemon:
+            connection = _connect(daemon.address)
+            try:
+                connection.request('POST', '/deploy', body,
+                                   {'Content-Type': 'application/json'})
+                wait_for(lambda: daemon.status()['running'])
+                status, out, _ = run_forward(
+                    daemon.address, ['--dry-run', 'test-image'], str(tmpdir))
+                wait_for(lambda: not daemon.status()['running'])
+            finally:
+                connection.close()
+
+        assert_that(status, Equals(0))
+        assert_that(out, Equals('docker push test-image\n'))
+
+    def post_deploy(self, address, body, headers):
+        connection = _connect(address)
+        try:
+            connection.request('POST', '/deploy', body, headers)
+            return connection.getresponse().status
+        finally:
+            connection.close()
+
+    def test_bad_request(self, socket_path):
+        """ Requests without the command's arguments should be rejected. """
+        with running_daemon(socket_path) as daemon:
+            status = self.post_deploy(
+                daemon.address, b'{"args": "test-image"}',
+                {'Content-Type': 'application/json'})
+
+        assert_that(status, Equals(400))
+
+    def test_browser_request(self, socket_path, tmpdir):
+        """
+        Requests that a web page could make, which aren't JSON or aren't
+        addressed to a loopback host, should be rejected without running
+        anything.
+        """
+        body = json.dumps({
+            'args': ['--dry-run', 'test-image'], 'cwd': str(tmpdir),
+        }).encode('utf-8')
+        with running_daemon(socket_path) as daemon:
+            statuses = [
+                self.post_deploy(daemon.address, body,
+                                 {'Content-Type': 'text/plain'}),
+                self.post_deploy(daemon.address, body,
+                                 {'Content-Type': 'application/json',
+                                  'Host': 'evil.example.com:8700'}),
+                self.post_deploy(daemon.address, body,
+                                 {'Content-Type': 'application/json',
+                                  'Host': '127.0.0.1:8700'}),
+            ]
+
+        assert_that(statuses, Equals([415, 403, 200]))
+
+    def test_already_listening(self, socket_path):
+        """
+        A daemon should not be started on a socket that another daemon is
+        listening on.
+        """
+        with running_daemon(socket_path) as daemon:
+            with ExpectedException(
+                    ValueError, r'a deploy daemon is already listening on .*'):
+                DeployServer(daemon.address, main, None)
+
+
+class TestForward(object):
+    def test_not_running(self, socket_path, tmpdir):
+        """
+        When there is no daemon at the address, an error should be raised.
+        """
+        with ExpectedException(
+                DaemonError, r'Failed to connect to the deploy daemon at .*'):
+            forward('unix://' + socket_path, ['test-image'], str(tmpdir))
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import socket
+import threading
+
+from testtools import ExpectedException
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, HasLength
+
+try:
+    from http.client import BadStatusLine
+except ImportError:  # pragma: no cover
+    from httplib import BadStatusLine  # Python 2
+
+from docker_ci_deploy.engine import (
+    default_socket_path, DockerEngineClient, DockerEngineError,
+    encode_registry_auth, format_progress)
+from docker_ci_deploy.testing.fake_engine import FakeDockerEngine
+
+
+class TestDefaultSocketPathFunc(object):
+    def test_default(self, monkeypatch):
+        """
+        When DOCKER_HOST is not set, the standard socket path should be used.
+        """
+        monkeypatch.delenv('DOCKER_HOST', raising=False)
+        assert_that(default_socket_path(), Equals('/var/run/docker.sock'))
+
+    def test_docker_host(self, monkeypatch):
+        """
+        When DOCKER_HOST is set to a unix socket, that socket should be used.
+        """
+        monkeypatch.setenv('DOCKER_HOST', 'unix:///tmp/docker.sock')
+        assert_that(default_socket_path(), Equals('/tmp/docker.sock'))
+
+
+def decode_registry_auth(auth):
+    return json.loads(
+        base64.urlsafe_b64decode(auth.encode('ascii')).decode('utf-8'))
+
+
+class TestEncodeRegistryAuthFunc(object):
+    def test_credentials(self):
+        """ Credentials should be encoded as base64 JSON. """
+        auth = encode_registry_auth(('user', 'pass'), 'registry:5000')
+        assert_that(decode_registry_auth(auth),
+                    Equals({'username': 'user', 'password': 'pass',
+                            'serveraddress': 'registry:5000'}))
+
+    def test_no_credentials(self):
+        """ Without credentials, an empty object should be encoded. """
+        auth = encode_registry_auth(None, 'registry:5000')
+        assert_that(decode_registry_auth(auth), Equals({}))
+
+
+class TestFormatProgressFunc(object):
+    def test_status(self):
+        """ Status messages should be formatted like the Docker CLI. """
+        assert_that(format_progress({'status': 'Pushed', 'id': 'abc'}),
+                    Equals('abc: Pushed'))
+        assert_that(format_progress({'status': 'Done'}), Equals('Done'))
+
+    def test_progress(self):
+        """ Progress and auxiliary messages should be ignored. """
+        assert_that(format_progress({
+            'status': 'Pushing', 'id': 'abc',
+            'progressDetail': {'current': 1, 'total': 2}}), Equals(None))
+        assert_that(format_progress({'aux': {'Tag': 'latest'}}),
+                    Equals(None))
+
+
+class TestDockerEngineClient(object):
+    def test_tag(self, socket_path):
+        """ When an image is tagged, the new tag should be created. """
+        with FakeDockerEngine(socket_path, ['foo:latest']) as engine:
+            client = DockerEngineClient(socket_path)
+            client.tag('foo', 'registry:5000/foo', 'bar')
+
+        assert_that(engine.images['registry:5000/foo:bar'],
+                    Equals(engine.images['foo:latest']))
+
+    def test_tag_missing_image(self, socket_path):
+        """
+        When the image to tag doesn't exist, an error should be raised with
+        the daemon's error message.
+        """
+        with FakeDockerEngine(socket_path) as engine:
+            client = DockerEngineClient(socket_path)
+            with ExpectedException(DockerEngineError,
+                                   r'.*No such image: foo$'):
+                client.tag('foo', 'foo', 'bar')
+
+        assert_that(engine.requests, Equals([
+            ('POST', '/images/foo/tag', {'repo': 'foo', 'tag': 'bar'})]))
+
+    def test_inspect_image(self, socket_path):
+        """
+        When an image is inspected, its information should be returned.
+        """
+        with FakeDockerEngine(socket_path, ['foo:bar']) as engine:
+            client = DockerEngineClient(socket_path)
+            details = client.inspect_image('foo:bar')
+
+        assert_that(details['Id'], Equals(engine.images['foo:bar']))
+
+    def test_push(self, socket_path):
+        """
+        When an image is pushed, the progress messages should be returned.
+        """
+        with FakeDockerEngine(socket_path, ['foo:bar']) as engine:
+            client = DockerEngineClient(socket_path)
+            messages = list(client.push('foo', 'bar', 'e30='))
+
+        assert_that(messages[-1]['aux']['Digest'],
+                    Equals(engine.images['foo:bar']))
+        assert_that(engine.registry_auths, Equals(['e30=']))
+
+    def test_push_latest(self, socket_path):
+        """
+        When an image without a tag is pushed, only the "latest" tag should
+        be pushed, rather than every tag of the repository.
+        """
+        with FakeDockerEngine(socket_path, ['foo:latest']) as engine:
+            client = DockerEngineClient(socket_path)
+            list(client.push('foo', None, 'e30='))
+
+        assert_that(engine.requests, Equals(
+            [('POST', '/images/foo/push', {'tag': 'latest'})]))
+
+    def test_push_error(self, socket_path):
+        """
+        When the daemon reports an error while pushing, an error should be
+        raised.
+        """
+        with FakeDockerEngine(socket_path):
+            client = DockerEngineClient(socket_path)
+            with ExpectedException(
+                    DockerEngineError,
+                    'An image does not exist locally with the tag: foo'):
+                list(client.push('foo', 'bar', 'e30='))
+
+    def test_persistent_connection(self, socket_path):
+        """
+        Requests made from the same thread should share one connection to the
+        daemon.
+        """
+        with FakeDockerEngine(socket_path, ['foo:latest']) as engine:
+            client = DockerEngineClient(socket_path)
+            for tag in ['a', 'b', 'c']:
+                client.tag('foo', 'foo', tag)
+                list(client.push('foo', tag, 'e30='))
+
+        assert_that(engine.connections, Equals(1))
+        assert_that(len(engine.requests), Equals(6))
+
+    def test_dropped_connection(self, socket_path):
+        """
+        When the daemon has closed an idle connection, the request should be
+        made on a new connection.
+        """
+        with FakeDockerEngine(socket_path, ['foo:latest'],
+                              drop_connections=True) as engine:
+            client = DockerEngineClient(socket_path)
+            for _ in range(3):
+                client.inspect_image('foo')
+
+        assert_that(engine.connections, Equals(3))
+        assert_that(engine.requests, HasLength(3))
+
+    def test_dropped_request(self, socket_path):
+        """
+        When the daemon closes a reused connection after receiving a request
+        that can safely be made again, it should be made again on a new
+        connection.
+        """
+        with FakeDockerEngine(socket_path, ['foo:latest'],
+                              drop_requests=True) as engine:
+            client = DockerEngineClient(socket_path)
+            for _ in range(2):
+                client.inspect_image('foo')
+
+        assert_that(engine.connections, Equals(2))
+        assert_that(engine.requests, HasLength(3))
+
+    def test_dropped_request_not_idempotent(self, socket_path):
+        """
+        When the daemon closes a reused connection after receiving a request
+        that might do something again if it were made again, such as a push,
+        the error should be raised.
+        """
+        with FakeDockerEngine(socket_path, ['foo:latest'],
+                              drop_requests=True) as engine:
+            client = DockerEngineClient(socket_path)
+            client.tag('foo', 'foo', 'a')
+            errors = []
+            try:
+                list(client.push('foo', 'a', 'e30='))
+            except (BadStatusLine, socket.error) as e:
+                errors.append(e)
+
+        assert_that(errors, HasLength(1))
+        assert_that(engine.requests, HasLength(2))
+
+    def test_close(self, socket_path):
+        """
+        Closing the client should close the connections of every thread that
+        used it.
+        """
+        with FakeDockerEngine(socket_path, ['foo:latest']) as engine:
+            client = DockerEngineClient(socket_path)
+            threads = [
+                threading.Thread(target=client.tag, args=('foo', 'foo', tag))
+                for tag in ['a', 'b']]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            connections = list(client._connections)
+            client.close()
+
+        assert_that(engine.connections, Equals(2))
+        assert_that([connection.sock for connection in connections],
+                    Equals([None, None]))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from testtools import ExpectedException
+from testtools.assertions import assert_that
+from testtools.matchers import Equals
+
+from docker_ci_deploy.files import write_atomic
+
+
+class TestWriteAtomic(object):
+    def test_write(self, tmpdir):
+        """
+        The file should be written, creating its directory, and replaced if
+        it exists, without leaving any temporary files behind.
+        """
+        path = tmpdir.join('dir', 'file.txt')
+        write_atomic(str(path), 'first\n')
+        write_atomic(str(path), 'second\n')
+
+        assert_that(path.read(), Equals('second\n'))
+        assert_that(tmpdir.join('dir').listdir(), Equals([path]))
+
+    def test_error(self, tmpdir):
+        """
+        When writing fails, the existing file should be left as it was and
+        the temporary file removed.
+        """
+        path = tmpdir.join('file.txt')
+        path.write('first\n')
+
+        with ExpectedException(TypeError):
+            write_atomic(str(path), None)
+
+        assert_that(path.read(), Equals('first\n'))
+        assert_that(tmpdir.listdir(), Equals([path]))
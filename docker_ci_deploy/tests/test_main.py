@@ -1,15 +1,33 @@
 # -*- coding: utf-8 -*-
+import io
+import json
+import os
+import random
 import re
+import stat
 import sys
+import threading
+import time
 from subprocess import CalledProcessError
 
+import pytest
 from testtools import ExpectedException
 from testtools.assertions import assert_that
-from testtools.matchers import Equals, MatchesRegex, MatchesStructure
+from testtools.matchers import (
+    Contains, Equals, GreaterThan, Is, LessThan, MatchesRegex,
+    MatchesStructure)
 
 from docker_ci_deploy.__main__ import (
-    cmd, DockerCiDeployRunner, join_image_tag, main, RegistryTagger,
-    generate_tags, generate_semver_versions, VersionTagger, split_image_tag)
+    _parse_name, _write_lines, ANCHORED_NAME_REGEX, cmd, DockerCiDeployRunner,
+    ImageReference, ImageSpec, join_image_tag, main, parse_name,
+    parse_reference, read_image_specs, REFERENCE_REGEX, RegistryTagger,
+    generate_tags, generate_semver_versions, run_concurrently, TaskPool,
+    VersionTagger, split_image_tag)
+from docker_ci_deploy.testing.fake_engine import FakeDockerEngine
+from docker_ci_deploy.testing.fake_registry import (
+    FakeRegistry, make_manifest)
+from docker_ci_deploy.testing.helpers import (
+    digest, make_config, running_daemon, write_docker_archive)
 
 
 class TestSplitImageTagFunc(object):
@@ -65,6 +83,135 @@ class TestSplitImageTagFunc(object):
             split_image_tag(image_tag)
 
 
+DIGEST = 'sha256:' + '0123456789abcdef' * 4
+
+# The components of these references are kept short because the reference
+# regexes take exponential time in the length of malformed name components
+VALID_REFERENCES = [
+    'name',
+    'name:tag',
+    'user/name:tag',
+    'reg.ex.io:5000/user/name:tag',
+    'host:5000/a.b_c__d---e/f',
+    'UP.ex.io/name',
+    'name:Tag_1.0-rc.1',
+    'name@' + DIGEST,
+    'reg:5000/name:tag@' + DIGEST,
+    'name:\xe1\xe9',
+]
+
+
+def random_reference(rng):
+    """
+    Generate a short random string made of the characters that are
+    significant in image references, or a mutation of a valid reference.
+    """
+    alphabet = 'abz09AZ.-_/:@+\xe9 '
+    if rng.random() < 0.5:
+        return ''.join(
+            rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+
+    reference = list(rng.choice(VALID_REFERENCES))
+    position = rng.randint(0, len(reference))
+    mutation = rng.choice(['insert', 'delete', 'replace'])
+    if mutation == 'insert':
+        reference.insert(position, rng.choice(alphabet))
+    elif position < len(reference):
+        if mutation == 'delete':
+            del reference[position]
+        else:
+            reference[position] = rng.choice(alphabet)
+    return ''.join(reference)
+
+
+class TestParseReferenceFunc(object):
+    def test_parts(self):
+        """
+        Given a reference with all possible parts, parse_reference should
+        return each part.
+        """
+        reference = parse_reference(
+            'registry.example.com:5000/user/name:tag@' + DIGEST)
+
+        assert_that(reference, Equals(ImageReference(
+            'registry.example.com:5000', ['user', 'name'], 'tag', DIGEST)))
+        assert_that(reference.name,
+                    Equals('registry.example.com:5000/user/name'))
+
+    def test_ambiguous_hostname(self):
+        """
+        When the first component of a name could be a hostname or a path
+        component, it should be treated as a hostname.
+        """
+        reference = parse_reference('praekeltorg/alpine-python')
+
+        assert_that(reference, Equals(ImageReference(
+            'praekeltorg', ['alpine-python'], None, None)))
+
+    def test_component_not_hostname(self):
+        """
+        When the first component of a name can't be a hostname, it should be
+        treated as a path component.
+        """
+        reference = parse_name('user_name/name')
+
+        assert_that(reference, Equals(ImageReference(
+            None, ['user_name', 'name'], None, None)))
+
+    def test_invalid(self):
+        """
+        Given malformed references, parse_reference should raise an error.
+        """
+        for reference in ['', 'name:', 'Name', 'a//b', 'a..b', 'name\n',
+                          'name:-tag', 'name:' + 't' * 129, 'name@sha256:abc',
+                          'name@' + DIGEST + '\n', 'name:tag:tag']:
+            with ExpectedException(
+                    ValueError, r"(?s)Unable to parse image tag '.*'"):
+                parse_reference(reference)
+
+    def test_linear_time(self):
+        """
+        Long malformed names that make the reference regexes backtrack
+        exponentially should be rejected quickly.
+        """
+        start = time.time()
+        for reference in ['a' * 100000 + '!', 'a-' * 50000 + '!',
+                          'a/' * 50000 + '!', 'a:' * 50000]:
+            with ExpectedException(ValueError):
+                parse_reference(reference)
+        assert_that(time.time() - start, LessThan(5))
+
+    def test_matches_regexes(self):
+        """
+        For many random references, parse_reference and _parse_name should
+        accept exactly the same references as the reference regexes and
+        return the same parts.
+        """
+        rng = random.Random(1234)
+        for _ in range(20000):
+            reference = random_reference(rng)
+
+            match = REFERENCE_REGEX.match(reference)
+            try:
+                parsed = parse_reference(reference)
+            except ValueError:
+                parsed = None
+            if match is None:
+                assert_that(parsed, Equals(None), reference)
+            else:
+                assert_that(
+                    (parsed.name, parsed.tag, parsed.digest),
+                    Equals(match.groups()), reference)
+
+            match = ANCHORED_NAME_REGEX.match(reference)
+            parsed = _parse_name(reference)
+            if match is None:
+                assert_that(parsed, Equals(None), reference)
+            else:
+                assert_that((parsed[0], '/'.join(parsed[1])),
+                            Equals(match.groups()), reference)
+
+
 class TestJoinImageTagFunc(object):
     def test_image_and_tag(self):
         """
@@ -113,6 +260,15 @@ class TestRegistryTagger(object):
             'praekeltorg/alpine-python')
         assert_that(image, Equals('registry:5000/praekeltorg/alpine-python'))
 
+    def test_multiple_registries(self):
+        """
+        When several registries are provided, an image name should be
+        generated for each registry, in order.
+        """
+        images = RegistryTagger('registry:5000', 'registry2').generate_tags(
+            'registry3:5000/bar')
+        assert_that(images, Equals(['registry:5000/bar', 'registry2/bar']))
+
     def test_image_unparsable(self):
         """
         Given a malformed image name, replace_image_registry should throw an
@@ -353,6 +509,434 @@ class TestCmdFunc(object):
 
         assert_output_lines(capfd, ['errored'], [])
 
+    def test_returns_stdout(self, capfd):
+        """
+        The stdout output of the command should be returned.
+        """
+        out = cmd(['echo', 'Hello, World!'])
+
+        assert_that(out, Equals(b'Hello, World!\n'))
+        assert_output_lines(capfd, ['Hello, World!'])
+
+    def test_error_output_tail(self, capfd, monkeypatch):
+        """
+        When a command with a lot of output exits with a non-zero return code,
+        only the end of the output should be kept in the error, but all the
+        output should be written.
+        """
+        monkeypatch.setattr(
+            'docker_ci_deploy.__main__.OUTPUT_TAIL_SIZE', 16)
+        args = ['awk', 'BEGIN { for (i = 0; i < 1000; i++) print i; exit 1 }']
+        with ExpectedException(CalledProcessError, MatchesStructure(
+                returncode=Equals(1),
+                output=Equals(b'996\n997\n998\n999\n'))):
+            cmd(args)
+
+        assert_output_lines(capfd, [str(i) for i in range(1000)])
+
+    def test_stream(self, capfd, tmpdir):
+        """
+        When ``stream`` is True, the output of a command should be written
+        while the command is still running.
+        """
+        done_path = str(tmpdir.join('done'))
+        args = ['sh', '-c', 'echo started; while [ ! -e "$0" ]; do '
+                'sleep 0.01; done; echo finished >&2', done_path]
+        thread = threading.Thread(target=cmd, args=(args,),
+                                  kwargs={'stream': True})
+        thread.start()
+
+        out = ''
+        deadline = time.time() + 5
+        while 'started' not in out and time.time() < deadline:
+            time.sleep(0.01)
+            out += capfd.readouterr()[0]
+        open(done_path, 'w').close()
+        thread.join()
+
+        assert_that(out, Equals('started\n'))
+        assert_output_lines(capfd, [], ['finished'])
+
+    def test_stream_error(self, capfd):
+        """
+        When ``stream`` is True and the command exits with a non-zero return
+        code, the error should include the command's stdout output.
+        """
+        args = ['awk', 'BEGIN { print "errored"; exit 1 }']
+        with ExpectedException(CalledProcessError, MatchesStructure(
+                returncode=Equals(1), output=Equals(b'errored\n'))):
+            cmd(args, stream=True)
+
+        assert_output_lines(capfd, ['errored'], [])
+
+
+class TestWriteLinesFunc(object):
+    def test_output_tail(self, capfd, monkeypatch):
+        """
+        All the lines should be written, but only the end of them returned.
+        """
+        monkeypatch.setattr(
+            'docker_ci_deploy.__main__.OUTPUT_TAIL_SIZE', 16)
+        out = _write_lines(str(i) for i in range(1000))
+
+        assert_that(out, Equals(b'996\n997\n998\n999\n'))
+        assert_output_lines(capfd, [str(i) for i in range(1000)])
+
+    def test_stream(self, capfd):
+        """
+        When ``stream`` is True, each line should be written as soon as it is
+        produced.
+        """
+        written = []
+
+        def lines():
+            for line in ['a', 'b']:
+                yield line
+                written.append(capfd.readouterr()[0])
+
+        out = _write_lines(lines(), stream=True)
+
+        assert_that(written, Equals(['a\n', 'b\n']))
+        assert_that(out, Equals(b'a\nb\n'))
+
+
+def fake_docker(tmpdir, inspect_output):
+    """
+    Create an executable that prints the given output for ``docker image
+    inspect`` commands and echoes the arguments of any other command.
+    """
+    inspect_path = tmpdir.join('inspect.json')
+    inspect_path.write(json.dumps(inspect_output))
+    executable = tmpdir.join('docker')
+    executable.write('\n'.join([
+        '#!/bin/sh',
+        'if [ "$1" = image ] && [ "$2" = inspect ]; then',
+        '  cat "%s"' % (inspect_path,),
+        'else',
+        '  echo "$@"',
+        'fi',
+    ]))
+    os.chmod(str(executable), stat.S_IRWXU)
+    return str(executable)
+
+
+def assert_output_lines_unordered(capfd, stdout_lines, stderr_lines=[]):
+    out, err = capfd.readouterr()
+
+    out_lines = out.split('\n')
+    assert_that(out_lines.pop(), Equals(''))
+    assert_that(sorted(out_lines), Equals(sorted(stdout_lines)))
+
+    err_lines = err.split('\n')
+    assert_that(err_lines.pop(), Equals(''))
+    assert_that(sorted(err_lines), Equals(sorted(stderr_lines)))
+
+
+class TestRunConcurrentlyFunc(object):
+    def test_runs_all(self):
+        """
+        When given a list of functions, all the functions should be called.
+        """
+        called = []
+        run_concurrently(
+            [lambda i=i: called.append(i) for i in range(10)], jobs=3)
+
+        assert_that(sorted(called), Equals(list(range(10))))
+
+    def test_jobs_limit(self):
+        """
+        No more than ``jobs`` functions should be running at the same time.
+        """
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+
+        def func():
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        run_concurrently([func] * 12, jobs=3)
+
+        assert_that(max_running[0], Equals(3))
+
+    def test_error_stops_work(self):
+        """
+        When a function raises an error, no further functions should be
+        started and the error should be re-raised once the functions already
+        running have completed.
+        """
+        called = []
+
+        def fail():
+            raise RuntimeError('failed')
+
+        funcs = [fail] + [lambda i=i: called.append(i) for i in range(10)]
+        with ExpectedException(RuntimeError, 'failed'):
+            run_concurrently(funcs, jobs=1)
+
+        assert_that(called, Equals([]))
+
+
+class TestTaskPool(object):
+    def test_dependencies(self):
+        """
+        A task should not be started until all the tasks it depends on have
+        completed.
+        """
+        events = []
+        lock = threading.Lock()
+
+        def record(name, delay=0):
+            def func():
+                time.sleep(delay)
+                with lock:
+                    events.append(name)
+            return func
+
+        pool = TaskPool(4)
+        a = pool.submit(record('a', delay=0.02))
+        b = pool.submit(record('b'))
+        pool.submit(record('c'), after=[a, b])
+        pool.join()
+
+        assert_that(sorted(events[:2]), Equals(['a', 'b']))
+        assert_that(events[2], Equals('c'))
+
+    def test_dependency_already_done(self):
+        """
+        A task whose dependencies have already completed should be run.
+        """
+        events = []
+        pool = TaskPool(1)
+        a = pool.submit(lambda: events.append('a'))
+        while not a.done:
+            time.sleep(0.001)
+        pool.submit(lambda: events.append('b'), after=[a])
+        pool.join()
+
+        assert_that(events, Equals(['a', 'b']))
+
+    def test_error_skips_dependents(self):
+        """
+        When a task raises an error, the tasks that depend on it should not be
+        run and the error should be re-raised by ``join()``.
+        """
+        events = []
+
+        def fail():
+            raise RuntimeError('failed')
+
+        pool = TaskPool(2)
+        a = pool.submit(fail)
+        pool.submit(lambda: events.append('b'), after=[a])
+        with ExpectedException(RuntimeError, 'failed'):
+            pool.join()
+
+        assert_that(events, Equals([]))
+
+    def test_max_pending(self):
+        """
+        When the maximum number of tasks are pending, submitting another task
+        should block until a task completes.
+        """
+        release = threading.Event()
+        pool = TaskPool(1, max_pending=2)
+        pool.submit(release.wait)
+        pool.submit(lambda: None)
+
+        submitted = threading.Event()
+
+        def submit():
+            pool.submit(lambda: None)
+            submitted.set()
+        thread = threading.Thread(target=submit)
+        thread.start()
+
+        assert_that(submitted.wait(timeout=0.05), Equals(False))
+        release.set()
+        thread.join()
+        pool.join()
+        assert_that(submitted.is_set(), Equals(True))
+
+    def test_resource_limit(self):
+        """
+        No more tasks using a resource than its limit should run at once, and
+        tasks waiting for a resource should not hold up other tasks.
+        """
+        running = {'slow': 0, 'fast': 0}
+        max_running = {'slow': 0, 'fast': 0}
+        fast_done = threading.Event()
+        lock = threading.Lock()
+
+        def record(resource):
+            def func():
+                with lock:
+                    running[resource] += 1
+                    max_running[resource] = max(
+                        max_running[resource], running[resource])
+                if resource == 'slow':
+                    fast_done.wait(timeout=5)
+                with lock:
+                    running[resource] -= 1
+            return func
+
+        pool = TaskPool(4, limit={'slow': 1}.get)
+        for _ in range(3):
+            pool.submit(record('slow'), resource='slow')
+        fast = [pool.submit(record('fast'), resource='fast')
+                for _ in range(3)]
+        pool.submit(fast_done.set, after=fast)
+        pool.join()
+
+        assert_that(fast_done.is_set(), Equals(True))
+        assert_that(max_running['slow'], Equals(1))
+
+    def test_groups(self):
+        """
+        When a task in a group raises an error, the group's later tasks
+        should not be run and its ``join()`` should re-raise the error, but
+        the tasks in other groups should still be run.
+        """
+        events = []
+
+        def fail():
+            raise RuntimeError('failed')
+
+        pool = TaskPool(1)
+        failing, other = pool.group(), pool.group()
+        failing.submit(fail)
+        failing.submit(lambda: events.append('failing'))
+        other.submit(lambda: events.append('other'))
+        with ExpectedException(RuntimeError, 'failed'):
+            failing.join()
+        other.join()
+        pool.join()
+
+        assert_that(events, Equals(['other']))
+
+    def test_error_skips_blocked_tasks(self):
+        """
+        When a task using a limited resource raises an error, the tasks
+        waiting for the resource should be skipped, and ``join()`` should
+        re-raise the error rather than waiting for them forever.
+        """
+        events = []
+        errors = []
+
+        def fail():
+            time.sleep(0.05)
+            raise RuntimeError('failed')
+
+        def join():
+            try:
+                pool.join()
+            except RuntimeError as e:
+                errors.append(e)
+
+        pool = TaskPool(4, limit={'registry': 1}.get)
+        pool.submit(fail, resource='registry')
+        for _ in range(3):
+            pool.submit(lambda: events.append('pushed'), resource='registry')
+        thread = threading.Thread(target=join)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout=5)
+
+        assert_that(thread.is_alive(), Equals(False))
+        assert_that([str(e) for e in errors], Equals(['failed']))
+        assert_that(events, Equals([]))
+
+    @pytest.mark.skipif(sys.version_info < (3, 7),
+                        reason='contextvars requires Python 3.7')
+    def test_context(self):
+        """
+        Tasks should be run with the context variables set where they were
+        submitted.
+        """
+        import contextvars
+        var = contextvars.ContextVar('var', default=None)
+        values = []
+
+        pool = TaskPool(1)
+        var.set('a')
+        pool.submit(lambda: values.append(var.get()))
+        var.set('b')
+        pool.submit(lambda: values.append(var.get()))
+        pool.join()
+
+        assert_that(values, Equals(['a', 'b']))
+
+
+class TestReadImageSpecsFunc(object):
+    def test_plain_lines(self):
+        """
+        When lines contain image tags, an ImageSpec without tags or a version
+        should be returned for each line, skipping blank lines and comments.
+        """
+        specs = read_image_specs(['foo:1\n', '\n', '# comment\n', ' bar \n'])
+
+        assert_that(list(specs), Equals([
+            ImageSpec('foo:1', None, None),
+            ImageSpec('bar', None, None),
+        ]))
+
+    def test_json_lines(self):
+        """
+        When lines contain JSON objects, the image, tags and version should be
+        read from each object.
+        """
+        specs = read_image_specs([
+            '{"image": "foo:1", "tags": ["a", "b"], "version": "1.2.3"}\n',
+            '{"image": "bar"}\n',
+        ])
+
+        assert_that(list(specs), Equals([
+            ImageSpec('foo:1', ['a', 'b'], '1.2.3'),
+            ImageSpec('bar', None, None),
+        ]))
+
+    def test_invalid_json(self):
+        """
+        When a line contains invalid JSON, an error should be raised with the
+        line number.
+        """
+        specs = read_image_specs(['foo\n', '{"image": \n'])
+
+        with ExpectedException(ValueError, r'Invalid image on line 2: .*'):
+            list(specs)
+
+    def test_invalid_spec(self):
+        """
+        When a line contains a JSON object without an image or with tags that
+        aren't a list, an error should be raised.
+        """
+        with ExpectedException(
+                ValueError, r'Invalid image on line 1: .*"image".*'):
+            list(read_image_specs(['{"tags": ["a"]}']))
+
+        with ExpectedException(
+                ValueError, r'Invalid image on line 1: .*"tags".*'):
+            list(read_image_specs(['{"image": "foo", "tags": "a"}']))
+
+    def test_lazy(self):
+        """
+        Lines should only be read as the images are needed.
+        """
+        read = []
+
+        def lines():
+            for line in ['foo', 'bar']:
+                read.append(line)
+                yield line
+
+        specs = read_image_specs(lines())
+        assert_that(next(specs), Equals(ImageSpec('foo', None, None)))
+        assert_that(read, Equals(['foo']))
+
 
 class TestGenerateTagsFunc(object):
     def test_no_tags(self):
@@ -392,6 +976,22 @@ class TestGenerateTagsFunc(object):
 
         assert_that(tags, Equals(['test-image:def', 'test-image:ghi']))
 
+    def test_multiple_registries(self):
+        """
+        When the registry tagger has several registries, each of the tags
+        should be generated for each registry.
+        """
+        tags = generate_tags(
+            'test-image:abc', tags=['def', 'ghi'],
+            registry_tagger=RegistryTagger('registry:5000', 'registry2'))
+
+        assert_that(tags, Equals([
+            'registry:5000/test-image:def',
+            'registry:5000/test-image:ghi',
+            'registry2/test-image:def',
+            'registry2/test-image:ghi',
+        ]))
+
     # FIXME?: The following 2 tests describe a weird, unintuitive edge case :-(
     # Passing `--tag latest` with `--version <version>` but *not*
     # `--version-latest` doesn't actually get you the tag 'latest' but rather
@@ -503,6 +1103,350 @@ class TestDockerCiDeployRunner(object):
 
         assert_output_lines(capfd, ['docker push foo'])
 
+    def test_push_digest(self, capfd, tmpdir):
+        """
+        When a tag is pushed, the digest in the output should be returned.
+        """
+        digest = 'sha256:' + 'a' * 64
+        executable = tmpdir.join('docker')
+        executable.write('\n'.join([
+            '#!/bin/sh',
+            'echo "The push refers to repository [foo]"',
+            'echo "latest: digest: %s size: 528"' % (digest,),
+        ]))
+        os.chmod(str(executable), stat.S_IRWXU)
+
+        runner = DockerCiDeployRunner(executable=str(executable))
+        assert_that(runner.docker_push('foo'), Equals(digest))
+
+    def test_registry_connections(self, capfd, tmpdir, monkeypatch):
+        """
+        The registry clients should share one pool of connections, and the
+        connection statistics should be logged when the runner is closed in
+        verbose mode.
+        """
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        with FakeRegistry() as registry:
+            registry.add_manifest('foo', 'a', make_manifest())
+            runner = DockerCiDeployRunner(
+                verbose=True, insecure_registries=[registry.domain])
+            runner.registry_tag('%s/foo:a' % (registry.domain,),
+                                ['%s/foo:b' % (registry.domain,)])
+            runner.registry_tag('%s/foo:a' % (registry.domain,),
+                                ['%s/foo:c' % (registry.domain,)])
+            runner.close()
+
+            assert_that(runner.registry_client('other').pool,
+                        Is(runner.registry_client(registry.domain).pool))
+
+        out, _ = capfd.readouterr()
+        assert_that(out.splitlines()[-1], Equals(
+            'Registry connections: 4 requests, 1 opened, 3 reused'))
+
+    def test_dedupe(self):
+        """
+        When ``dedupe`` is called, the target tags of identical source images
+        should be merged, and repeated target tags should be removed.
+        """
+        runner = DockerCiDeployRunner()
+        tag_map = runner.dedupe([
+            ('foo', ['foo:a', 'foo:b']),
+            ('bar', ['bar:a']),
+            ('foo', ['foo:b', 'foo:c']),
+        ])
+
+        assert_that(tag_map, Equals([
+            ('foo', ['foo:a', 'foo:b', 'foo:c']),
+            ('bar', ['bar:a']),
+        ]))
+
+    def test_dedupe_image_ids(self):
+        """
+        When ``dedupe`` is called with the images' details, the target tags of
+        source images with the same ID should be merged.
+        """
+        runner = DockerCiDeployRunner()
+        tag_map = runner.dedupe([
+            ('foo:latest', ['reg/foo:latest']),
+            ('foo:alpine', ['reg/foo:alpine']),
+            ('bar', ['reg/bar:latest']),
+        ], {
+            'foo:latest': {'Id': 'sha256:abc'},
+            'foo:alpine': {'Id': 'sha256:abc'},
+            'bar': {'Id': 'sha256:def'},
+        })
+
+        assert_that(tag_map, Equals([
+            ('foo:latest', ['reg/foo:latest', 'reg/foo:alpine']),
+            ('bar', ['reg/bar:latest']),
+        ]))
+
+    def test_dedupe_conflict(self):
+        """
+        When ``dedupe`` is called with the images' details, and two different
+        source images have the same target tag, an error should be raised.
+        """
+        runner = DockerCiDeployRunner()
+        with ExpectedException(ValueError, (
+                r'The tag "foo:x" would be pushed from both "foo:a" and '
+                r'"foo:b"')):
+            runner.dedupe([('foo:a', ['foo:x']), ('foo:b', ['foo:x'])], {
+                'foo:a': {'Id': 'sha256:abc'},
+                'foo:b': {'Id': 'sha256:def'},
+            })
+
+    def test_dedupe_conflict_without_details(self):
+        """
+        When ``dedupe`` is called without the images' details, and two
+        different source image tags have the same target tag, the target tag
+        should be pushed from both, as they may be the same image.
+        """
+        runner = DockerCiDeployRunner()
+        tag_map = runner.dedupe(
+            [('foo', ['foo:x']), ('foo:latest', ['foo:x'])])
+
+        assert_that(tag_map, Equals([
+            ('foo', ['foo:x']),
+            ('foo:latest', ['foo:x']),
+        ]))
+
+    def test_dedupe_previous_calls(self):
+        """
+        When ``dedupe`` is called more than once, target tags from earlier
+        calls should be removed if they are from the same image, and should
+        conflict if they aren't.
+        """
+        runner = DockerCiDeployRunner()
+        details = {
+            'foo:a': {'Id': 'sha256:abc'},
+            'foo:b': {'Id': 'sha256:def'},
+        }
+        runner.dedupe([('foo:a', ['foo:x'])], details)
+
+        assert_that(runner.dedupe([('foo:a', ['foo:x', 'foo:y'])], details),
+                    Equals([('foo:a', ['foo:y'])]))
+        with ExpectedException(ValueError, r'The tag "foo:y" .*'):
+            runner.dedupe([('foo:b', ['foo:y'])], details)
+
+    def test_dedupe_previous_calls_without_details(self):
+        """
+        When ``dedupe`` is called more than once without the images' details,
+        target tags shouldn't be remembered between calls, so that memory use
+        doesn't grow with the number of images.
+        """
+        runner = DockerCiDeployRunner()
+        runner.dedupe([('foo:a', ['foo:x'])])
+
+        assert_that(runner.dedupe([('foo:a', ['foo:x', 'foo:y'])]),
+                    Equals([('foo:a', ['foo:x', 'foo:y'])]))
+        assert_that(runner._targets, Equals({}))
+
+    LAYER_DETAILS = {
+        'base': {'RootFS': {'Layers': ['a']}, 'Size': 100},
+        'app1': {'RootFS': {'Layers': ['a', 'b']}, 'Size': 150},
+        'app2': {'RootFS': {'Layers': ['a', 'c']}, 'Size': 300},
+        'other': {'RootFS': {'Layers': ['x']}, 'Size': 120},
+    }
+
+    def test_schedule(self, capfd):
+        """
+        When ``schedule`` is called, images that share layers with a base
+        image should be ordered after it, and the images with the most work
+        depending on them should be first.
+        """
+        runner = DockerCiDeployRunner(verbose=True)
+        tag_map = runner.schedule([
+            ('app1', ['app1:a']),
+            ('app2', ['app2:a']),
+            ('other', ['other:a']),
+            ('base', ['base:a']),
+        ], self.LAYER_DETAILS)
+
+        assert_that([image for image, _ in tag_map], Equals(
+            ['base', 'app2', 'other', 'app1']))
+        assert_output_lines(capfd, [
+            'Push plan: 1. "base" (100 B, 1 layers)',
+            'Push plan: 2. "app2" (300 B, 2 layers) after "base"',
+            'Push plan: 3. "other" (120 B, 1 layers)',
+            'Push plan: 4. "app1" (150 B, 2 layers) after "base"',
+        ])
+
+    def test_deploy_scheduled(self):
+        """
+        When ``deploy`` is called, and jobs is greater than 1, images that
+        were scheduled after a base image should be tagged straight away but
+        not pushed until the base image has been pushed.
+        """
+        events = []
+        lock = threading.Lock()
+
+        class RecordingRunner(DockerCiDeployRunner):
+            def _docker_cmd(self, args):
+                if args == ['push', 'base:a']:
+                    time.sleep(0.02)
+                with lock:
+                    events.append(tuple(args))
+
+        runner = RecordingRunner(jobs=4)
+        runner.deploy(runner.schedule([
+            ('base', ['base:a']), ('app1', ['app1:a']), ('other', ['other:a']),
+        ], self.LAYER_DETAILS))
+
+        assert_that(events.index(('push', 'app1:a')), GreaterThan(
+            events.index(('push', 'base:a'))))
+        assert_that(events.index(('tag', 'app1', 'app1:a')), LessThan(
+            events.index(('push', 'base:a'))))
+        assert_that(events.index(('push', 'other:a')), LessThan(
+            events.index(('push', 'base:a'))))
+
+    def test_deploy(self, capfd):
+        """
+        When ``deploy`` is called, all the images should be tagged before any
+        of the tags are pushed.
+        """
+        runner = DockerCiDeployRunner(executable='echo')
+        runner.deploy([('foo', ['foo:a', 'foo:b']), ('bar', ['bar:a'])])
+
+        assert_output_lines(capfd, [
+            'tag foo foo:a',
+            'tag foo foo:b',
+            'tag bar bar:a',
+            'push foo:a',
+            'push foo:b',
+            'push bar:a',
+        ])
+
+    def test_deploy_jobs(self, capfd):
+        """
+        When ``deploy`` is called, and jobs is greater than 1, the same
+        commands should be run as when the commands are run serially, with the
+        output of each command kept intact.
+        """
+        runner = DockerCiDeployRunner(executable='echo', jobs=4)
+        runner.deploy([('foo', ['foo:a', 'foo:b']), ('bar', ['bar:a'])])
+
+        assert_output_lines_unordered(capfd, [
+            'tag foo foo:a',
+            'tag foo foo:b',
+            'tag bar bar:a',
+            'push foo:a',
+            'push foo:b',
+            'push bar:a',
+        ])
+
+    def test_deploy_jobs_pipelined(self):
+        """
+        When ``deploy`` is called, and jobs is greater than 1, the tags for an
+        image should be pushed once that image's tags have been created, even
+        if other images have not been tagged yet. All of an image's tags should
+        be created before any of them are pushed.
+        """
+        events = []
+        first_push = threading.Event()
+
+        class RecordingRunner(DockerCiDeployRunner):
+            def _docker_cmd(self, args):
+                if args == ['tag', 'bar', 'bar:a']:
+                    # Don't finish tagging 'bar' until 'foo' is being pushed
+                    assert first_push.wait(timeout=5)
+                events.append(tuple(args))
+                if args[0] == 'push':
+                    first_push.set()
+
+        runner = RecordingRunner(jobs=2)
+        runner.deploy([('foo', ['foo:a', 'foo:b']), ('bar', ['bar:a'])])
+
+        assert_that(events.index(('push', 'foo:a')), LessThan(
+            events.index(('tag', 'bar', 'bar:a'))))
+        for push in [('push', 'foo:a'), ('push', 'foo:b')]:
+            assert_that(events.index(push), GreaterThan(
+                events.index(('tag', 'foo', 'foo:b'))))
+        assert_that(events.index(('push', 'bar:a')), GreaterThan(
+            events.index(('tag', 'bar', 'bar:a'))))
+
+    def test_deploy_jobs_error(self, capfd):
+        """
+        When ``deploy`` is called, and jobs is greater than 1, and a command
+        fails, the error should be raised and no tags should be pushed.
+        """
+        runner = DockerCiDeployRunner(executable='false', jobs=4)
+        with ExpectedException(CalledProcessError):
+            runner.deploy([('foo', ['foo:a', 'foo:b']), ('bar', ['bar:a'])])
+
+        assert_output_lines(capfd, [], [])
+
+    def test_deploy_batches(self, capfd):
+        """
+        When ``deploy`` is called with more images than the batch size, each
+        batch of images should be tagged and pushed before the next batch.
+        """
+        runner = DockerCiDeployRunner(executable='echo')
+        runner.batch_size = 1
+        runner.deploy([('foo', ['foo:a', 'foo:b']), ('bar', ['bar:a'])])
+
+        assert_output_lines(capfd, [
+            'tag foo foo:a',
+            'tag foo foo:b',
+            'push foo:a',
+            'push foo:b',
+            'tag bar bar:a',
+            'push bar:a',
+        ])
+
+    def test_deploy_streams_images(self):
+        """
+        When ``deploy`` is called with a generator, images should be pushed
+        before the rest of the images have been generated.
+        """
+        pushed = threading.Event()
+
+        class RecordingRunner(DockerCiDeployRunner):
+            def _docker_cmd(self, args):
+                if args == ['push', 'foo:a']:
+                    pushed.set()
+
+        def tag_map():
+            yield 'foo', ['foo:a']
+            assert pushed.wait(timeout=5)
+            yield 'bar', ['bar:a']
+
+        for jobs in [1, 2]:
+            pushed.clear()
+            runner = RecordingRunner(jobs=jobs)
+            runner.batch_size = 1
+            runner.deploy(tag_map())
+
+    def test_deploy_registry_jobs(self):
+        """
+        When ``deploy`` is called with a limit on the number of pushes to a
+        registry, pushes to that registry should be limited while pushes to
+        other registries continue.
+        """
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        class RecordingRunner(DockerCiDeployRunner):
+            def _docker_cmd(self, args):
+                if args[0] != 'push':
+                    return
+                with lock:
+                    running.append(args[1])
+                    max_running.append(
+                        len([t for t in running if t.startswith('slow')]))
+                time.sleep(0.01)
+                with lock:
+                    running.remove(args[1])
+
+        runner = RecordingRunner(jobs=4, registry_jobs={'slow.example.com': 1})
+        runner.deploy([
+            ('foo', ['slow.example.com/foo:a', 'slow.example.com/foo:b',
+                     'fast.example.com/foo:a', 'fast.example.com/foo:b']),
+            ('bar', ['slow.example.com/bar:a', 'fast.example.com/bar:a']),
+        ])
+
+        assert_that(max(max_running), Equals(1))
+
 
 class TestMainFunc(object):
     def test_args(self, capfd):
@@ -579,25 +1523,107 @@ class TestMainFunc(object):
 
     def test_image_required(self, capfd):
         """
-        When the main function is given no image argument, it should exit with
-        a return code of 2 and inform the user of the missing argument.
+        When the main function is given no image argument and no file to read
+        images from, it should exit with a return code of 2 and inform the
+        user of the missing argument.
         """
         with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
             main(['--tag', 'abc'])
 
         out, err = capfd.readouterr()
         assert_that(out, Equals(''))
+        assert_that(err, MatchesRegex(
+            r'.*error: at least one image or the --from-file option is '
+            r'required$',
+            re.DOTALL
+        ))
 
-        # More useful error message added to argparse in Python 3
-        if sys.version_info >= (3,):
-            # Use re.DOTALL so that '.*' also matches newlines
-            assert_that(err, MatchesRegex(
-                r'.*error: the following arguments are required: image$',
-                re.DOTALL
-            ))
-        else:
-            assert_that(
-                err, MatchesRegex(r'.*error: too few arguments$', re.DOTALL))
+    def test_from_file(self, capfd, tmpdir):
+        """
+        When the --from-file option is used, the images in the file should be
+        pushed after the images given as arguments, using the tags and
+        version given for each image in the file.
+        """
+        images = tmpdir.join('images.jsonl')
+        images.write('\n'.join([
+            'test-image2',
+            '{"image": "test-image3:abc", "tags": ["def"]}',
+            '{"image": "test-image4", "version": "2.0"}',
+        ]))
+        main([
+            '--executable', 'echo',
+            '--version', '1.0',
+            '--from-file', str(images),
+            'test-image:abc',
+        ])
+
+        assert_output_lines(capfd, [
+            'tag test-image:abc test-image:1.0-abc',
+            'tag test-image2 test-image2:1.0',
+            'tag test-image3:abc test-image3:1.0-def',
+            'tag test-image4 test-image4:2.0',
+            'push test-image:1.0-abc',
+            'push test-image2:1.0',
+            'push test-image3:1.0-def',
+            'push test-image4:2.0',
+        ])
+
+    def test_from_file_invalid(self, capfd, tmpdir):
+        """
+        When a line of the file given with the --from-file option isn't a
+        valid image, the command should exit with a return code of 2 and
+        say which line it was.
+        """
+        images = tmpdir.join('images.jsonl')
+        images.write('test-image\n{"tags": ["abc"]}\n')
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--executable', 'echo', '--from-file', str(images)])
+
+        _, err = capfd.readouterr()
+        assert_that(err, MatchesRegex(
+            r'.*error: Invalid image on line 2: expected an object with an '
+            r'"image" string$', re.DOTALL))
+
+    def test_from_file_stdin(self, capfd, monkeypatch):
+        """
+        When the --from-file option is given '-', the images should be read
+        from stdin, and the --version-semver option can be used without
+        --version for images that have their own version.
+        """
+        monkeypatch.setattr(sys, 'stdin', io.StringIO(
+            u'{"image": "test-image", "version": "1.2"}\n'))
+        main([
+            '--executable', 'echo',
+            '--version-semver',
+            '--from-file', '-',
+        ])
+
+        assert_output_lines(capfd, [
+            'tag test-image test-image:1.2',
+            'tag test-image test-image:1',
+            'push test-image:1.2',
+            'push test-image:1',
+        ])
+
+    def test_from_file_without_versions(self, capfd, monkeypatch):
+        """
+        When the --version-latest and --version-semver options are used with
+        the --from-file option, but no image has a version and --version
+        isn't given either, the images should be pushed and a warning that
+        the options had no effect should be printed.
+        """
+        monkeypatch.setattr(sys, 'stdin', io.StringIO(u'test-image\n'))
+        main([
+            '--executable', 'echo',
+            '--version-latest', '--version-semver',
+            '--from-file', '-',
+        ])
+
+        assert_output_lines(capfd, ['push test-image'], [
+            'WARNING: the --version-latest and --version-semver options had '
+            'no effect, as neither --version nor a "version" for any image '
+            'was given',
+        ])
 
     def test_version_latest_requires_version(self, capfd):
         """
@@ -717,6 +1743,727 @@ class TestMainFunc(object):
             'push test-image:ghi'
         ])
 
+    def test_jobs(self, capfd):
+        """
+        When the --jobs option is used, the same Docker commands should be
+        run.
+        """
+        main([
+            '--tag', 'abc', 'def',
+            '--executable', 'echo',
+            '--jobs', '3',
+            'test-image:xyz', 'test-image2',
+        ])
+
+        assert_output_lines_unordered(capfd, [
+            'tag test-image:xyz test-image:abc',
+            'tag test-image:xyz test-image:def',
+            'tag test-image2 test-image2:abc',
+            'tag test-image2 test-image2:def',
+            'push test-image:abc',
+            'push test-image:def',
+            'push test-image2:abc',
+            'push test-image2:def',
+        ])
+
+    def test_push_once(self, capfd, tmpdir, monkeypatch):
+        """
+        When the --push-once option is used, only one tag for each image
+        should be tagged and pushed with Docker and the remaining tags should
+        be added using the registry API.
+        """
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        manifest = make_manifest(layers=[b'abc'])
+        with FakeRegistry() as registry:
+            # Pretend the push by 'echo' actually pushed the image
+            registry.add_manifest('test-image', '1.2.3', manifest)
+            main([
+                '--executable', 'echo',
+                '--registry', registry.domain,
+                '--insecure-registry', registry.domain,
+                '--version', '1.2.3', '--version-semver', '--version-latest',
+                '--push-once',
+                'test-image',
+            ])
+
+            for tag in ['1.2', '1', 'latest']:
+                assert_that(registry.get_manifest('test-image', tag)[1],
+                            Equals(manifest))
+
+        assert_output_lines(capfd, [
+            'tag test-image %s/test-image:1.2.3' % (registry.domain,),
+            'push %s/test-image:1.2.3' % (registry.domain,),
+        ])
+
+    def test_push_once_dry_run(self, capfd):
+        """
+        When the --push-once option is used with --dry-run, the tags that
+        would be added using the registry API should be printed.
+        """
+        main([
+            '--dry-run',
+            '--version', '1.2.3', '--version-latest',
+            '--push-once',
+            'test-image',
+        ])
+
+        assert_output_lines(capfd, [
+            'docker tag test-image test-image:1.2.3',
+            'docker push test-image:1.2.3',
+            'Tagging "test-image:1.2.3" as "test-image:latest" in the '
+            'registry...',
+        ])
+
+    def test_skip_unchanged(self, capfd, tmpdir, monkeypatch):
+        """
+        When the --skip-unchanged option is used, tags that the registry
+        already has for the same image should not be tagged or pushed.
+        """
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        with FakeRegistry() as registry:
+            name = '%s/test-image' % (registry.domain,)
+            digest = registry.add_manifest(
+                'test-image', '1.2.3', make_manifest(layers=[b'new']))
+            registry.add_manifest(
+                'test-image', 'latest', make_manifest(layers=[b'old']))
+            executable = fake_docker(tmpdir, [{
+                'Id': 'sha256:abc',
+                'RepoDigests': ['%s@%s' % (name, digest)],
+            }])
+
+            main([
+                '--executable', executable,
+                '--registry', registry.domain,
+                '--insecure-registry', registry.domain,
+                '--version', '1.2.3', '--version-semver', '--version-latest',
+                '--skip-unchanged',
+                'test-image',
+            ])
+
+            assert_that(registry.requests, Equals([
+                ('GET', '/v2/test-image/tags/list'),
+                ('HEAD', '/v2/test-image/manifests/1.2.3'),
+                ('HEAD', '/v2/test-image/manifests/latest'),
+            ]))
+
+        assert_output_lines(capfd, [
+            'tag test-image %s:1.2' % (name,),
+            'tag test-image %s:1' % (name,),
+            'tag test-image %s:latest' % (name,),
+            'push %s:1.2' % (name,),
+            'push %s:1' % (name,),
+            'push %s:latest' % (name,),
+        ])
+
+    def test_cache(self, capfd, tmpdir):
+        """
+        When the --cache-file option is used, tags that were pushed from the
+        same image before should not be tagged or pushed again, unless the
+        --no-cache option is used.
+        """
+        cache_file = str(tmpdir.join('cache.json'))
+        args = ['--cache-file', cache_file, '--tag', 'a', 'b', '--',
+                'test-image']
+
+        main(['--executable', fake_docker(tmpdir, [{'Id': 'sha256:abc'}])] +
+             args)
+        assert_output_lines(capfd, [
+            'tag test-image test-image:a',
+            'tag test-image test-image:b',
+            'push test-image:a',
+            'push test-image:b',
+        ])
+
+        main(['--executable', fake_docker(tmpdir, [{'Id': 'sha256:abc'}])] +
+             args)
+        assert_output_lines(capfd, [])
+
+        main(['--executable', fake_docker(tmpdir, [{'Id': 'sha256:abc'}]),
+              '--no-cache'] + args)
+        assert_output_lines(capfd, [
+            'tag test-image test-image:a',
+            'tag test-image test-image:b',
+            'push test-image:a',
+            'push test-image:b',
+        ])
+
+        main(['--executable', fake_docker(tmpdir, [{'Id': 'sha256:def'}])] +
+             args)
+        assert_output_lines(capfd, [
+            'tag test-image test-image:a',
+            'tag test-image test-image:b',
+            'push test-image:a',
+            'push test-image:b',
+        ])
+
+    def test_dedupe(self, capfd, tmpdir):
+        """
+        When the --dedupe option is used, images with the same ID should be
+        tagged and pushed together.
+        """
+        executable = fake_docker(
+            tmpdir, [{'Id': 'sha256:abc'}, {'Id': 'sha256:abc'}])
+        main([
+            '--executable', executable,
+            '--registry', 'registry.example.com',
+            '--dedupe',
+            'test-image:latest', 'test-image:alpine',
+        ])
+
+        assert_output_lines(capfd, [
+            'tag test-image:latest registry.example.com/test-image:latest',
+            'tag test-image:latest registry.example.com/test-image:alpine',
+            'push registry.example.com/test-image:latest',
+            'push registry.example.com/test-image:alpine',
+        ])
+
+    def test_conflicting_tags(self, capfd, tmpdir):
+        """
+        When the --dedupe option is used and two different images would be
+        pushed with the same tag, the main function should exit with a return
+        code of 2 and report the conflict before the images are tagged or
+        pushed.
+        """
+        executable = fake_docker(
+            tmpdir, [{'Id': 'sha256:abc'}, {'Id': 'sha256:def'}])
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main([
+                '--executable', executable,
+                '--dedupe',
+                '--tag', 'abc', '--',
+                'test-image:latest', 'test-image:alpine',
+            ])
+
+        out, err = capfd.readouterr()
+        assert_that(out, Equals(''))
+        assert_that(err, MatchesRegex(
+            r'.*error: The tag "test-image:abc" would be pushed from both '
+            r'"test-image:latest" and "test-image:alpine"$',
+            re.DOTALL
+        ))
+
+    def test_same_tag_without_dedupe(self, capfd):
+        """
+        When two images would be pushed with the same tag, but the --dedupe
+        option isn't used, the images should be tagged and pushed as they
+        were given, as they may be the same image.
+        """
+        main([
+            '--executable', 'echo',
+            '--tag', 'abc', '--',
+            'test-image:latest', 'test-image:alpine',
+        ])
+
+        assert_output_lines(capfd, [
+            'tag test-image:latest test-image:abc',
+            'tag test-image:alpine test-image:abc',
+            'push test-image:abc',
+            'push test-image:abc',
+        ])
+
+    def test_same_image_without_dedupe(self, capfd, tmpdir):
+        """
+        When images with the same ID are inspected for another option, but
+        the --dedupe option isn't used, they should be tagged and pushed
+        separately.
+        """
+        executable = fake_docker(
+            tmpdir, [{'Id': 'sha256:abc'}, {'Id': 'sha256:abc'}])
+        main([
+            '--executable', executable,
+            '--cache-file', str(tmpdir.join('cache.json')),
+            '--registry', 'registry.example.com',
+            'test-image:latest', 'test-image:alpine',
+        ])
+
+        assert_output_lines_unordered(capfd, [
+            'tag test-image:latest registry.example.com/test-image:latest',
+            'tag test-image:alpine registry.example.com/test-image:alpine',
+            'push registry.example.com/test-image:latest',
+            'push registry.example.com/test-image:alpine',
+        ])
+
+    def test_layer_schedule_dry_run(self, capfd, tmpdir):
+        """
+        When the --layer-schedule option is used in a dry run, the images
+        should be inspected and the plan should be printed, along with the
+        Docker commands in the planned order.
+        """
+        executable = fake_docker(tmpdir, [
+            {'Id': 'sha256:1', 'RootFS': {'Layers': ['a', 'b']}, 'Size': 2000},
+            {'Id': 'sha256:2', 'RootFS': {'Layers': ['a']}, 'Size': 1500},
+        ])
+        main([
+            '--executable', executable,
+            '--layer-schedule',
+            '--dry-run',
+            'app', 'base',
+        ])
+
+        assert_output_lines(capfd, [
+            'Push plan: 1. "base" (1.5 kB, 1 layers)',
+            'Push plan: 2. "app" (2.0 kB, 2 layers) after "base"',
+            '%s push base' % (executable,),
+            '%s push app' % (executable,),
+        ])
+
+    def test_skip_unchanged_dry_run(self, capfd):
+        """
+        When the --skip-unchanged option is used with --dry-run, the command
+        to inspect the images should be printed and no tags should be
+        skipped.
+        """
+        main(['--dry-run', '--skip-unchanged', 'test-image:abc'])
+
+        assert_output_lines(capfd, [
+            'docker image inspect test-image:abc',
+            'docker push test-image:abc',
+        ])
+
+    def test_engine_backend(self, capfd, socket_path, tmpdir, monkeypatch):
+        """
+        When the --backend engine option is used, the images should be tagged
+        and pushed using the Docker Engine API and the push progress should be
+        printed.
+        """
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        with FakeDockerEngine(socket_path, ['test-image:abc']) as engine:
+            main([
+                '--backend', 'engine',
+                '--docker-socket', socket_path,
+                '--version', '1.2.3',
+                'test-image:abc',
+            ])
+
+        image_id = engine.images['test-image:abc']
+        assert_that(engine.images['test-image:1.2.3-abc'], Equals(image_id))
+        assert_that(engine.connections, Equals(1))
+        assert_that(engine.requests, Equals([
+            ('POST', '/images/test-image:abc/tag',
+             {'repo': 'test-image', 'tag': '1.2.3-abc'}),
+            ('POST', '/images/test-image/push', {'tag': '1.2.3-abc'}),
+        ]))
+        assert_output_lines(capfd, [
+            'The push refers to repository [test-image]',
+            '%s: Preparing' % (image_id[7:19],),
+            '%s: Pushed' % (image_id[7:19],),
+            '1.2.3-abc: digest: %s size: 528' % (image_id,),
+        ])
+
+    def test_metrics_file(self, socket_path, tmpdir, monkeypatch):
+        """
+        When the --metrics-file option is used, metrics for the run should be
+        written to the file when it finishes, as JSON if the path ends in
+        '.json' and in the Prometheus text format otherwise.
+        """
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        json_path = tmpdir.join('metrics.json')
+        prom_path = tmpdir.join('metrics.prom')
+        with FakeDockerEngine(socket_path, ['test-image:abc']):
+            main([
+                '--tag', 'a', 'b',
+                '--backend', 'engine',
+                '--docker-socket', socket_path,
+                '--metrics-file', str(json_path),
+                '--metrics-file', str(prom_path),
+                'test-image:abc',
+            ])
+
+        summary = json.loads(json_path.read())
+        assert_that(summary['succeeded'], Equals(True))
+        assert_that(
+            [(o['operation'], o['registry'], o['count'])
+             for o in summary['operations']],
+            Equals([
+                ('generate-tags', None, 1),
+                ('push', 'docker.io', 2),
+                ('tag', None, 2),
+            ]))
+        assert_that(summary['counters'], Equals([
+            {'name': 'layers', 'value': 2,
+             'labels': {'registry': 'docker.io', 'status': 'pushed'}},
+            {'name': 'manifest_bytes', 'value': 2 * 528,
+             'labels': {'registry': 'docker.io'}},
+        ]))
+        assert_that(prom_path.read().splitlines(), Contains(
+            'docker_ci_deploy_operation_duration_seconds_count'
+            '{operation="push",registry="docker.io"} 2'))
+
+    def test_trace_file(self, socket_path, tmpdir, monkeypatch):
+        """
+        When the --trace-file option is used, a timeline of the run should be
+        written to the file, with the work done by each worker on its own
+        track.
+        """
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        path = tmpdir.join('trace.json')
+        with FakeDockerEngine(socket_path, ['test-image:abc']):
+            main([
+                '--tag', 'a', 'b',
+                '--backend', 'engine',
+                '--docker-socket', socket_path,
+                '--jobs', '2',
+                '--trace-file', str(path),
+                'test-image:abc',
+            ])
+
+        events = json.loads(path.read())['traceEvents']
+        tracks = dict((e['tid'], e['args']['name']) for e in events
+                      if e['name'] == 'thread_name')
+        spans = [(e['name'], tracks[e['tid']]) for e in events
+                 if e['ph'] == 'X']
+        assert_that(sorted(n for n, track in spans if track == 'MainThread'),
+                    Equals(['deploy', 'generate_tags', 'parse arguments']))
+        assert_that(sorted(n for n, track in spans
+                           if track.startswith('worker-')),
+                    Equals(['docker push', 'docker push',
+                            'docker tag', 'docker tag']))
+
+    def test_engine_backend_dry_run(self, capfd):
+        """
+        When the --backend engine option is used with --dry-run, the
+        equivalent Docker commands should be printed.
+        """
+        main(['--backend', 'engine', '--dry-run', '--tag', 'abc', '--',
+              'test-image'])
+
+        assert_output_lines(capfd, [
+            'docker tag test-image test-image:abc',
+            'docker push test-image:abc',
+        ])
+
+    def test_docker_socket_requires_engine_backend(self, capfd):
+        """
+        When the --docker-socket option is used without --backend engine, an
+        error should be raised.
+        """
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--docker-socket', '/tmp/docker.sock', 'test-image'])
+
+        out, err = capfd.readouterr()
+        assert_that(out, Equals(''))
+        assert_that(err, MatchesRegex(
+            r'.*error: the --docker-socket option requires --backend '
+            r'engine$', re.DOTALL))
+
+    @pytest.mark.skipif(sys.version_info < (3, 4),
+                        reason='tracemalloc requires Python 3.4')
+    def test_profile_mem(self, capfd, tmpdir):
+        """
+        When the --profile mem option is used, a memory report should be
+        written with a snapshot after each phase of the deploy.
+        """
+        path = tmpdir.join('mem.txt')
+        main(['--profile', 'mem', '--profile-file', str(path), '--dry-run',
+              '--tag', 'a', 'b', '--', 'test-image'])
+
+        checkpoints = [line for line in path.read().splitlines()
+                       if line.startswith('===')]
+        assert_that(checkpoints, Equals([
+            '=== 1. tags generated ===',
+            '=== 2. tagged ===',
+            '=== 3. pushed ===',
+            '=== 4. end ===',
+        ]))
+
+    @pytest.mark.skipif(sys.version_info >= (3, 4),
+                        reason='tracemalloc is available')
+    def test_profile_mem_unavailable(self, capfd):
+        """
+        When the --profile mem option is used without tracemalloc, an error
+        should be raised.
+        """
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--profile', 'mem', '--dry-run', 'test-image'])
+
+        _, err = capfd.readouterr()
+        assert_that(err, MatchesRegex(
+            r'.*error: Memory profiling requires Python 3.4 or later$',
+            re.DOTALL))
+
+    def test_profile_file_requires_profile(self, capfd):
+        """
+        When the --profile-file option is used without --profile, an error
+        should be raised.
+        """
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--profile-file', 'cpu.prof', 'test-image'])
+
+        out, err = capfd.readouterr()
+        assert_that(out, Equals(''))
+        assert_that(err, MatchesRegex(
+            r'.*error: the --profile-file option requires --profile$',
+            re.DOTALL))
+
+    @pytest.mark.needs_contextvars
+    def test_daemon(self, capfd, socket_path, monkeypatch):
+        """
+        When a deploy daemon's address is given, the command should be run
+        by the daemon and its output written.
+        """
+        monkeypatch.setenv('DOCKER_CI_DEPLOY_DAEMON', 'unix://' + socket_path)
+        with running_daemon(socket_path):
+            main(['--dry-run', '--tag', 'abc', '--', 'test-image'])
+
+        out, _ = capfd.readouterr()
+        assert_that(out, Equals('docker tag test-image test-image:abc\n'
+                                'docker push test-image:abc\n'))
+
+    @pytest.mark.needs_contextvars
+    def test_daemon_failure(self, socket_path, monkeypatch):
+        """
+        When the command run by a deploy daemon fails, the command should
+        exit with the same status.
+        """
+        with running_daemon(socket_path), ExpectedException(
+                SystemExit, MatchesStructure(code=Equals(1))):
+            main(['--daemon', 'unix://' + socket_path, '--executable',
+                  'false', 'test-image'])
+
+    def test_daemon_profile(self, capfd):
+        """
+        When the --profile option is used with a deploy daemon, an error
+        should be raised.
+        """
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--daemon', 'unix:///run/dcd.sock', '--profile', 'cpu',
+                  'test-image'])
+
+        _, err = capfd.readouterr()
+        assert_that(err, MatchesRegex(
+            r".*error: the --profile option can't be used with a deploy "
+            r'daemon$', re.DOTALL))
+
+    def test_image_named_serve(self, capfd, monkeypatch):
+        """
+        When the first argument is an image named "serve", the image should
+        be deployed rather than a deploy daemon run.
+        """
+        monkeypatch.delenv('DOCKER_CI_DEPLOY_DAEMON', raising=False)
+        main(['serve', '--executable', 'echo'])
+
+        assert_output_lines(capfd, ['push serve'])
+
+    def test_serve_not_first(self, capfd):
+        """
+        When the --serve option isn't the first argument, an error should be
+        raised.
+        """
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--executable', 'echo', '--serve', 'test-image'])
+
+        _, err = capfd.readouterr()
+        assert_that(err, MatchesRegex(
+            r'.*error: the --serve option must be the first argument$',
+            re.DOTALL))
+
+    @pytest.mark.needs_contextvars
+    def test_serve_without_listen(self, capfd, monkeypatch):
+        """
+        When the --serve option is the first argument, the deploy daemon's
+        options should be parsed instead.
+        """
+        monkeypatch.delenv('DOCKER_CI_DEPLOY_DAEMON', raising=False)
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--serve', '--jobs', '2'])
+
+        _, err = capfd.readouterr()
+        assert_that(err, MatchesRegex(
+            r'.*--serve: error: the --listen option is required$',
+            re.DOTALL))
+
+    def test_archive_backend(self, capfd, tmpdir, monkeypatch):
+        """
+        When the archive backend is used without any images, all the images
+        in the archive should be tagged and pushed to the registry.
+        """
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        path = str(tmpdir.join('images.tar'))
+        write_docker_archive(path, [
+            (['test-image:latest'], [b'base']),
+            (['other-image:1'], [b'base', b'other']),
+        ])
+        with FakeRegistry() as registry:
+            main([
+                '--backend', 'archive', '--archive', path,
+                '--registry', registry.domain,
+                '--insecure-registry', registry.domain,
+                '--tag', 'abc', 'def',
+            ])
+
+            for repository in ['test-image', 'other-image']:
+                assert_that(registry.tags(repository),
+                            Equals(['abc', 'def']))
+            assert_that(registry.get_blob('other-image', digest(b'other')),
+                        Equals(b'other'))
+
+        out, _ = capfd.readouterr()
+        assert_that(out, MatchesRegex(
+            r'The push refers to repository \[%s/test-image\]\n.*'
+            r'abc: digest: sha256:[0-9a-f]{64} size: \d+\n' % (
+                re.escape(registry.domain),), re.DOTALL))
+
+    def test_archive_backend_metrics(self, tmpdir, monkeypatch):
+        """
+        When the archive backend is used with the --metrics-file option, the
+        bytes of the blobs uploaded should be counted, as well as those of
+        the manifests pushed.
+        """
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        path = str(tmpdir.join('images.tar'))
+        write_docker_archive(path, [(['test-image:latest'], [b'layer'])])
+        metrics_path = tmpdir.join('metrics.json')
+        with FakeRegistry() as registry:
+            main([
+                '--backend', 'archive', '--archive', path,
+                '--registry', registry.domain,
+                '--insecure-registry', registry.domain,
+                '--metrics-file', str(metrics_path),
+            ])
+
+        counters = dict((counter['name'], counter['value']) for counter in
+                        json.loads(metrics_path.read())['counters'])
+        config = make_config([b'layer'])
+        assert_that(counters['pushed_bytes'],
+                    Equals(len(b'layer') + len(config)))
+        assert_that(counters['manifest_bytes'], GreaterThan(0))
+
+    def test_chunk_size(self, tmpdir, monkeypatch):
+        """
+        When the --chunk-size option is used, blobs should be uploaded in
+        chunks of that size.
+        """
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        path = str(tmpdir.join('images.tar'))
+        layer = b'layer' * 500
+        write_docker_archive(path, [(['test-image:latest'], [layer])])
+        with FakeRegistry() as registry:
+            main([
+                '--backend', 'archive', '--archive', path,
+                '--registry', registry.domain,
+                '--insecure-registry', registry.domain,
+                '--cache-file', str(tmpdir.join('cache.json')),
+                '--chunk-size', '1k',
+            ])
+
+            assert_that(registry.get_blob('test-image', digest(layer)),
+                        Equals(layer))
+            assert_that(
+                sum(1 for method, _ in registry.requests
+                    if method == 'PATCH'),
+                Equals(4))
+
+    def test_compress(self, tmpdir, monkeypatch):
+        """
+        When the --compress option is used, uncompressed layers should be
+        pushed compressed with gzip, the same way on every run.
+        """
+        monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+        path = str(tmpdir.join('images.tar'))
+        write_docker_archive(path, [(['test-image:latest'], [b'layer'])])
+        with FakeRegistry() as registry:
+            args = [
+                '--backend', 'archive', '--archive', path,
+                '--registry', registry.domain,
+                '--insecure-registry', registry.domain,
+                '--compress', '--compress-chunk-size', '1k',
+            ]
+            main(args)
+            _, first_manifest = registry.get_manifest('test-image', 'latest')
+            main(args)
+
+            _, manifest = registry.get_manifest('test-image', 'latest')
+            layer = json.loads(manifest.decode('utf-8'))['layers'][0]
+            assert_that(layer['mediaType'], Equals(
+                'application/vnd.oci.image.layer.v1.tar+gzip'))
+            assert_that(manifest, Equals(first_manifest))
+
+    def test_chunk_size_invalid(self, capfd):
+        """
+        When the --chunk-size option isn't a size, or is used without
+        --backend archive, an error should be raised.
+        """
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--backend', 'archive', '--archive', 'images.tar',
+                  '--chunk-size', '0'])
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--chunk-size', '1M', 'test-image'])
+
+        out, err = capfd.readouterr()
+        assert_that(out, Equals(''))
+        assert_that(err, MatchesRegex(
+            r".*error: the --chunk-size option must be a number of bytes of "
+            r"at least 1, optionally followed by 'k', 'M' or 'G'\n"
+            r'.*error: the --chunk-size option requires --backend archive$',
+            re.DOTALL))
+
+    def test_archive_requires_archive_backend(self, capfd):
+        """
+        When the --archive option is used without --backend archive, or the
+        other way round, an error should be raised.
+        """
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--archive', 'images.tar'])
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--backend', 'archive', 'test-image'])
+
+        out, err = capfd.readouterr()
+        assert_that(out, Equals(''))
+        assert_that(err, MatchesRegex(
+            r'.*error: the --archive option requires --backend archive\n'
+            r'.*error: the --backend archive option requires --archive$',
+            re.DOTALL))
+
+    def test_jobs_must_be_positive(self, capfd):
+        """
+        When the --jobs option is less than 1, an error should be raised.
+        """
+        with ExpectedException(SystemExit, MatchesStructure(code=Equals(2))):
+            main(['--jobs', '0', 'test-image'])
+
+        out, err = capfd.readouterr()
+        assert_that(out, Equals(''))
+        assert_that(err, MatchesRegex(
+            r'.*error: the --jobs option must be at least 1$', re.DOTALL))
+
+    def test_registry_jobs_must_be_positive(self, capfd):
+        """
+        When the --registry-jobs option is not a number of at least 1, an
+        error should be raised.
+        """
+        for value in ['0', 'registry.example.com=abc']:
+            with ExpectedException(
+                    SystemExit, MatchesStructure(code=Equals(2))):
+                main(['--registry-jobs', value, 'test-image'])
+
+            out, err = capfd.readouterr()
+            assert_that(out, Equals(''))
+            assert_that(err, MatchesRegex(
+                r'.*error: the --registry-jobs option must be a number of at '
+                r"least 1, optionally preceded by 'REGISTRY='$", re.DOTALL))
+
+    def test_multiple_registries(self, capfd):
+        """
+        When the --registry option is repeated, the image should be tagged
+        and pushed to each registry.
+        """
+        main([
+            '--registry', 'registry.example.com:5000',
+            '--registry', 'registry2.example.com',
+            '--registry-jobs', '2',
+            '--registry-jobs', 'registry2.example.com=1',
+            '--executable', 'echo',
+            '--jobs', '4',
+            'test-image:abc'
+        ])
+
+        assert_output_lines_unordered(capfd, [
+            'tag test-image:abc registry.example.com:5000/test-image:abc',
+            'tag test-image:abc registry2.example.com/test-image:abc',
+            'push registry.example.com:5000/test-image:abc',
+            'push registry2.example.com/test-image:abc',
+        ])
+
     def test_tag_requires_arguments(self, capfd):
         """
         When the main function is given the `--tag` option without any
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+from testtools import ExpectedException
+from testtools.assertions import assert_that
+from testtools.matchers import Contains, Equals, MatchesListwise
+
+from docker_ci_deploy.metrics import DeployMetrics
+
+
+def fake_clock(monkeypatch, times):
+    """ Make ``time.time()`` return each of the given times in turn. """
+    times = iter(times)
+    monkeypatch.setattr(time, 'time', lambda: next(times))
+
+
+class TestDeployMetrics(object):
+    def test_summary(self, monkeypatch):
+        """
+        The summary should have the count, percentiles and total of the
+        durations of each operation, and the counters.
+        """
+        fake_clock(monkeypatch, [0] + list(range(10, 31)))
+        metrics = DeployMetrics()
+        for _ in range(10):
+            with metrics.measure('push', 'docker.io'):
+                pass
+        metrics.add('pushed_bytes', 100, registry='docker.io')
+        metrics.add('pushed_bytes', 20, registry='docker.io')
+        metrics.add('skipped_tags', reason='cached')
+        metrics.finish(True)
+
+        summary = metrics.summary()
+        assert_that(summary['duration_seconds'], Equals(30))
+        assert_that(summary['succeeded'], Equals(True))
+        assert_that(summary['operations'], Equals([{
+            'operation': 'push',
+            'registry': 'docker.io',
+            'count': 10,
+            'failures': 0,
+            'total_seconds': 10,
+            'p50_seconds': 1,
+            'p95_seconds': 1,
+            'max_seconds': 1,
+        }]))
+        assert_that(summary['counters'], Equals([
+            {'name': 'pushed_bytes', 'labels': {'registry': 'docker.io'},
+             'value': 120},
+            {'name': 'skipped_tags', 'labels': {'reason': 'cached'},
+             'value': 1},
+        ]))
+
+    def test_failure(self):
+        """
+        When a measured operation raises an exception, it should be counted
+        as a failure and the exception should be raised.
+        """
+        metrics = DeployMetrics()
+        with ExpectedException(RuntimeError, r'oops'):
+            with metrics.measure('push', 'docker.io'):
+                raise RuntimeError('oops')
+
+        [operation] = metrics.summary()['operations']
+        assert_that(operation['count'], Equals(1))
+        assert_that(operation['failures'], Equals(1))
+
+    def test_prometheus(self, monkeypatch):
+        """
+        The Prometheus output should have a histogram of the durations of
+        each operation, and a line for each counter.
+        """
+        fake_clock(monkeypatch, [0, 10, 10.5, 11, 14, 20])
+        metrics = DeployMetrics(buckets=(1, 5))
+        with metrics.measure('push', 'registry:5000'):
+            pass
+        with metrics.measure('tag'):
+            pass
+        metrics.add('layers', registry='a"b', status='pushed')
+        metrics.finish(False)
+
+        lines = metrics.prometheus_lines()
+        name = 'docker_ci_deploy_operation_duration_seconds'
+        assert_that(lines[:12], MatchesListwise([Equals(line) for line in [
+            '# HELP %s Time taken by each operation.' % (name,),
+            '# TYPE %s histogram' % (name,),
+            name + '_bucket{operation="push",registry="registry:5000",'
+                   'le="1"} 1',
+            name + '_bucket{operation="push",registry="registry:5000",'
+                   'le="5"} 1',
+            name + '_bucket{operation="push",registry="registry:5000",'
+                   'le="+Inf"} 1',
+            name + '_sum{operation="push",registry="registry:5000"} 0.5',
+            name + '_count{operation="push",registry="registry:5000"} 1',
+            name + '_bucket{operation="tag",registry="",le="1"} 0',
+            name + '_bucket{operation="tag",registry="",le="5"} 1',
+            name + '_bucket{operation="tag",registry="",le="+Inf"} 1',
+            name + '_sum{operation="tag",registry=""} 3.0',
+            name + '_count{operation="tag",registry=""} 1',
+        ]]))
+        assert_that(lines, Contains(
+            'docker_ci_deploy_layers_total{registry="a\\"b",status="pushed"} '
+            '1'))
+        assert_that(lines, Contains('docker_ci_deploy_last_run_success 0'))
+
+    def test_write(self, tmpdir):
+        """
+        The metrics should be written as JSON to a path ending in '.json',
+        and in the Prometheus text format to any other path.
+        """
+        metrics = DeployMetrics()
+        metrics.add('retries', 2)
+        metrics.write(str(tmpdir.join('metrics', 'deploy.json')))
+        metrics.write(str(tmpdir.join('metrics', 'deploy.prom')))
+
+        summary = json.loads(tmpdir.join('metrics', 'deploy.json').read())
+        assert_that(summary['counters'], Equals(
+            [{'name': 'retries', 'labels': {}, 'value': 2}]))
+        assert_that(
+            tmpdir.join('metrics', 'deploy.prom').read().splitlines(),
+            Contains('docker_ci_deploy_retries_total 2'))
+        assert_that(
+            sorted(path.basename for path in tmpdir.join('metrics').listdir()),
+            Equals(['deploy.json', 'deploy.prom']))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import pstats
+import sys
+import threading
+
+import pytest
+from testtools import ExpectedException
+from testtools.assertions import assert_that
+from testtools.matchers import Contains, Equals
+
+from docker_ci_deploy.profiling import (
+    CpuProfiler, make_profiler, MemoryProfiler)
+
+needs_tracemalloc = pytest.mark.skipif(
+    sys.version_info < (3, 4), reason='tracemalloc requires Python 3.4')
+
+
+def work_in_thread():
+    thread = threading.Thread(target=sorted, args=([3, 1, 2],))
+    thread.start()
+    thread.join()
+
+
+class TestCpuProfiler(object):
+    def test_threads(self, tmpdir):
+        """
+        The stats should include the functions called in threads started
+        while profiling as well as in the thread that started the profiler.
+        """
+        path = str(tmpdir.join('cpu.prof'))
+        profiler = CpuProfiler(path)
+        profiler.start()
+        work_in_thread()
+        profiler.stop()
+
+        functions = [function for _, _, function in pstats.Stats(path).stats]
+        assert_that(functions, Contains('work_in_thread'))
+        assert_that(any('sorted' in function for function in functions),
+                    Equals(True))
+
+    def test_one_profile_per_thread(self, tmpdir):
+        """
+        When a profiler can't be enabled in a thread, because another one
+        already profiles every thread, no more profilers should be created
+        for that thread.
+        """
+        class SingleProfile(object):
+            enabled = []
+
+            def enable(self):
+                if self.enabled:
+                    raise ValueError('Another profiling tool is already '
+                                     'active')
+                self.enabled.append(self)
+
+        profiler = CpuProfiler(str(tmpdir.join('cpu.prof')))
+        profiler._profile_class = SingleProfile
+        profiler.start()
+        try:
+            thread = threading.Thread(
+                target=lambda: [sorted([i]) for i in range(1000)])
+            thread.start()
+            thread.join()
+        finally:
+            threading.setprofile(None)
+            sys.setprofile(None)
+
+        assert_that(len(profiler._profiles), Equals(1))
+
+
+@needs_tracemalloc
+class TestMemoryProfiler(object):
+    def test_checkpoints(self, tmpdir):
+        """
+        The report should have the memory in use at each checkpoint and at
+        the end, and the lines that allocated it.
+        """
+        path = tmpdir.join('mem.txt')
+        profiler = MemoryProfiler(str(path), top=5)
+        profiler.start()
+        data = [bytearray(1000) for _ in range(100)]
+        profiler.checkpoint('allocated')
+        del data
+        profiler.stop()
+
+        lines = path.read().splitlines()
+        assert_that([line for line in lines if line.startswith('===')],
+                    Equals(['=== 1. allocated ===', '=== 2. end ===']))
+        assert_that(lines[4], Contains('test_profiling.py'))
+        assert_that(lines, Contains('Top 5 changes:'))
+
+
+class TestMakeProfilerFunc(object):
+    def test_default_paths(self):
+        """
+        Profiles should be written to files named after their kind by
+        default.
+        """
+        assert_that(make_profiler('cpu').path,
+                    Equals('docker-ci-deploy.cpu.prof'))
+        assert_that(make_profiler('cpu', 'cpu.prof').path,
+                    Equals('cpu.prof'))
+
+    @needs_tracemalloc
+    def test_default_paths_mem(self):
+        """
+        Memory reports should be written to a file named after their kind by
+        default.
+        """
+        assert_that(make_profiler('mem').path,
+                    Equals('docker-ci-deploy.mem.txt'))
+        assert_that(make_profiler('mem', 'mem.txt').path, Equals('mem.txt'))
+
+    @pytest.mark.skipif(sys.version_info >= (3, 4),
+                        reason='tracemalloc is available')
+    def test_mem_unavailable(self):
+        """
+        Without tracemalloc, a memory profiler should be rejected.
+        """
+        with ExpectedException(
+                ValueError, r'Memory profiling requires Python 3.4 or later'):
+            make_profiler('mem')
+
+    def test_unknown(self):
+        """ An unknown kind of profiler should be rejected. """
+        with ExpectedException(ValueError, r'Unknown kind of profiler: io'):
+            make_profiler('io')
@@ -0,0 +1,597 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+
+import pytest
+from testtools import ExpectedException
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, HasLength, Is, MatchesStructure
+
+try:
+    from http.client import BadStatusLine
+except ImportError:  # pragma: no cover
+    from httplib import BadStatusLine  # Python 2
+
+from docker_ci_deploy.registry import (
+    ConnectionPool, CredentialStore, load_basic_credentials,
+    parse_auth_challenge, RegistryClient, RegistryError, split_repository)
+from docker_ci_deploy.trace import TraceRecorder
+from docker_ci_deploy.testing.fake_registry import (
+    FakeRegistry, Faults, make_manifest)
+
+
+@pytest.fixture
+def docker_config(tmpdir, monkeypatch):
+    """ Point the Docker client config at an empty temporary directory. """
+    monkeypatch.setenv('DOCKER_CONFIG', str(tmpdir))
+    return tmpdir
+
+
+def write_docker_config(config_dir, auths):
+    config_dir.join('config.json').write(json.dumps({'auths': dict(
+        (domain, {'auth': base64.b64encode(
+            ':'.join(creds).encode('utf-8')).decode('ascii')})
+        for domain, creds in auths.items())}))
+
+
+@pytest.fixture
+def credential_helper(tmpdir, monkeypatch):
+    """
+    Install a ``docker-credential-fake`` credential helper that has the
+    credentials ('helper-user', 'secret') for every registry. Each server URL
+    it is asked about is written to the returned file.
+    """
+    bin_dir = tmpdir.mkdir('bin')
+    log = tmpdir.join('helper.log')
+    helper = bin_dir.join('docker-credential-fake')
+    helper.write('\n'.join([
+        '#!' + sys.executable,
+        'import json, sys',
+        'server_url = sys.stdin.read()',
+        'with open(%r, "a") as f:' % (str(log),),
+        '    f.write(server_url + "\\n")',
+        'print(json.dumps({"ServerURL": server_url,',
+        '                  "Username": "helper-user", "Secret": "secret"}))',
+    ]))
+    helper.chmod(helper.stat().mode | stat.S_IXUSR)
+    monkeypatch.setenv(
+        'PATH', os.pathsep.join([str(bin_dir), os.environ['PATH']]))
+    return log
+
+
+class TestSplitRepositoryFunc(object):
+    def test_registry(self):
+        """
+        When the first component of the name looks like a registry address,
+        it should be split from the repository.
+        """
+        assert_that(split_repository('registry:5000/user/name'),
+                    Equals(('registry:5000', 'user/name')))
+        assert_that(split_repository('example.com/name'),
+                    Equals(('example.com', 'name')))
+        assert_that(split_repository('localhost/name'),
+                    Equals(('localhost', 'name')))
+
+    def test_user_name(self):
+        """
+        When the first component of the name doesn't look like a registry
+        address, the image should be in a Docker Hub user's repository.
+        """
+        assert_that(split_repository('user/name'),
+                    Equals(('docker.io', 'user/name')))
+
+    def test_official_image(self):
+        """
+        When the name has only one component, the image should be an official
+        Docker Hub image.
+        """
+        assert_that(split_repository('name'),
+                    Equals(('docker.io', 'library/name')))
+
+
+class TestLoadBasicCredentialsFunc(object):
+    def test_credentials(self, docker_config):
+        """
+        When the Docker config has credentials for the registry, they should
+        be returned.
+        """
+        write_docker_config(docker_config, {'registry:5000': ('foo', 'b:r')})
+
+        assert_that(load_basic_credentials('registry:5000'),
+                    Equals(('foo', 'b:r')))
+
+    def test_docker_hub(self, docker_config):
+        """
+        Credentials for Docker Hub should be found under the legacy index
+        address.
+        """
+        write_docker_config(
+            docker_config, {'https://index.docker.io/v1/': ('foo', 'bar')})
+
+        assert_that(load_basic_credentials('docker.io'),
+                    Equals(('foo', 'bar')))
+
+    def test_no_credentials(self, docker_config):
+        """
+        When there are no credentials for the registry, or no config file,
+        None should be returned.
+        """
+        assert_that(load_basic_credentials('registry:5000'), Is(None))
+
+        write_docker_config(docker_config, {'other:5000': ('foo', 'bar')})
+        assert_that(load_basic_credentials('registry:5000'), Is(None))
+
+    def test_credential_helper(self, docker_config, credential_helper):
+        """
+        When the Docker config names a credential helper for the registry, or
+        a default credential store, the credentials should be read from it.
+        """
+        config = docker_config.join('config.json')
+        config.write(json.dumps(
+            {'credHelpers': {'registry:5000': 'fake'}}))
+        assert_that(load_basic_credentials('registry:5000'),
+                    Equals(('helper-user', 'secret')))
+        assert_that(load_basic_credentials('other:5000'), Is(None))
+
+        config.write(json.dumps({'credsStore': 'fake'}))
+        assert_that(load_basic_credentials('docker.io'),
+                    Equals(('helper-user', 'secret')))
+        assert_that(credential_helper.read().splitlines(), Equals(
+            ['registry:5000', 'https://index.docker.io/v1/']))
+
+    def test_missing_credential_helper(self, docker_config):
+        """
+        When the credential helper can't be run, the credentials in the
+        Docker config should be used instead.
+        """
+        docker_config.join('config.json').write(json.dumps({
+            'credsStore': 'missing',
+            'auths': {'registry:5000': {'auth': base64.b64encode(
+                b'foo:bar').decode('ascii')}},
+        }))
+
+        assert_that(load_basic_credentials('registry:5000'),
+                    Equals(('foo', 'bar')))
+
+
+class TestCredentialStore(object):
+    def test_get_once(self, docker_config, credential_helper):
+        """
+        When the credentials for a registry are needed many times, even by
+        several threads at once, the credential helper should only be run
+        once for each registry.
+        """
+        docker_config.join('config.json').write(
+            json.dumps({'credsStore': 'fake'}))
+        store = CredentialStore()
+        domains = ['registry:5000', 'other:5000'] * 4
+        threads = [threading.Thread(target=store.get, args=(domain,))
+                   for domain in domains]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert_that(store.get('registry:5000'),
+                    Equals(('helper-user', 'secret')))
+        assert_that(sorted(credential_helper.read().splitlines()),
+                    Equals(['other:5000', 'registry:5000']))
+
+
+class TestParseAuthChallengeFunc(object):
+    def test_bearer(self):
+        """ A bearer challenge should be parsed into its parameters. """
+        challenge = parse_auth_challenge(
+            'Bearer realm="https://auth.docker.io/token",'
+            'service="registry.docker.io",scope="repository:a/b:pull,push"')
+
+        assert_that(challenge, Equals(('bearer', {
+            'realm': 'https://auth.docker.io/token',
+            'service': 'registry.docker.io',
+            'scope': 'repository:a/b:pull,push',
+        })))
+
+
+class TestConnectionPool(object):
+    def test_reuse(self):
+        """
+        When several requests are made to the same host, one connection
+        should be opened and reused for them.
+        """
+        pool = ConnectionPool()
+        with FakeRegistry() as registry:
+            url = 'http://%s/v2/name/manifests/tag' % (registry.domain,)
+            for _ in range(3):
+                assert_that(pool.request(url)[0], Equals(404))
+            pool.close()
+
+        assert_that(pool.stats(), Equals(
+            {'requests': 3, 'connections': 1, 'reused': 2, 'retries': 0}))
+
+    def test_tracer(self):
+        """
+        When the pool has a tracer, each request should be recorded as a
+        span with the response's status.
+        """
+        tracer = TraceRecorder()
+        pool = ConnectionPool(tracer=tracer)
+        with FakeRegistry() as registry:
+            url = 'http://%s/v2/name/manifests/tag' % (registry.domain,)
+            pool.request(url, 'HEAD')
+
+        [event] = [e for e in tracer.events() if e['ph'] == 'X']
+        assert_that(event['name'], Equals('HEAD /v2/name/manifests/tag'))
+        assert_that(event['cat'], Equals('registry'))
+        assert_that(event['args'], Equals({'url': url, 'status': 404}))
+
+    def test_max_connections(self):
+        """
+        When more threads make requests at once than the maximum number of
+        connections, they should wait for a connection to be free.
+        """
+        pool = ConnectionPool(max_connections=2)
+        with FakeRegistry(faults=Faults(latency=0.02)) as registry:
+            url = 'http://%s/v2/name/manifests/tag' % (registry.domain,)
+            threads = [threading.Thread(target=pool.request, args=(url,))
+                       for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert_that(pool.stats(), Equals(
+            {'requests': 6, 'connections': 2, 'reused': 4, 'retries': 0}))
+
+    def test_dropped_connection(self):
+        """
+        When the server has closed an idle connection, the request should be
+        made again on a new connection.
+        """
+        pool = ConnectionPool()
+        with FakeRegistry(drop_connections=True) as registry:
+            url = 'http://%s/v2/name/manifests/tag' % (registry.domain,)
+            for _ in range(3):
+                assert_that(pool.request(url)[0], Equals(404))
+
+        assert_that(registry.requests, HasLength(3))
+        assert_that(pool.stats(), Equals(
+            {'requests': 3, 'connections': 3, 'reused': 0, 'retries': 2}))
+
+    def test_dropped_request(self):
+        """
+        When the server closes a reused connection after receiving a request
+        that can safely be made again, it should be made again on a new
+        connection.
+        """
+        pool = ConnectionPool()
+        with FakeRegistry(drop_requests=True) as registry:
+            url = 'http://%s/v2/name/manifests/tag' % (registry.domain,)
+            for _ in range(2):
+                assert_that(pool.request(url)[0], Equals(404))
+
+        assert_that(registry.requests, HasLength(3))
+        assert_that(pool.stats(), Equals(
+            {'requests': 2, 'connections': 2, 'reused': 0, 'retries': 1}))
+
+    def test_dropped_request_not_idempotent(self):
+        """
+        When the server closes a reused connection after receiving a request
+        that might do something again if it were made again, such as a POST,
+        the error should be raised.
+        """
+        pool = ConnectionPool()
+        with FakeRegistry(drop_requests=True) as registry:
+            url = 'http://%s/v2/name/blobs/uploads/' % (registry.domain,)
+            pool.request(url, 'POST')
+            errors = []
+            try:
+                pool.request(url, 'POST')
+            except (BadStatusLine, socket.error) as e:
+                errors.append(e)
+
+        assert_that(errors, HasLength(1))
+        assert_that(registry.requests, HasLength(2))
+
+    def test_timeout(self):
+        """
+        Connections should be made with the pool's timeout.
+        """
+        pool = ConnectionPool(timeout=5)
+        connection, _ = pool._acquire(('http', '127.0.0.1:5000'))
+
+        assert_that(connection.timeout, Equals(5))
+
+
+class TestRegistryClient(object):
+    @pytest.fixture
+    def registry(self):
+        with FakeRegistry() as registry:
+            yield registry
+
+    def test_get_manifest(self, docker_config, registry):
+        """
+        When a manifest is fetched, its media type, content and digest should
+        be returned.
+        """
+        manifest = make_manifest(layers=[b'abc'])
+        digest = registry.add_manifest('user/name', 'tag', manifest)
+        client = RegistryClient(registry.domain, secure=False)
+
+        assert_that(client.get_manifest('user/name', 'tag'), Equals((
+            'application/vnd.docker.distribution.manifest.v2+json', manifest,
+            digest)))
+
+    def test_put_manifest(self, docker_config, registry):
+        """
+        When a manifest is uploaded, it should be stored under the given tag.
+        """
+        manifest = make_manifest(layers=[b'abc'])
+        client = RegistryClient(registry.domain, secure=False)
+        client.put_manifest('user/name', 'tag', 'application/foo', manifest)
+
+        assert_that(registry.get_manifest('user/name', 'tag'),
+                    Equals(('application/foo', manifest)))
+
+    def test_error(self, docker_config, registry):
+        """
+        When the registry responds with an error status, an error should be
+        raised.
+        """
+        client = RegistryClient(registry.domain, secure=False)
+
+        with ExpectedException(RegistryError, MatchesStructure(
+                status=Equals(404))):
+            client.get_manifest('user/name', 'missing')
+
+    def test_server_error(self, docker_config):
+        """
+        When the registry fails to handle a request, an error should be
+        raised.
+        """
+        with FakeRegistry(faults=Faults(failure_rate=1)) as registry:
+            client = RegistryClient(registry.domain, secure=False)
+
+            with ExpectedException(RegistryError, MatchesStructure(
+                    status=Equals(503))):
+                client.get_manifest('user/name', 'tag')
+
+    def test_basic_auth(self, docker_config):
+        """
+        When the registry requires basic authentication, the credentials from
+        the Docker config should be used.
+        """
+        with FakeRegistry(auth='basic') as registry:
+            write_docker_config(
+                docker_config, {registry.domain: ('user', 'pass')})
+            registry.add_manifest('name', 'tag', b'{}')
+            client = RegistryClient(registry.domain, secure=False)
+
+            assert_that(client.get_manifest('name', 'tag')[1], Equals(b'{}'))
+
+    def test_bearer_auth(self, docker_config):
+        """
+        When the registry requires bearer token authentication, a token should
+        be fetched for the requested scope and reused for later requests.
+        """
+        with FakeRegistry(auth='bearer') as registry:
+            registry.add_manifest('name', 'tag', b'{}')
+            client = RegistryClient(
+                registry.domain, secure=False, credentials=('user', 'pass'))
+            client.get_manifest('name', 'tag')
+            client.get_manifest('name', 'tag')
+
+            assert_that(registry.tokens_issued, Equals(1))
+            assert_that(registry.requests, Equals([
+                ('GET', '/v2/name/manifests/tag'),
+                ('GET', '/token'),
+                ('GET', '/v2/name/manifests/tag'),
+                ('GET', '/v2/name/manifests/tag'),
+            ]))
+
+    def test_bearer_token_renewed(self, docker_config, monkeypatch):
+        """
+        When a bearer token is about to expire, a new one should be fetched
+        before the next request rather than after the registry rejects it.
+        Once the registry has asked for bearer tokens, tokens for new scopes
+        should also be fetched before making requests.
+        """
+        with FakeRegistry(auth='bearer', token_lifetime=300) as registry:
+            registry.add_manifest('name', 'tag', b'{}')
+            registry.add_manifest('other', 'tag', b'{}')
+            client = RegistryClient(
+                registry.domain, secure=False, credentials=('user', 'pass'))
+            client.get_manifest('name', 'tag')
+            client.get_manifest('other', 'tag')
+
+            now = time.time()
+            monkeypatch.setattr(time, 'time', lambda: now + 271)
+            client.get_manifest('name', 'tag')
+
+            assert_that(registry.tokens_issued, Equals(3))
+            assert_that(registry.requests, Equals([
+                ('GET', '/v2/name/manifests/tag'),
+                ('GET', '/token'),
+                ('GET', '/v2/name/manifests/tag'),
+                ('GET', '/token'),
+                ('GET', '/v2/other/manifests/tag'),
+                ('GET', '/token'),
+                ('GET', '/v2/name/manifests/tag'),
+            ]))
+
+    def test_bearer_token_scopes(self, docker_config):
+        """
+        While a bearer token is being fetched for one scope, tokens for other
+        scopes should still be fetched without waiting for it.
+        """
+        client = RegistryClient(
+            'registry.example.com', credentials=('user', 'pass'))
+        started, release = threading.Event(), threading.Event()
+        fetched = []
+
+        def fetch_token(params):
+            if params['scope'] == 'slow':
+                started.set()
+                release.wait(timeout=5)
+            fetched.append(params['scope'])
+            return 'token-for-' + params['scope'], time.time() + 60
+        client._fetch_token = fetch_token
+
+        thread = threading.Thread(
+            target=client._token, args=({'scope': 'slow'},))
+        thread.start()
+        started.wait(timeout=5)
+        token = client._token({'scope': 'fast'})
+        release.set()
+        thread.join()
+
+        assert_that(token, Equals('token-for-fast'))
+        assert_that(fetched, Equals(['fast', 'slow']))
+
+    def test_bearer_auth_bad_credentials(self, docker_config):
+        """
+        When the token server rejects the credentials, an error should be
+        raised.
+        """
+        with FakeRegistry(auth='bearer') as registry:
+            client = RegistryClient(
+                registry.domain, secure=False, credentials=('user', 'wrong'))
+
+            with ExpectedException(RegistryError, MatchesStructure(
+                    status=Equals(401))):
+                client.get_manifest('name', 'tag')
+
+    def test_manifest_digest(self, docker_config, registry):
+        """
+        The digest of a manifest should be fetched without fetching the
+        manifest, and None should be returned if there is no such manifest.
+        """
+        digest = registry.add_manifest('name', 'tag', make_manifest())
+        client = RegistryClient(registry.domain, secure=False)
+
+        assert_that(client.manifest_digest('name', 'tag'), Equals(digest))
+        assert_that(client.manifest_digest('name', 'other'), Is(None))
+        assert_that(registry.requests, Equals([
+            ('HEAD', '/v2/name/manifests/tag'),
+            ('HEAD', '/v2/name/manifests/other'),
+        ]))
+
+    def test_list_tags(self, docker_config, registry):
+        """
+        All the tags in a repository should be listed, following pagination
+        links until the last page.
+        """
+        for tag in ['a', 'b', 'c', 'd', 'e']:
+            registry.add_manifest('name', tag, make_manifest())
+        client = RegistryClient(registry.domain, secure=False)
+
+        assert_that(client.list_tags('name', page_size=2),
+                    Equals(['a', 'b', 'c', 'd', 'e']))
+        assert_that(registry.requests, Equals(
+            [('GET', '/v2/name/tags/list')] * 3))
+
+    def test_list_tags_missing_repository(self, docker_config, registry):
+        """
+        When the repository doesn't exist, an empty list should be returned.
+        """
+        client = RegistryClient(registry.domain, secure=False)
+
+        assert_that(client.list_tags('name'), Equals([]))
+
+    def test_upload_blob(self, docker_config, registry):
+        """
+        When a blob is uploaded, the repository should have it, and checking
+        for it should not fetch it.
+        """
+        client = RegistryClient(registry.domain, secure=False)
+        digest = 'sha256:' + hashlib.sha256(b'abc').hexdigest()
+
+        assert_that(client.blob_exists('name', digest), Equals(False))
+        client.upload_blob('name', digest, memoryview(b'abc'))
+
+        assert_that(registry.get_blob('name', digest), Equals(b'abc'))
+        assert_that(client.blob_exists('name', digest), Equals(True))
+        assert_that([method for method, _ in registry.requests], Equals(
+            ['HEAD', 'POST', 'PUT', 'HEAD']))
+
+    def test_upload_blob_wrong_digest(self, docker_config, registry):
+        """
+        When a blob's content doesn't match its digest, an error should be
+        raised.
+        """
+        client = RegistryClient(registry.domain, secure=False)
+
+        with ExpectedException(RegistryError, MatchesStructure(
+                status=Equals(400))):
+            client.upload_blob('name', 'sha256:' + '0' * 64, b'abc')
+
+    def test_upload_blob_chunked(self, docker_config, registry):
+        """
+        When a blob is uploaded in chunks, each chunk should be sent in its
+        own request and the progress reported after each one.
+        """
+        client = RegistryClient(registry.domain, secure=False)
+        digest = 'sha256:' + hashlib.sha256(b'abcde').hexdigest()
+        progress = []
+
+        client.upload_blob('name', digest, memoryview(b'abcde'), chunk_size=2,
+                           progress=lambda *args: progress.append(args))
+
+        assert_that(registry.get_blob('name', digest), Equals(b'abcde'))
+        assert_that([method for method, _ in registry.requests], Equals(
+            ['POST', 'PATCH', 'PATCH', 'PATCH', 'PUT']))
+        assert_that([offset for _, offset in progress], Equals([2, 4, 5]))
+
+    def test_upload_blob_resume(self, docker_config, registry):
+        """
+        When an interrupted chunked upload is resumed, only the chunks that
+        the registry hasn't received should be sent. When the upload session
+        no longer exists, the upload should start again. The byte that the
+        upload started from should be returned.
+        """
+        client = RegistryClient(registry.domain, secure=False)
+        digest = 'sha256:' + hashlib.sha256(b'abcde').hexdigest()
+        locations = []
+
+        def interrupt(location, offset):
+            locations.append(location)
+            raise KeyboardInterrupt()
+
+        with ExpectedException(KeyboardInterrupt):
+            client.upload_blob('name', digest, b'abcde', chunk_size=2,
+                               progress=interrupt)
+        del registry.requests[:]
+        start = client.upload_blob('name', digest, b'abcde', chunk_size=2,
+                                   location=locations[0])
+
+        assert_that(start, Equals(2))
+        assert_that(registry.get_blob('name', digest), Equals(b'abcde'))
+        assert_that([method for method, _ in registry.requests], Equals(
+            ['GET', 'PATCH', 'PATCH', 'PUT']))
+
+        del registry.requests[:]
+        start = client.upload_blob('name', digest, b'abcde', chunk_size=4,
+                                   location=locations[0])
+        assert_that(start, Equals(0))
+        assert_that([method for method, _ in registry.requests], Equals(
+            ['GET', 'POST', 'PATCH', 'PATCH', 'PUT']))
+
+    def test_mount_blob(self, docker_config, registry):
+        """
+        When a blob is mounted from another repository that has it, the
+        repository should have the blob. When the other repository doesn't
+        have it, False should be returned.
+        """
+        digest = registry.add_blob('other', b'abc')
+        client = RegistryClient(registry.domain, secure=False)
+
+        assert_that(client.mount_blob('name', digest, 'other'), Equals(True))
+        assert_that(registry.get_blob('name', digest), Equals(b'abc'))
+        assert_that(client.mount_blob('name', digest, 'missing'),
+                    Equals(False))
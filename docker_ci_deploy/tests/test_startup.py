@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+
+import pytest
+from testtools.assertions import assert_that
+from testtools.matchers import Contains, Equals, LessThan, Not
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+BUILD_ZIPAPP = os.path.join(ROOT, 'scripts', 'build_zipapp.py')
+
+# The most time, in microseconds, that importing the main module itself (not
+# counting the modules it imports) may take. It usually takes a few
+# milliseconds, but CI machines can be slow.
+IMPORT_BUDGET = 50000
+
+# Modules that are slow to import and shouldn't be needed until they're used
+DEFERRED_MODULES = [
+    'argparse', 'json', 'subprocess', 'tempfile',
+    'docker_ci_deploy.registry', 'docker_ci_deploy.engine',
+    'docker_ci_deploy.archive',
+]
+
+needs_importtime = pytest.mark.skipif(
+    sys.version_info < (3, 8),
+    reason='-X importtime and PYTHONPYCACHEPREFIX require Python 3.8')
+
+
+def python_env(tmpdir):
+    """
+    An environment for running Python like a freshly installed package: with
+    bytecode that is written once and then used, but not in the source tree.
+    """
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPYCACHEPREFIX'] = str(tmpdir.join('pycache'))
+    env['PYTHONPATH'] = ROOT
+    return env
+
+
+def import_times(env):
+    """
+    Import the main module in a new interpreter and get the self time, in
+    microseconds, of each module that was imported.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import docker_ci_deploy.__main__'],
+        env=env, stderr=subprocess.STDOUT).decode('utf-8')
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        self_time, _, module = line[len('import time:'):].split('|')
+        if self_time.strip().isdigit():
+            times[module.strip()] = int(self_time)
+    return times
+
+
+@needs_importtime
+class TestImportTime(object):
+    def test_deferred_imports(self, tmpdir):
+        """
+        Importing the main module should not import the modules that are
+        only needed once a deploy starts.
+        """
+        times = import_times(python_env(tmpdir))
+
+        assert_that(times, Contains('docker_ci_deploy.__main__'))
+        for module in DEFERRED_MODULES:
+            assert_that(times, Not(Contains(module)))
+
+    def test_budget(self, tmpdir):
+        """
+        Importing the main module, once its bytecode has been written, should
+        take less than the budget.
+        """
+        env = python_env(tmpdir)
+        import_times(env)
+
+        times = import_times(env)
+        assert_that(times['docker_ci_deploy.__main__'],
+                    LessThan(IMPORT_BUDGET))
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5),
+                    reason='zipapp requires Python 3.5')
+@pytest.mark.skipif(not os.path.exists(BUILD_ZIPAPP),
+                    reason='The build script is not installed')
+class TestZipapp(object):
+    def test_build_and_run(self, tmpdir):
+        """
+        The zipapp should include the package's bytecode but not its tests,
+        and should run the command.
+        """
+        import zipfile
+
+        path = str(tmpdir.join('docker-ci-deploy.pyz'))
+        subprocess.check_call(
+            [sys.executable, BUILD_ZIPAPP, '--output', path])
+
+        names = zipfile.ZipFile(path).namelist()
+        assert_that(names, Contains('__main__.py'))
+        assert_that(names, Contains('docker_ci_deploy/__main__.pyc'))
+        assert_that(
+            [name for name in names if '/tests/' in name], Equals([]))
+
+        output = subprocess.check_output(
+            [sys.executable, path, '--dry-run', '--tag', 'abc', '--',
+             'test-image']).decode('utf-8')
+        assert_that(output, Contains('docker push test-image:abc'))
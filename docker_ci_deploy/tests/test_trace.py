@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+
+from testtools import ExpectedException
+from testtools.assertions import assert_that
+from testtools.matchers import Equals
+
+from docker_ci_deploy.trace import TraceRecorder
+
+
+class TestTraceRecorder(object):
+    def test_span(self, monkeypatch):
+        """
+        When a span is recorded, it should be a complete event with its start
+        and duration in microseconds since the recorder was created, and the
+        details it was given.
+        """
+        times = iter([10, 10.5, 12.25])
+        monkeypatch.setattr(time, 'time', lambda: next(times))
+        tracer = TraceRecorder()
+        with tracer.span('docker push', 'deploy', tag='foo:a') as details:
+            details['status'] = 200
+
+        [event] = tracer.events()[3:]
+        assert_that(event, Equals({
+            'name': 'docker push', 'cat': 'deploy', 'ph': 'X',
+            'ts': 500000, 'dur': 1750000, 'pid': event['pid'], 'tid': 1,
+            'args': {'tag': 'foo:a', 'status': 200},
+        }))
+
+    def test_span_error(self):
+        """
+        When the code in a span raises an exception, the span should still be
+        recorded, with the error.
+        """
+        tracer = TraceRecorder()
+        with ExpectedException(RuntimeError, r'oops'):
+            with tracer.span('docker tag', 'deploy'):
+                raise RuntimeError('oops')
+
+        [event] = tracer.events()[3:]
+        assert_that(event['args'], Equals({'error': 'RuntimeError: oops'}))
+
+    def test_tracks(self):
+        """
+        Each thread should get its own track, named after the thread.
+        """
+        tracer = TraceRecorder()
+        tracer.record('main', 'deploy', tracer.started, tracer.started)
+        threads = [
+            threading.Thread(target=tracer.record, name='worker-%d' % (i,),
+                             args=('work', 'deploy', tracer.started,
+                                   tracer.started))
+            for i in [1, 2]]
+        for thread in threads:
+            thread.start()
+            thread.join()
+
+        thread_names = [
+            (event['tid'], event['args']['name']) for event in tracer.events()
+            if event['name'] == 'thread_name']
+        assert_that(thread_names, Equals([
+            (1, threading.current_thread().name),
+            (2, 'worker-1'),
+            (3, 'worker-2'),
+        ]))
+
+    def test_write(self, tmpdir):
+        """
+        The trace should be written as a JSON object, replacing the file in
+        one step without leaving any temporary files behind.
+        """
+        tracer = TraceRecorder()
+        tracer.record('main', 'deploy', tracer.started, tracer.started)
+        path = tmpdir.join('traces', 'trace.json')
+        tracer.write(str(path))
+
+        trace = json.loads(path.read())
+        assert_that(trace['traceEvents'], Equals(tracer.events()))
+        assert_that(tmpdir.join('traces').listdir(), Equals([path]))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+A timeline of a deploy run in the Chrome trace event format, which can be
+opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing. Each thread
+that does any work gets its own track, so overlapping tags and pushes (and
+the time spent waiting between them) can be seen.
+https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from docker_ci_deploy.files import write_atomic
+
+
+class TraceRecorder(object):
+    """
+    Records spans of time, as "complete" trace events, on the track of the
+    thread they happen on. Safe to use from any number of threads.
+    """
+
+    def __init__(self, process_name='docker-ci-deploy'):
+        self.process_name = process_name
+        self.started = time.time()
+        self._pid = os.getpid()
+        self._events = []
+        # Threads => (track ID, thread name). Keyed by the threads rather
+        # than their idents, which are reused once a thread has finished.
+        self._tracks = {}
+        self._lock = threading.Lock()
+
+    def _track(self):
+        thread = threading.current_thread()
+        track = self._tracks.get(thread)
+        if track is None:
+            track = self._tracks[thread] = (
+                len(self._tracks) + 1, thread.name)
+        return track[0]
+
+    def _timestamp(self, seconds):
+        # Trace timestamps are in microseconds
+        return int(round((seconds - self.started) * 1000000))
+
+    def record(self, name, category, start, end, args=None):
+        """
+        Record a span on the current thread's track.
+
+        :param name: The name of the span, e.g. 'docker push'.
+        :param category: The category of the span, e.g. 'docker'.
+        :param start: When the span started, as returned by ``time.time()``.
+        :param end: When the span ended.
+        :param args: A dict of details to show with the span, or None.
+        """
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': self._timestamp(start),
+            'dur': self._timestamp(end) - self._timestamp(start),
+            'pid': self._pid,
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            event['tid'] = self._track()
+            self._events.append(event)
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """
+        Record a span for the code in a ``with`` block. The block is given
+        the span's details as a dict that it can add to, e.g. with a response
+        status. If the block raises an exception, the span's 'error' is set.
+        """
+        start = time.time()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            self.record(name, category, start, time.time(), args)
+
+    def events(self):
+        """
+        Get the recorded events, after metadata events that name the process
+        and each track.
+        """
+        with self._lock:
+            events = list(self._events)
+            tracks = sorted(self._tracks.values())
+        metadata = [{
+            'name': 'process_name', 'ph': 'M', 'pid': self._pid,
+            'args': {'name': self.process_name},
+        }]
+        for track, thread_name in tracks:
+            metadata.extend([{
+                'name': 'thread_name', 'ph': 'M', 'pid': self._pid,
+                'tid': track, 'args': {'name': thread_name},
+            }, {
+                'name': 'thread_sort_index', 'ph': 'M', 'pid': self._pid,
+                'tid': track, 'args': {'sort_index': track},
+            }])
+        return metadata + sorted(events, key=lambda event: event['ts'])
+
+    def write(self, path):
+        """ Write the trace to a file as JSON. """
+        write_atomic(path, json.dumps({'traceEvents': self.events(),
+                                       'displayTimeUnit': 'ms'}))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Build docker-ci-deploy as a single-file zipapp that can be copied into a CI
+image and run with ``python3 docker-ci-deploy.pyz``, without pip or
+setuptools. The archive includes bytecode compiled by the Python that builds
+it, so that nothing needs to be compiled when it starts. Other versions of
+Python can still run it, but will compile the modules they import every time.
+
+    python3 scripts/build_zipapp.py --output dist/docker-ci-deploy.pyz
+"""
+from __future__ import print_function
+
+import argparse
+import compileall
+import os
+import shutil
+import sys
+import tempfile
+import zipapp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'docker_ci_deploy'
+DEFAULT_OUTPUT = os.path.join('dist', 'docker-ci-deploy.pyz')
+
+
+def build(output, interpreter='/usr/bin/env python3', compile=True):
+    """
+    Build the zipapp.
+
+    :param output: The path to write the archive to.
+    :param interpreter:
+        The interpreter for the archive's shebang line, or None for no
+        shebang line.
+    :param compile: Whether to include bytecode for the running Python.
+    """
+    staging = tempfile.mkdtemp()
+    try:
+        shutil.copytree(
+            os.path.join(ROOT, PACKAGE), os.path.join(staging, PACKAGE),
+            ignore=shutil.ignore_patterns(
+                'tests', 'testing', '__pycache__', '*.py[co]'))
+        if compile:
+            # zipimport only loads bytecode that is next to the source rather
+            # than in __pycache__, which is what legacy=True does
+            if not compileall.compile_dir(
+                    staging, quiet=1, legacy=True, optimize=0):
+                raise RuntimeError('Failed to compile %s' % (PACKAGE,))
+
+        directory = os.path.dirname(os.path.abspath(output))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        zipapp.create_archive(
+            staging, output, interpreter=interpreter,
+            main='%s.__main__:main' % (PACKAGE,))
+    finally:
+        shutil.rmtree(staging)
+
+
+def main(raw_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description='Build docker-ci-deploy as a single-file zipapp.')
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT,
+                        help='The path to write the zipapp to (default: '
+                             '%(default)s)')
+    parser.add_argument('-p', '--python', default='/usr/bin/env python3',
+                        help='The interpreter for the shebang line (default: '
+                             '%(default)s)')
+    parser.add_argument('--no-compile', action='store_true',
+                        help="Don't include precompiled bytecode")
+    args = parser.parse_args(raw_args)
+
+    build(args.output, interpreter=args.python, compile=not args.no_compile)
+    print('Built %s' % (args.output,))
+
+
+if __name__ == '__main__':
+    main()